@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import time
+import unicodedata
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from profiling import add_profile_argument, profiled  # noqa: E402
+from step2_planner import compute_base  # noqa: E402
+
+# Maps metadata variables to the questionnaire text that introduces them, without any LLM call.
+# Labels are normalized into tokens, matched against an inverted index of PDF lines, and the
+# best window of consecutive lines wins. Variables resolving to the same stem form a cluster.
+
+STOPWORDS = frozenset(
+    "a an and are as at be by do does for from has have how i if in is it me of on or our "
+    "please that the their them these this to was we what when which who with you your".split()
+)
+WINDOW_LINES = 3
+CANDIDATE_TOKENS = 4
+CANDIDATE_LINES = 16
+MIN_SCORE = 0.5
+
+_code_prefix = re.compile(r"^\s*[A-Za-z][\w.]*\s*[:.]\s+")
+
+
+class Line(NamedTuple):
+    page: int
+    text: str
+    tokens: Tuple[str, ...]
+
+
+def fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+
+def light_stem(token: str) -> str:
+    # Enough to match "brands"/"brand", "purchased"/"purchase", "shopping"/"shop"
+    for suffix in ("ing", "ies", "ed", "es", "s"):
+        if len(token) > len(suffix) + 3 and token.endswith(suffix):
+            return token[: -len(suffix)] + ("y" if suffix == "ies" else "")
+    return token
+
+
+def tokenize(text: str) -> Tuple[str, ...]:
+    return tuple(light_stem(t) for t in fold(text).split() if t not in STOPWORDS and len(t) > 1)
+
+
+def split_label(code: str, label: str) -> Tuple[str, str]:
+    # Export labels look like "A07r4: Jewelry - Do you ... industries?" -> (option, stem)
+    text = label or ""
+    if text.startswith(code):
+        text = text[len(code):].lstrip(" :.-")
+    else:
+        text = _code_prefix.sub("", text, count=1)
+    if " - " in text:
+        option, stem = text.split(" - ", 1)
+        return option.strip(), stem.strip()
+    return "", text.strip()
+
+
+def pdf_lines(pdf_path: str) -> List[Line]:
+    import fitz  # PyMuPDF
+
+    lines: List[Line] = []
+    with fitz.open(pdf_path) as doc:
+        for pno, page in enumerate(doc, start=1):
+            # words: (x0, y0, x1, y1, word, block, line, word_no); regroup into visual lines
+            current: Dict[Tuple[int, int], List[str]] = {}
+            for w in page.get_text("words", sort=True):
+                current.setdefault((w[5], w[6]), []).append(w[4])
+            for words in current.values():
+                text = " ".join(words)
+                tokens = tokenize(text)
+                if tokens:
+                    lines.append(Line(pno, text, tokens))
+    return lines
+
+
+class LineIndex:
+    def __init__(self, lines: List[Line]) -> None:
+        self.lines = lines
+        self.postings: Dict[str, List[int]] = {}
+        for i, line in enumerate(lines):
+            for tok in set(line.tokens):
+                self.postings.setdefault(tok, []).append(i)
+        n = max(1, len(lines))
+        self.idf = {tok: math.log(1.0 + n / len(ids)) for tok, ids in self.postings.items()}
+
+    def weight(self, tok: str) -> float:
+        # Tokens absent from the PDF still count against coverage, at the rarest weight
+        return self.idf.get(tok, math.log(1.0 + len(self.lines)))
+
+    def window_tokens(self, start: int, end: int) -> set:
+        out: set = set()
+        page = self.lines[start].page
+        for i in range(start, min(end, len(self.lines))):
+            if self.lines[i].page != page:
+                break
+            out.update(self.lines[i].tokens)
+        return out
+
+    def best_span(self, tokens: Tuple[str, ...]) -> Optional[Tuple[int, int, float]]:
+        # (first line, end line, IDF-weighted share of the stem's tokens found in the window)
+        wanted = set(tokens)
+        if not wanted:
+            return None
+        total = sum(self.weight(t) for t in wanted)
+        rare = sorted((t for t in wanted if t in self.postings), key=lambda t: -self.idf[t])[:CANDIDATE_TOKENS]
+        # Rank lines by the rare tokens they contain; only windows around the best few are scored
+        acc: Dict[int, float] = {}
+        for tok in rare:
+            w = self.idf[tok]
+            for i in self.postings[tok]:
+                acc[i] = acc.get(i, 0.0) + w
+        anchors = sorted(acc, key=lambda i: (-acc[i], i))[:CANDIDATE_LINES]
+        best: Optional[Tuple[int, int, float]] = None
+        for s in sorted({s for i in anchors for s in range(max(0, i - WINDOW_LINES + 1), i + 1)}):
+            for size in range(1, WINDOW_LINES + 1):
+                found = wanted & self.window_tokens(s, s + size)
+                score = sum(self.weight(t) for t in found) / total
+                # Highest coverage wins; ties go to the shortest window, then the earliest line
+                if best is None or score > best[2] + 1e-9 or (score > best[2] - 1e-9 and size < best[1] - best[0]):
+                    best = (s, s + size, score)
+        return best
+
+
+def align(
+    metadata: List[Dict[str, Any]],
+    lines: List[Line],
+    *,
+    min_score: float = MIN_SCORE,
+) -> Dict[str, Any]:
+    index = LineIndex(lines)
+    stems: Dict[Tuple[str, ...], Optional[Tuple[int, int, float]]] = {}
+    variables: Dict[str, Dict[str, Any]] = {}
+    unmatched: List[str] = []
+    clusters: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+
+    for q in metadata:
+        code = str(q.get("question_code", ""))
+        if not code:
+            continue
+        option, stem = split_label(code, str(q.get("question_text") or ""))
+        key = tokenize(stem)
+        if key not in stems:
+            # Many variables share one stem (grid rows, multi-select options); match it once
+            stems[key] = index.best_span(key)
+        hit = stems[key]
+        if hit is None or hit[2] < min_score:
+            unmatched.append(code)
+            # Unmatched variables still cluster on an identical stem + code base
+            cluster_key: Tuple[Any, ...] = ("stem", key, compute_base(code)) if key else ("code", code)
+            entry: Dict[str, Any] = {"page": None}
+        else:
+            start, end, score = hit
+            cluster_key = ("span", start, compute_base(code))
+            entry = {
+                "page": lines[start].page,
+                "lines": [start, end],
+                "span": " ".join(lines[i].text for i in range(start, end)),
+                "score": round(score, 3),
+            }
+        if option:
+            entry["option"] = option
+        cluster = clusters.get(cluster_key)
+        if cluster is None:
+            cluster = {
+                "id": f"c{len(clusters) + 1}",
+                "stem": stem,
+                "page": entry["page"],
+                "variables": [],
+            }
+            clusters[cluster_key] = cluster
+        cluster["variables"].append(code)
+        entry["cluster"] = cluster["id"]
+        variables[code] = entry
+
+    return {
+        "pages": max((ln.page for ln in lines), default=0),
+        "lines": len(lines),
+        "variables": variables,
+        "clusters": list(clusters.values()),
+        "unmatched": unmatched,
+    }
+
+
+def align_files(pdf_path: str, metadata_path: str, *, min_score: float = MIN_SCORE) -> Dict[str, Any]:
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    t0 = time.time()
+    lines = pdf_lines(pdf_path)
+    t1 = time.time()
+    result = align(metadata, lines, min_score=min_score)
+    t2 = time.time()
+    print(
+        f"[align] {len(lines)} lines from {result['pages']} pages in {t1 - t0:.2f}s; "
+        f"{len(metadata) - len(result['unmatched'])}/{len(metadata)} variables aligned, "
+        f"{len(result['clusters'])} clusters in {t2 - t1:.2f}s",
+        file=sys.stderr,
+    )
+    result["pdf"] = os.path.abspath(pdf_path)
+    return result
+
+
+def load_alignment(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def cluster_ids(alignment: Dict[str, Any], codes: List[str]) -> List[str]:
+    variables = alignment.get("variables", {})
+    return [str(variables.get(c, {}).get("cluster", f"code:{c}")) for c in codes]
+
+
+def grouping_hints(alignment: Dict[str, Any], codes: List[str]) -> List[Dict[str, Any]]:
+    # Multi-variable clusters restricted to `codes`: compact evidence of shared question stems
+    wanted = set(codes)
+    hints: List[Dict[str, Any]] = []
+    for cluster in alignment.get("clusters", []):
+        members = [c for c in cluster.get("variables", []) if c in wanted]
+        if len(members) >= 2:
+            hints.append({"page": cluster.get("page"), "variables": members})
+    return hints
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Align metadata variables to questionnaire PDF text (variable -> page -> span) and cluster shared stems."
+    )
+    parser.add_argument("--pdf", required=True, help="Path to the questionnaire PDF")
+    parser.add_argument("--metadata", required=True, help="Path to step1 metadata JSON")
+    parser.add_argument("--output", help="Optional output JSON path. If omitted, prints to stdout.")
+    parser.add_argument("--min-score", type=float, default=MIN_SCORE, help="Minimum weighted token coverage for a match (default: 0.5)")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiled("align", args.profile):
+        result = align_files(args.pdf, args.metadata, min_score=args.min_score)
+        payload = json.dumps(result, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(payload)
+            print(f"[align] Written: {args.output}", file=sys.stderr)
+        else:
+            print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Content-addressed store for uploads and stage outputs.
+#
+#   <root>/blobs/ab/<sha256>        file contents, stored once
+#   <root>/runs/<run_id>/           one directory per run: manifest.json plus hard links
+#                                   to the blobs under their logical names
+#   <root>/memo/<key>.json          stage cache: hash(stage, input hashes, params) -> output hashes
+#
+# Runs and memo entries hold blobs; eviction drops the least recently used holders (age first,
+# then size) and deletes blobs nothing holds any more.
+
+STORE_ENV = "PIPELINE_STORE_DIR"
+MAX_BYTES_ENV = "PIPELINE_STORE_MAX_BYTES"
+MAX_AGE_ENV = "PIPELINE_STORE_MAX_AGE_DAYS"
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Output", "store")
+DEFAULT_MAX_BYTES = 2 << 30
+DEFAULT_MAX_AGE_DAYS = 30.0
+# Blobs written or deduplicated onto (has/put/materialize refresh their mtime) moments ago may
+# belong to a run that has not committed its manifest yet
+UNREFERENCED_GRACE_S = 3600.0
+MANIFEST = "manifest.json"
+
+_process_lock = threading.Lock()
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def memo_key(stage: str, inputs: Dict[str, str], params: Optional[Dict[str, Any]] = None) -> str:
+    payload = {"stage": stage, "inputs": inputs, "params": params or {}}
+    return sha256_bytes(json.dumps(payload, sort_keys=True, default=str).encode("utf-8"))
+
+
+def new_run_id() -> str:
+    return datetime.now().strftime("%Y%m%d_%H%M%S_") + os.urandom(4).hex()
+
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _write_json(path: str, payload: Any) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else None
+    except Exception:
+        return None
+
+
+class ArtifactStore:
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        *,
+        max_bytes: Optional[int] = None,
+        max_age_s: Optional[float] = None,
+    ) -> None:
+        self.root = os.path.abspath(root or os.environ.get(STORE_ENV) or DEFAULT_ROOT)
+        self.max_bytes = int(max_bytes if max_bytes is not None else os.environ.get(MAX_BYTES_ENV) or DEFAULT_MAX_BYTES)
+        days = float(os.environ.get(MAX_AGE_ENV) or DEFAULT_MAX_AGE_DAYS)
+        self.max_age_s = float(max_age_s if max_age_s is not None else days * 86400)
+        self.blobs_dir = os.path.join(self.root, "blobs")
+        self.runs_dir = os.path.join(self.root, "runs")
+        self.memo_dir = os.path.join(self.root, "memo")
+        for d in (self.blobs_dir, self.runs_dir, self.memo_dir):
+            os.makedirs(d, exist_ok=True)
+
+    # Blobs
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.blobs_dir, sha[:2], sha)
+
+    def has(self, sha: str) -> bool:
+        path = self.blob_path(sha)
+        if os.path.exists(path):
+            _touch(path)
+            return True
+        return False
+
+    def _store_tmp(self, tmp: str, sha: str) -> str:
+        dest = self.blob_path(sha)
+        if os.path.exists(dest):
+            os.unlink(tmp)
+            _touch(dest)
+            return dest
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, dest)
+        return dest
+
+    def put_bytes(self, data: bytes) -> str:
+        sha = sha256_bytes(data)
+        if self.has(sha):
+            return sha
+        fd, tmp = tempfile.mkstemp(dir=self.blobs_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        self._store_tmp(tmp, sha)
+        return sha
+
+    def put_file(self, path: str) -> str:
+        sha = sha256_file(path)
+        if self.has(sha):
+            return sha
+        fd, tmp = tempfile.mkstemp(dir=self.blobs_dir, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(path, tmp)
+        self._store_tmp(tmp, sha)
+        return sha
+
+    def materialize(self, sha: str, dest: str, *, link: bool = True) -> str:
+        # Hard link when possible (instant, no extra disk). Blobs are stored read-only to discourage
+        # in-place edits through a link; link=False copies for files that will change.
+        src = self.blob_path(sha)
+        if not os.path.exists(src):
+            raise FileNotFoundError(f"blob {sha} not in store")
+        _touch(src)
+        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        if link:
+            try:
+                os.link(src, dest)
+                return dest
+            except OSError:
+                pass
+        shutil.copyfile(src, dest)
+        os.chmod(dest, 0o644)
+        return dest
+
+    # Runs
+
+    def run_dir(self, run_id: str) -> str:
+        return os.path.join(self.runs_dir, run_id)
+
+    def commit_run(
+        self,
+        run_id: str,
+        files: Dict[str, str],
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        # files: logical name (may contain "/") -> existing path; missing paths are skipped
+        run_dir = self.run_dir(run_id)
+        os.makedirs(run_dir, exist_ok=True)
+        entries: Dict[str, Dict[str, Any]] = {}
+        for name, src in files.items():
+            if not src or not os.path.isfile(src):
+                continue
+            sha = self.put_file(src)
+            self.materialize(sha, os.path.join(run_dir, name))
+            entries[name] = {"sha256": sha, "size": os.path.getsize(self.blob_path(sha))}
+        manifest = {
+            "run_id": run_id,
+            "created_at": time.time(),
+            "files": entries,
+            "meta": meta or {},
+        }
+        _write_json(os.path.join(run_dir, MANIFEST), manifest)
+        return manifest
+
+    def load_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self.run_dir(run_id), MANIFEST)
+        manifest = _read_json(path)
+        if manifest is not None:
+            _touch(path)
+        return manifest
+
+    def runs(self) -> List[Dict[str, Any]]:
+        out = []
+        for run_id in sorted(os.listdir(self.runs_dir)):
+            manifest = _read_json(os.path.join(self.runs_dir, run_id, MANIFEST))
+            if manifest is not None:
+                out.append(manifest)
+        return out
+
+    # Stage cache
+
+    def memo_get(self, key: str) -> Optional[Dict[str, str]]:
+        path = os.path.join(self.memo_dir, key + ".json")
+        entry = _read_json(path)
+        if entry is None:
+            return None
+        outputs = entry.get("outputs") or {}
+        if not all(self.has(sha) for sha in outputs.values()):
+            return None
+        _touch(path)
+        return outputs
+
+    def memo_put(self, key: str, outputs: Dict[str, str], meta: Optional[Dict[str, Any]] = None) -> None:
+        _write_json(
+            os.path.join(self.memo_dir, key + ".json"),
+            {"outputs": outputs, "created_at": time.time(), "meta": meta or {}},
+        )
+
+    # Eviction
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with _process_lock:
+            try:
+                import fcntl
+            except ImportError:
+                yield
+                return
+            with open(os.path.join(self.root, ".lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _holders(self) -> List[Tuple[float, str, str, List[str]]]:
+        # (last used, kind, path, blob hashes) for every run and memo entry
+        holders = []
+        for run_id in os.listdir(self.runs_dir):
+            path = os.path.join(self.runs_dir, run_id, MANIFEST)
+            manifest = _read_json(path)
+            if manifest is None:
+                # Run still being committed (or broken); judge it by its directory
+                path = os.path.join(self.runs_dir, run_id)
+                holders.append((os.path.getmtime(path), "run", path, []))
+                continue
+            shas = [e["sha256"] for e in manifest.get("files", {}).values()]
+            holders.append((os.path.getmtime(path), "run", path, shas))
+        for fname in os.listdir(self.memo_dir):
+            if not fname.endswith(".json"):
+                continue
+            path = os.path.join(self.memo_dir, fname)
+            entry = _read_json(path) or {}
+            holders.append((os.path.getmtime(path), "memo", path, list((entry.get("outputs") or {}).values())))
+        return holders
+
+    def _blob_sizes(self) -> Dict[str, Tuple[int, float]]:
+        sizes: Dict[str, Tuple[int, float]] = {}
+        for sub in os.listdir(self.blobs_dir):
+            d = os.path.join(self.blobs_dir, sub)
+            if not os.path.isdir(d):
+                continue
+            for sha in os.listdir(d):
+                st = os.stat(os.path.join(d, sha))
+                sizes[sha] = (st.st_size, st.st_mtime)
+        return sizes
+
+    def usage(self) -> Dict[str, Any]:
+        sizes = self._blob_sizes()
+        return {
+            "root": self.root,
+            "blobs": len(sizes),
+            "bytes": sum(s for s, _ in sizes.values()),
+            "runs": len(os.listdir(self.runs_dir)),
+            "memo": len([f for f in os.listdir(self.memo_dir) if f.endswith(".json")]),
+            "max_bytes": self.max_bytes,
+            "max_age_days": round(self.max_age_s / 86400, 2),
+        }
+
+    def _drop_holder(self, kind: str, path: str) -> None:
+        if kind == "run":
+            shutil.rmtree(path if os.path.isdir(path) else os.path.dirname(path), ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def evict(self, *, max_bytes: Optional[int] = None, max_age_s: Optional[float] = None) -> Dict[str, int]:
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age_s = self.max_age_s if max_age_s is None else max_age_s
+        stats = {"runs": 0, "memo": 0, "blobs": 0, "bytes": 0}
+        with self._locked():
+            now = time.time()
+            holders = sorted(self._holders())
+            sizes = self._blob_sizes()
+            refs: Dict[str, int] = {}
+            for _, _, _, shas in holders:
+                for sha in set(shas):
+                    refs[sha] = refs.get(sha, 0) + 1
+            total = sum(s for s, _ in sizes.values())
+
+            def drop_blob(sha: str) -> None:
+                nonlocal total
+                path = self.blob_path(sha)
+                try:
+                    # Sessions deduplicate without the lock; re-check so a blob reused since the
+                    # scan survives until the run holding it is committed
+                    if time.time() - os.stat(path).st_mtime <= UNREFERENCED_GRACE_S:
+                        return
+                except OSError:
+                    return
+                size = sizes.pop(sha, (0, 0.0))[0]
+                try:
+                    os.chmod(path, 0o644)
+                    os.unlink(path)
+                except OSError:
+                    return
+                total -= size
+                stats["blobs"] += 1
+                stats["bytes"] += size
+
+            # Blobs nobody holds (e.g. uploads of failed runs) go first; every blob deletion waits out
+            # the grace period, including blobs whose last holder is evicted below
+            for sha in list(sizes):
+                if sha not in refs:
+                    drop_blob(sha)
+
+            # Oldest holders first: everything past max age, then until the store fits max_bytes
+            for used, kind, path, shas in holders:
+                if now - used <= max_age_s and total <= max_bytes:
+                    break
+                if kind == "run" and not shas and now - used <= UNREFERENCED_GRACE_S:
+                    continue
+                self._drop_holder(kind, path)
+                stats["runs" if kind == "run" else "memo"] += 1
+                for sha in set(shas):
+                    refs[sha] -= 1
+                    if refs[sha] == 0:
+                        drop_blob(sha)
+        return stats
+
+
+def ingest_dirs(store: ArtifactStore, dirs: List[str], *, move: bool = False) -> List[Dict[str, Any]]:
+    manifests = []
+    for d in dirs:
+        files = {}
+        for base, _, names in os.walk(d):
+            for n in names:
+                full = os.path.join(base, n)
+                files[os.path.relpath(full, d).replace(os.sep, "/")] = full
+        run_id = os.path.basename(os.path.normpath(d))
+        if os.path.exists(store.run_dir(run_id)):
+            run_id = f"{run_id}_{os.urandom(4).hex()}"
+        manifests.append(store.commit_run(run_id, files, {"source": os.path.abspath(d)}))
+        if move:
+            shutil.rmtree(d, ignore_errors=True)
+    return manifests
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Content-addressed artifact store for uploads and stage outputs.")
+    parser.add_argument("--root", help=f"Store directory (default: ${STORE_ENV} or Output/store)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_ingest = sub.add_parser("ingest", help="Store existing run directories (one run per directory)")
+    p_ingest.add_argument("dirs", nargs="+")
+    p_ingest.add_argument("--move", action="store_true", help="Delete each source directory once stored")
+    p_gc = sub.add_parser("gc", help="Evict by age and size")
+    p_gc.add_argument("--max-bytes", type=int, help=f"Size budget (default: ${MAX_BYTES_ENV} or 2 GiB)")
+    p_gc.add_argument("--max-age-days", type=float, help=f"Age budget (default: ${MAX_AGE_ENV} or 30)")
+    sub.add_parser("ls", help="List runs")
+    sub.add_parser("stats", help="Show store usage")
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.root)
+    if args.command == "ingest":
+        before = store.usage()["bytes"]
+        manifests = ingest_dirs(store, args.dirs, move=args.move)
+        added = store.usage()["bytes"] - before
+        logical = sum(e["size"] for m in manifests for e in m["files"].values())
+        print(f"[store] {len(manifests)} run(s), {logical} bytes of files, {added} new bytes stored")
+    elif args.command == "gc":
+        max_age = args.max_age_days * 86400 if args.max_age_days is not None else None
+        stats = store.evict(max_bytes=args.max_bytes, max_age_s=max_age)
+        print(f"[store] evicted {stats['runs']} run(s), {stats['memo']} cache entr(ies), {stats['blobs']} blob(s), {stats['bytes']} bytes")
+    elif args.command == "ls":
+        for m in store.runs():
+            size = sum(e["size"] for e in m["files"].values())
+            ts = datetime.fromtimestamp(m["created_at"]).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{m['run_id']}  {ts}  {len(m['files'])} files  {size} bytes")
+    else:
+        print(json.dumps(store.usage(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# Reverse index of a step3 groups file: column -> group, position, recode. Written next to
+# step3_groups.json so consumers look columns up instead of scanning every group.
+#
+# JSON layout (version 1), shared tables referenced by position to keep the file small:
+#
+#   {"version": 1,
+#    "groups":   [[id, name], ...],
+#    "recodes":  [[id, target, [source, ...]], ...],
+#    "columns":  {column: [group, position, recode, [source_of, ...]], ...}}
+#
+# group/position: index into "groups" and position in its "columns" array, -1 if ungrouped;
+# recode: index into "recodes" of the recode producing this column, -1 if none; source_of:
+# indices of recodes reading this column. The optional Parquet export has one row per column
+# with the references resolved.
+
+INDEX_VERSION = 1
+
+ROLE_MEMBER = "member"
+ROLE_RECODE = "recode"
+ROLE_SOURCE = "source"
+
+
+class ColumnEntry(NamedTuple):
+    column: str
+    group_id: Optional[str]
+    group_name: Optional[str]
+    position: Optional[int]
+    recode_id: Optional[str]
+    recode_sources: Tuple[str, ...]
+    source_of: Tuple[str, ...]
+
+    @property
+    def roles(self) -> Tuple[str, ...]:
+        roles = []
+        if self.group_id is not None:
+            roles.append(ROLE_MEMBER)
+        if self.recode_id is not None:
+            roles.append(ROLE_RECODE)
+        if self.source_of:
+            roles.append(ROLE_SOURCE)
+        return tuple(roles)
+
+
+def build_index(groups_out: Dict[str, Any]) -> Dict[str, Any]:
+    # groups_out: step3 output ({"groups": [...], "recodings": [...]})
+    groups = [g for g in groups_out.get("groups", []) if isinstance(g, dict)]
+    recodes = [r for r in groups_out.get("recodings", []) if isinstance(r, dict)]
+    columns: Dict[str, List[Any]] = {}
+
+    def row(column: str) -> List[Any]:
+        entry = columns.get(column)
+        if entry is None:
+            entry = columns[column] = [-1, -1, -1, []]
+        return entry
+
+    for gi, g in enumerate(groups):
+        for pos, col in enumerate(g.get("columns", [])):
+            entry = row(str(col))
+            if entry[0] < 0:
+                # A column listed in two groups keeps the first, like a scan would
+                entry[0], entry[1] = gi, pos
+    for ri, r in enumerate(recodes):
+        target = str(r.get("recode") or r.get("name") or "")
+        if target:
+            entry = row(target)
+            if entry[2] < 0:
+                entry[2] = ri
+        for src in r.get("codes", []) or []:
+            sources = row(str(src))[3]
+            if ri not in sources:
+                sources.append(ri)
+    return {
+        "version": INDEX_VERSION,
+        "groups": [[str(g.get("id", "")), g.get("name")] for g in groups],
+        "recodes": [
+            [str(r.get("id", "")), str(r.get("recode") or r.get("name") or ""), [str(s) for s in r.get("codes", []) or []]]
+            for r in recodes
+        ],
+        "columns": columns,
+    }
+
+
+def write_index(index: Dict[str, Any], path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def _arrow() -> Any:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        raise SystemExit(
+            "pyarrow is required for Parquet. Install dependencies with: pip install -r requirements.txt"
+        ) from exc
+    return pa, pq
+
+
+def write_index_parquet(index: Dict[str, Any], path: str) -> None:
+    pa, pq = _arrow()
+    entries = list(ColumnIndex(index))
+    table = pa.table({
+        "column": [e.column for e in entries],
+        "group_id": [e.group_id for e in entries],
+        "group_name": [e.group_name for e in entries],
+        "position": pa.array([e.position for e in entries], type=pa.int32()),
+        "recode_id": [e.recode_id for e in entries],
+        "recode_sources": pa.array([list(e.recode_sources) for e in entries], type=pa.list_(pa.string())),
+        "source_of": pa.array([list(e.source_of) for e in entries], type=pa.list_(pa.string())),
+    })
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    pq.write_table(table, path)
+
+
+def _index_from_parquet(path: str) -> Dict[str, Any]:
+    _, pq = _arrow()
+    rows = pq.read_table(path).to_pylist()
+    groups: Dict[str, int] = {}
+    recodes: Dict[str, int] = {}
+    index: Dict[str, Any] = {"version": INDEX_VERSION, "groups": [], "recodes": [], "columns": {}}
+    for r in rows:
+        gi = -1
+        if r["group_id"] is not None:
+            gi = groups.setdefault(r["group_id"], len(groups))
+            if gi == len(index["groups"]):
+                index["groups"].append([r["group_id"], r["group_name"]])
+        ri = -1
+        if r["recode_id"] is not None:
+            ri = recodes.setdefault(r["recode_id"], len(recodes))
+            if ri == len(index["recodes"]):
+                index["recodes"].append([r["recode_id"], r["column"], list(r["recode_sources"] or [])])
+        index["columns"][r["column"]] = [gi, -1 if r["position"] is None else r["position"], ri, list(r["source_of"] or [])]
+    # source_of holds recode ids here; map them to table positions like the JSON form
+    for entry in index["columns"].values():
+        entry[3] = [recodes[s] for s in entry[3] if s in recodes]
+    return index
+
+
+class ColumnIndex:
+    # O(1) lookups over a loaded index; entries are resolved on access, not up front
+    def __init__(self, index: Dict[str, Any]) -> None:
+        version = index.get("version")
+        if version != INDEX_VERSION:
+            raise ValueError(f"Unsupported column index version: {version!r}")
+        self._groups: List[List[Any]] = index["groups"]
+        self._recodes: List[List[Any]] = index["recodes"]
+        self._columns: Dict[str, List[Any]] = index["columns"]
+
+    @classmethod
+    def load(cls, path: str) -> "ColumnIndex":
+        if path.lower().endswith((".parquet", ".pq")):
+            return cls(_index_from_parquet(path))
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def from_groups(cls, groups_out: Dict[str, Any]) -> "ColumnIndex":
+        return cls(build_index(groups_out))
+
+    def __len__(self) -> int:
+        return len(self._columns)
+
+    def __contains__(self, column: object) -> bool:
+        return column in self._columns
+
+    def __iter__(self) -> Iterator[ColumnEntry]:
+        for column in self._columns:
+            yield self._entry(column, self._columns[column])
+
+    def _entry(self, column: str, row: List[Any]) -> ColumnEntry:
+        gi, pos, ri, source_of = row
+        group = self._groups[gi] if gi >= 0 else None
+        recode = self._recodes[ri] if ri >= 0 else None
+        return ColumnEntry(
+            column,
+            group[0] if group else None,
+            group[1] if group else None,
+            pos if group else None,
+            recode[0] if recode else None,
+            tuple(recode[2]) if recode else (),
+            tuple(self._recodes[i][0] for i in source_of),
+        )
+
+    def lookup(self, column: str) -> Optional[ColumnEntry]:
+        row = self._columns.get(column)
+        return None if row is None else self._entry(column, row)
+
+    def group_of(self, column: str) -> Optional[str]:
+        row = self._columns.get(column)
+        if row is None or row[0] < 0:
+            return None
+        return self._groups[row[0]][0]
+
+    def recode_sources(self, column: str) -> Tuple[str, ...]:
+        row = self._columns.get(column)
+        if row is None or row[2] < 0:
+            return ()
+        return tuple(self._recodes[row[2]][2])
+
+    def roles(self, column: str) -> Tuple[str, ...]:
+        entry = self.lookup(column)
+        return entry.roles if entry else ()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build or query the column -> group index of a step3 groups file.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="Build the index from step3_groups.json")
+    p_build.add_argument("--groups", required=True, help="Path to step3 groups JSON")
+    p_build.add_argument("--output", required=True, help="Path to write the index JSON")
+    p_build.add_argument("--parquet", help="Also write the index as a Parquet table")
+    p_query = sub.add_parser("query", help="Look columns up in an index (JSON or Parquet)")
+    p_query.add_argument("--index", required=True)
+    p_query.add_argument("columns", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with open(args.groups, "r", encoding="utf-8") as f:
+            index = build_index(json.load(f))
+        write_index(index, args.output)
+        print(f"[index] {len(index['columns'])} columns -> {args.output}", file=sys.stderr)
+        if args.parquet:
+            write_index_parquet(index, args.parquet)
+            print(f"[index] Parquet: {args.parquet}", file=sys.stderr)
+    else:
+        idx = ColumnIndex.load(args.index)
+        for column in args.columns:
+            entry = idx.lookup(column)
+            found = dict(entry._asdict(), roles=list(entry.roles)) if entry else {"column": column, "roles": []}
+            print(json.dumps(found, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+
+class Table(NamedTuple):
+    name: str
+    frame: pd.DataFrame
+    labels: Dict[str, str]
+    value_labels: Dict[str, Dict[str, str]]
+
+
+Reader = Callable[..., List[Table]]
+# Cell strings pandas' readers treat as missing by default (pandas._libs.parsers.STR_NA_VALUES);
+# readers that bypass pandas parsing apply the same list so every path agrees
+NA_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+READERS: Dict[str, Reader] = {}
+
+EXTENSIONS = {
+    ".sav": "sav",
+    ".zsav": "sav",
+    ".xlsx": "xlsx",
+    ".xlsm": "xlsx",
+    ".xls": "xlsx",
+    ".csv": "csv",
+    ".txt": "csv",
+    ".tsv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+}
+
+
+def register_reader(fmt: str) -> Callable[[Reader], Reader]:
+    def decorator(func: Reader) -> Reader:
+        READERS[fmt] = func
+        return func
+    return decorator
+
+
+def detect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in EXTENSIONS:
+        return EXTENSIONS[ext]
+    # Uploads sometimes lose their extension; sniff the magic bytes instead
+    with open(path, "rb") as f:
+        head = f.read(8)
+    if head.startswith(b"$FL2") or head.startswith(b"$FL3"):
+        return "sav"
+    if head.startswith(b"PAR1"):
+        return "parquet"
+    if head.startswith(b"PK\x03\x04") or head.startswith(b"\xd0\xcf\x11\xe0"):
+        return "xlsx"
+    return "csv"
+
+
+def _plain_table(name: str, df: pd.DataFrame) -> Table:
+    df.columns = [str(c) for c in df.columns]
+    return Table(name, df, {c: c for c in df.columns}, {})
+
+
+@register_reader("sav")
+def read_sav(path: str, *, columns: Optional[List[str]] = None, **_: Any) -> List[Table]:
+    try:
+        import pyreadstat
+    except ImportError as exc:
+        raise SystemExit(
+            "pyreadstat is required. Install dependencies with: pip install -r requirements.txt"
+        ) from exc
+    from step1_extract_spss_metadata import coerce_label_key_to_string
+
+    df, meta = pyreadstat.read_sav(path, usecols=columns)
+    names: List[str] = list(getattr(meta, "column_names", []) or [])
+    raw_labels: List[Any] = list(getattr(meta, "column_labels", []) or [])
+    labels: Dict[str, str] = {}
+    for i, name in enumerate(names):
+        label = raw_labels[i] if i < len(raw_labels) else None
+        labels[name] = label if label else name
+    value_labels: Dict[str, Dict[str, str]] = {}
+    for name, mapping in (getattr(meta, "variable_value_labels", {}) or {}).items():
+        value_labels[name] = {coerce_label_key_to_string(k): (v if v is not None else "") for k, v in mapping.items()}
+    return [Table(os.path.basename(path), df, labels, value_labels)]
+
+
+def xlsx_engine(path: str) -> Optional[str]:
+    # calamine (Rust) parses wide exports several times faster than openpyxl
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return None if path.lower().endswith(".xls") else "openpyxl"
+
+
+@register_reader("xlsx")
+def read_xlsx(path: str, *, sheet: Any = 0, columns: Optional[List[str]] = None, **_: Any) -> List[Table]:
+    # sheet may be an index, a name, a list of either, or "all"
+    if isinstance(sheet, str) and sheet.isdigit():
+        sheet = int(sheet)
+    sheet_name = None if sheet == "all" else sheet
+    usecols: Any = columns
+    if columns:
+        wanted = set(columns)
+        usecols = lambda c: str(c) in wanted  # noqa: E731
+    frames = pd.read_excel(path, sheet_name=sheet_name, usecols=usecols, engine=xlsx_engine(path))
+    if isinstance(frames, dict):
+        return [_plain_table(str(name), df) for name, df in frames.items()]
+    return [_plain_table(str(sheet), frames)]
+
+
+@register_reader("csv")
+def read_csv(path: str, *, columns: Optional[List[str]] = None, **_: Any) -> List[Table]:
+    name = os.path.basename(path)
+    delimiter = "\t" if path.lower().endswith(".tsv") else None
+    try:
+        import pyarrow.csv as pacsv
+    except ImportError:
+        return [_plain_table(name, pd.read_csv(path, usecols=columns, sep=delimiter or ","))]
+    parse = pacsv.ParseOptions(delimiter=delimiter) if delimiter else pacsv.ParseOptions()
+    convert = pacsv.ConvertOptions(strings_can_be_null=True, null_values=NA_VALUES)
+    if columns:
+        convert.include_columns = columns
+    table = pacsv.read_csv(path, parse_options=parse, convert_options=convert)
+    return [_plain_table(name, table.to_pandas())]
+
+
+@register_reader("parquet")
+def read_parquet(path: str, *, columns: Optional[List[str]] = None, **_: Any) -> List[Table]:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        raise SystemExit(
+            "pyarrow is required for Parquet. Install dependencies with: pip install -r requirements.txt"
+        ) from exc
+    table = pq.read_table(path, columns=columns)
+    return [_plain_table(os.path.basename(path), table.to_pandas())]
+
+
+def read_tables(
+    path: str,
+    *,
+    fmt: Optional[str] = None,
+    sheet: Any = 0,
+    columns: Optional[List[str]] = None,
+) -> List[Table]:
+    fmt = fmt or detect_format(path)
+    reader = READERS.get(fmt)
+    if reader is None:
+        raise SystemExit(f"Unsupported data file: {path}")
+    return reader(path, sheet=sheet, columns=columns)
+
+
+def read_response_matrix(
+    path: str,
+    *,
+    sheet: Any = 0,
+    columns: Optional[List[str]] = None,
+) -> Tuple[pd.DataFrame, Dict[str, str], Dict[str, Dict[str, str]]]:
+    # Returns (responses, variable labels, value labels) of the first selected table
+    tables = read_tables(path, sheet=sheet, columns=columns)
+    if not tables:
+        raise SystemExit(f"No tables found in: {path}")
+    first = tables[0]
+    return first.frame, first.labels, first.value_labels
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from data_readers import read_response_matrix  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+
+# popcount per byte, used to count set bits of packed non-null masks
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def column_signatures(
+    df: pd.DataFrame,
+    value_labels: Dict[str, Dict[str, str]],
+    *,
+    max_scale_card: int = 15,
+) -> Dict[str, Any]:
+    names = [str(c) for c in df.columns]
+    # One packed bitset row per column: bit r set when respondent r answered
+    masks = np.packbits(df.notna().to_numpy().T, axis=1)
+    bases = POPCOUNT[masks].sum(axis=1, dtype=np.int64)
+
+    kinds: List[str] = []
+    domain_keys: List[str] = []
+    domains: List[List[Any]] = []
+    for name in names:
+        series = df[name].dropna()
+        if series.empty:
+            kinds.append("empty")
+            domain_keys.append("")
+            domains.append([])
+            continue
+        values = pd.unique(series)
+        numeric = pd.api.types.is_numeric_dtype(series)
+        if numeric:
+            values = np.sort(values.astype(float))
+        if numeric and set(values.tolist()) <= {0.0, 1.0}:
+            kind = "flag" if values.tolist() == [1.0] else "binary"
+            key = kind
+        elif numeric and 3 <= len(values) <= max_scale_card and np.all(np.mod(values, 1) == 0):
+            kind = "scale"
+            labels = value_labels.get(name)
+            if labels:
+                # share one key across items using the same label set even if some codes are unused
+                key = "labels:" + hashlib.sha1(json.dumps(sorted(labels.items())).encode("utf-8")).hexdigest()[:12]
+            else:
+                key = f"range:{int(values[0])}-{int(values[-1])}"
+        else:
+            kinds.append("other")
+            domain_keys.append("")
+            domains.append([])
+            continue
+        kinds.append(kind)
+        domain_keys.append(key)
+        domains.append([int(v) for v in values.tolist()])
+    return {
+        "names": names,
+        "masks": masks,
+        "bases": bases,
+        "kinds": kinds,
+        "domain_keys": domain_keys,
+        "domains": domains,
+    }
+
+
+def code_stem(code: str) -> str:
+    # "Q5r12" -> "Q5", "A15_3" -> "A15"; used only to split runs that cross question boundaries
+    m = re.match(r"^(.*?)(?:_?[rRcC]?\d{1,3})$", code)
+    return m.group(1) if m and m.group(1) else code
+
+
+def mask_jaccard(masks: np.ndarray, i: int, j: int) -> float:
+    inter = int(POPCOUNT[masks[i] & masks[j]].sum())
+    union = int(POPCOUNT[masks[i] | masks[j]].sum())
+    return inter / union if union else 0.0
+
+
+def detect_data_groups(
+    df: pd.DataFrame,
+    value_labels: Optional[Dict[str, Dict[str, str]]] = None,
+    *,
+    min_columns: int = 2,
+    min_mask_jaccard: float = 0.95,
+    max_scale_card: int = 15,
+    split_on_names: bool = True,
+) -> List[Dict[str, Any]]:
+    sig = column_signatures(df, value_labels or {}, max_scale_card=max_scale_card)
+    names = sig["names"]
+    masks = sig["masks"]
+    kinds = sig["kinds"]
+    keys = sig["domain_keys"]
+
+    def same_stem(i: int, j: int) -> bool:
+        return not split_on_names or code_stem(names[i]) == code_stem(names[j])
+
+    def fits(head: int, j: int) -> Optional[float]:
+        # Mask overlap with the run's first column if j may join it (1.0 for 1/NaN flags), else None
+        if kinds[j] in ("empty", "other") or keys[j] != keys[head] or not same_stem(head, j):
+            return None
+        if kinds[j] == "flag":
+            return 1.0
+        jac = mask_jaccard(masks, head, j)
+        return jac if jac >= min_mask_jaccard else None
+
+    # Walk columns in questionnaire order and extend a run while the next column shares the
+    # run's domain signature and (except for 1/NaN flags) the same respondent base. A single
+    # column that only differs in base (a routed option) stays in when the next one continues.
+    runs: List[Dict[str, Any]] = []
+    current: Optional[Dict[str, Any]] = None
+    for j in range(len(names)):
+        if current is not None:
+            head = current["columns"][0]
+            jac = fits(head, j)
+            if jac is not None:
+                current["columns"].append(j)
+                if kinds[j] != "flag":
+                    current["jaccards"].append(jac)
+                continue
+            prev_gap = current["gaps"] and current["gaps"][-1] == current["columns"][-1]
+            if (
+                not prev_gap
+                and kinds[j] not in ("empty", "other")
+                and keys[j] == keys[head]
+                and same_stem(head, j)
+                and j + 1 < len(names)
+                and fits(head, j + 1) is not None
+            ):
+                current["columns"].append(j)
+                current["gaps"].append(j)
+                continue
+            runs.append(current)
+            current = None
+        if kinds[j] not in ("empty", "other"):
+            current = {"columns": [j], "jaccards": [], "gaps": []}
+    if current is not None:
+        runs.append(current)
+
+    # Join runs of one question cut apart by columns outside them (an open end, a longer routed
+    # stretch): same code stem, same domain and a compatible base. Runs in between that belong
+    # to the same question but do not fit stay groups of their own.
+    if split_on_names:
+        joined: List[Dict[str, Any]] = []
+        for run in runs:
+            first = run["columns"][0]
+            target = None
+            for prev in reversed(joined):
+                if not same_stem(prev["columns"][0], first):
+                    break
+                jac = fits(prev["columns"][0], first)
+                if jac is not None and kinds[first] == kinds[prev["columns"][0]]:
+                    target = (prev, jac)
+                    break
+            if target is None:
+                joined.append(run)
+                continue
+            prev, jac = target
+            prev["columns"] += run["columns"]
+            prev["gaps"] += run["gaps"]
+            if kinds[first] != "flag":
+                prev["jaccards"] += [jac] + run["jaccards"]
+        runs = joined
+
+    groups: List[Dict[str, Any]] = []
+    for r in runs:
+        run = r["columns"]
+        if len(run) < min_columns:
+            continue
+        kind = kinds[run[0]]
+        union = np.bitwise_or.reduce(masks[run], axis=0)
+        evidence: Dict[str, Any] = {
+            "domain": sig["domains"][run[0]] if kind != "scale" else sorted({v for i in run for v in sig["domains"][i]}),
+            "domain_key": keys[run[0]],
+            "base": int(POPCOUNT[union].sum()),
+        }
+        if kind != "flag":
+            evidence["min_mask_jaccard"] = round(min(r["jaccards"]) if r["jaccards"] else 1.0, 4)
+        if r["gaps"]:
+            evidence["routed"] = [names[i] for i in r["gaps"]]
+        groups.append({
+            "id": f"data_group_{len(groups)}",
+            "type": "grid" if kind == "scale" else "multi-select",
+            "columns": [names[i] for i in run],
+            "evidence": evidence,
+        })
+    return groups
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Detect candidate multi-select and grid groups from response data (value domains and shared bases), without any LLM call."
+    )
+    parser.add_argument("--input", required=True, help="Path to the .sav or .xlsx data file")
+    parser.add_argument("--output", help="Optional output JSON path. If omitted, prints to stdout.")
+    parser.add_argument("--sheet", default=0, help="Sheet index or name for .xlsx (default: 0)")
+    parser.add_argument("--min-columns", type=int, default=2)
+    parser.add_argument("--min-mask-jaccard", type=float, default=0.95, help="Minimum overlap of answered respondents within a group")
+    parser.add_argument("--max-scale-card", type=int, default=15, help="Largest number of scale points treated as a grid scale")
+    parser.add_argument("--ignore-names", action="store_true", help="Do not split runs where the column code stem changes (pure data signals)")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiled("data-groups", args.profile):
+        t0 = time.time()
+        df, _, value_labels = read_response_matrix(args.input, sheet=args.sheet)
+        print(f"[data-groups] Loaded {df.shape[0]} rows x {df.shape[1]} columns in {time.time() - t0:.1f}s", file=sys.stderr)
+        t1 = time.time()
+        groups = detect_data_groups(
+            df,
+            value_labels,
+            min_columns=args.min_columns,
+            min_mask_jaccard=args.min_mask_jaccard,
+            max_scale_card=args.max_scale_card,
+            split_on_names=not args.ignore_names,
+        )
+        print(f"[data-groups] {len(groups)} candidate groups in {time.time() - t1:.1f}s", file=sys.stderr)
+
+        payload = json.dumps({"groups": groups}, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(payload)
+            print(f"[data-groups] Written: {args.output}", file=sys.stderr)
+        else:
+            print(payload)
+
+
+if __name__ == "__main__":
+    main()
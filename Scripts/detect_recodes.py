@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from data_readers import read_response_matrix  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+
+# step1 turns numeric columns with more distinct values than this into min/max ranges; such
+# columns (weights, scores, amounts) are measurements, not codes a recode could start from
+RANGE_THRESHOLD = 25
+WEIGHT_TOKENS = {"weight", "weights", "weighting", "wgt", "wt", "wght"}
+
+
+def tokenize(text: str) -> Set[str]:
+    # Split codes like "hAgeGroup2" / "AGE_BAND" into lowercase word tokens
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    return {t for t in re.split(r"[^0-9a-zA-Z]+", text.lower()) if t and not t.isdigit()}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def continuous_columns(df: pd.DataFrame, cards: np.ndarray, tokens: List[Set[str]]) -> np.ndarray:
+    # Numeric columns with many distinct or fractional values, and anything named like a weight
+    out = np.zeros(df.shape[1], dtype=bool)
+    for j in range(df.shape[1]):
+        if tokens[j] & WEIGHT_TOKENS:
+            out[j] = True
+            continue
+        col = df.iloc[:, j]
+        if not pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype):
+            continue
+        if cards[j] > RANGE_THRESHOLD:
+            out[j] = True
+        else:
+            values = col.dropna().to_numpy(dtype=float)
+            out[j] = bool(values.size) and not np.all(np.mod(values, 1.0) == 0.0)
+    return out
+
+
+def factorize_columns(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    # Integer-code every column once (NaN -> -1) so all later checks are pure NumPy
+    codes = np.empty((len(df), df.shape[1]), dtype=np.int32)
+    cards = np.empty(df.shape[1], dtype=np.int64)
+    for j in range(df.shape[1]):
+        col_codes, uniques = pd.factorize(df.iloc[:, j], use_na_sentinel=True)
+        codes[:, j] = col_codes
+        cards[j] = len(uniques)
+    return codes, cards
+
+
+def detect_recodes(
+    df: pd.DataFrame,
+    labels: Dict[str, str],
+    value_labels: Dict[str, Dict[str, str]],
+    *,
+    max_target_card: int = 12,
+    max_source_ratio: float = 0.5,
+    min_support: float = 3.0,
+    min_rows: int = 30,
+    min_similarity: float = 0.0,
+) -> List[Dict[str, Any]]:
+    names = [str(c) for c in df.columns]
+    n_rows = len(df)
+    if n_rows == 0 or not names:
+        return []
+    codes, cards = factorize_columns(df)
+    non_null = codes >= 0
+    non_null_counts = non_null.sum(axis=0)
+
+    tokens = [tokenize(n) | tokenize(labels.get(n, n)) for n in names]
+    continuous = continuous_columns(df, cards, tokens)
+    label_keys = [frozenset(value_labels.get(n, {}).items()) for n in names]
+
+    # Cardinality pruning: targets are low-cardinality, sources are coarser-than-ID columns
+    # with enough rows per distinct value for the dependency to be meaningful.
+    target_idx = np.flatnonzero((cards >= 2) & (cards <= max_target_card))
+    source_ok = (
+        ~continuous
+        & (cards >= 3)
+        & (cards <= max_source_ratio * n_rows)
+        & (non_null_counts >= min_support * np.maximum(cards, 1))
+    )
+    source_idx = np.flatnonzero(source_ok)
+
+    found: Dict[int, List[Dict[str, Any]]] = {}
+    for a in source_idx:
+        cand = target_idx[cards[target_idx] < cards[a]]
+        cand = cand[cand != a]
+        if cand.size == 0:
+            continue
+        # Target must be empty wherever the source is empty (derived values need an input)
+        a_mask = non_null[:, a]
+        cand = cand[~(non_null[:, cand] & ~a_mask[:, None]).any(axis=0)]
+        if cand.size == 0:
+            continue
+        # Label-set similarity pruning: identical value-label sets mean sibling items on a
+        # shared scale (grid rows, multi-select flags), not a derivation.
+        if label_keys[a]:
+            cand = np.array([b for b in cand if label_keys[b] != label_keys[a]], dtype=np.int64)
+        if min_similarity > 0.0:
+            cand = np.array([b for b in cand if jaccard(tokens[a], tokens[b]) >= min_similarity], dtype=np.int64)
+        if cand.size == 0:
+            continue
+
+        # Group-wise nunique in NumPy: sort rows by A once, then B is a function of A
+        # iff B never changes between neighbouring rows of the same A-group.
+        rows = np.flatnonzero(a_mask)
+        order = rows[np.argsort(codes[rows, a], kind="stable")]
+        a_sorted = codes[order, a]
+        same_group = a_sorted[1:] == a_sorted[:-1]
+        b_sorted = codes[np.ix_(order, cand)]
+        changes = (b_sorted[1:] != b_sorted[:-1]) & same_group[:, None]
+        determined = cand[~changes.any(axis=0)]
+        for b in determined:
+            # Support: rows backing the mapping (the target's, all inside the source's) per source value
+            support = float(non_null_counts[b]) / float(cards[a])
+            if non_null_counts[b] < min_rows or support < min_support:
+                continue
+            found.setdefault(int(b), []).append({
+                "source": names[a],
+                "source_cardinality": int(cards[a]),
+                "support": round(support, 2),
+                "similarity": round(jaccard(tokens[a], tokens[b]), 3),
+                "distance": abs(int(a) - int(b)),
+            })
+
+    results: List[Dict[str, Any]] = []
+    for b, cands in sorted(found.items()):
+        # Prefer sources that share words with the target, then the finest source, then the nearest column
+        cands.sort(key=lambda c: (-c["similarity"], -c["source_cardinality"], c["distance"]))
+        best = cands[0]
+        results.append({
+            "target": names[b],
+            "sources": [best["source"]],
+            "target_cardinality": int(cards[b]),
+            "source_cardinality": best["source_cardinality"],
+            "support": best["support"],
+            "similarity": best["similarity"],
+            "alternatives": [c["source"] for c in cands[1:10]],
+        })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Detect candidate recodes (B fully determined by A) from the response data of a .sav or .xlsx file."
+    )
+    parser.add_argument("--input", required=True, help="Path to the .sav or .xlsx data file")
+    parser.add_argument("--output", help="Optional output JSON path. If omitted, prints to stdout.")
+    parser.add_argument("--sheet", default=0, help="Sheet index or name for .xlsx (default: 0)")
+    parser.add_argument("--max-target-card", type=int, default=12, help="Largest distinct count for a recode target (default: 12)")
+    parser.add_argument("--max-source-ratio", type=float, default=0.5, help="Skip sources whose distinct count exceeds this share of rows (ID-like)")
+    parser.add_argument("--min-support", type=float, default=3.0, help="Minimum average rows per distinct source value, for the source and for each candidate")
+    parser.add_argument("--min-rows", type=int, default=30, help="Minimum rows with a target value before a candidate is reported (default: 30)")
+    parser.add_argument("--min-similarity", type=float, default=0.0, help="Minimum name/label token Jaccard between source and target")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiled("recodes", args.profile):
+        t0 = time.time()
+        df, labels, value_labels = read_response_matrix(args.input, sheet=args.sheet)
+        print(f"[recodes] Loaded {df.shape[0]} rows x {df.shape[1]} columns in {time.time() - t0:.1f}s", file=sys.stderr)
+        t1 = time.time()
+        results = detect_recodes(
+            df,
+            labels,
+            value_labels,
+            max_target_card=args.max_target_card,
+            max_source_ratio=args.max_source_ratio,
+            min_support=args.min_support,
+            min_rows=args.min_rows,
+            min_similarity=args.min_similarity,
+        )
+        print(f"[recodes] {len(results)} candidate recodes in {time.time() - t1:.1f}s", file=sys.stderr)
+
+        payload = json.dumps(results, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(payload)
+            print(f"[recodes] Written: {args.output}", file=sys.stderr)
+        else:
+            print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, FrozenSet, List, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from step2_planner import manual_plan  # noqa: E402
+
+# Scores step2/step3 configurations against earlier runs used as reference groupings.
+#
+#   score: compare one step3_groups.json with a reference run
+#   run:   for every study x configuration, group the study again (through a client that
+#          records each Gemini response, or replays it with --offline), emit step3 and score it
+#
+# Metrics are group-level: a group counts as correct only when its column set equals a
+# reference group (precision, recall, F1); jaccard is the mean over reference groups of the
+# best column-set Jaccard against any produced group, so near misses still show.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESPONSES = os.path.join(ROOT, "Output", "eval", "responses")
+DEFAULT_STUDIES: List[Dict[str, str]] = [
+    {"name": "bill_run", "reference": "Output/bill_run", "pdf": "Output/bill_run/questionnaire.pdf"},
+    {"name": "jewelry_two_step", "reference": "Output/jewelry_two_step", "pdf": "Data/ifop-fine-jewelery/ifop-fine-jewelery.pdf"},
+    {"name": "ui_20250828_120747", "reference": "Output/ui_runs/20250828_120747", "pdf": "Data/ifop-fine-jewelery/ifop-fine-jewelery.pdf"},
+]
+DEFAULT_CONFIGS: List[Dict[str, Any]] = [
+    {"name": "flash-256", "model": "gemini-2.5-flash", "thinking_budget": 256},
+    {"name": "flash-4096", "model": "gemini-2.5-flash", "thinking_budget": 4096},
+    {"name": "pro-1024", "model": "gemini-2.5-pro", "thinking_budget": 1024},
+    {"name": "pro-8192", "model": "gemini-2.5-pro", "thinking_budget": 8192},
+    {"name": "auto", "auto": True},
+]
+USAGE_FIELDS = ("prompt_token_count", "cached_content_token_count", "candidates_token_count", "thoughts_token_count", "total_token_count")
+
+
+def load_groups(path: str) -> List[FrozenSet[str]]:
+    # step3_groups.json, or a run directory holding one
+    if os.path.isdir(path):
+        path = os.path.join(path, "step3_groups.json")
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    groups = data.get("groups", []) if isinstance(data, dict) else []
+    return [frozenset(str(c) for c in g.get("columns", [])) for g in groups if isinstance(g, dict) and g.get("columns")]
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def score_groups(reference: List[FrozenSet[str]], candidate: List[FrozenSet[str]]) -> Dict[str, Any]:
+    ref_set = set(reference)
+    cand_set = set(candidate)
+    precision = sum(1 for g in candidate if g in ref_set) / len(candidate) if candidate else 0.0
+    recall = sum(1 for g in reference if g in cand_set) / len(reference) if reference else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    # Index candidates by column so each reference group only meets groups it overlaps
+    by_column: Dict[str, List[int]] = {}
+    for i, g in enumerate(candidate):
+        for c in g:
+            by_column.setdefault(c, []).append(i)
+    best: List[float] = []
+    for g in reference:
+        near = {i for c in g for i in by_column.get(c, ())}
+        best.append(max((jaccard(g, candidate[i]) for i in near), default=0.0))
+    return {
+        "reference_groups": len(reference),
+        "groups": len(candidate),
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(f1, 4),
+        "jaccard": round(sum(best) / len(best), 4) if best else 1.0,
+    }
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def usage_dict(usage: Any) -> Dict[str, int]:
+    if usage is None:
+        return {}
+    if isinstance(usage, dict):
+        return {k: int(usage.get(k) or 0) for k in USAGE_FIELDS}
+    return {k: int(getattr(usage, k, 0) or 0) for k in USAGE_FIELDS}
+
+
+class ResponseLog:
+    # <dir>/<sha256>.json: one recorded Gemini response (text, usage, latency) per request
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        tmp = self._path(key) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self._path(key))
+
+
+class RecordingClient:
+    # Stands in for genai.Client inside run_grouping. Requests are keyed by model, generation
+    # settings, the text parts and the PDF's hash (not its upload URI), so a recording made
+    # online replays offline. Every call's usage and latency is kept for the report.
+    def __init__(self, log: ResponseLog, pdf_sha: str, client: Any = None, *, refresh: bool = False) -> None:
+        self.log = log
+        self.pdf_sha = pdf_sha
+        self.client = client
+        self.refresh = refresh
+        self.calls: List[Dict[str, Any]] = []
+        self.upload_s = 0.0
+        self._upload_started = 0.0
+        self.files = SimpleNamespace(upload=self._upload, get=self._get)
+        self.models = SimpleNamespace(generate_content=self._generate)
+
+    def _upload(self, *, file: Any, config: Any = None) -> Any:
+        key = "upload-" + self.pdf_sha
+        recorded = self.log.get(key)
+        if self.client is None:
+            self.upload_s += float((recorded or {}).get("elapsed_s", 0.0))
+            return SimpleNamespace(name="files/replay", uri=f"replay://{self.pdf_sha}", state="ACTIVE")
+        self._upload_started = time.time()
+        return self.client.files.upload(file=file, config=config)
+
+    def _get(self, *, name: str) -> Any:
+        if self.client is None:
+            return SimpleNamespace(name=name, uri=f"replay://{self.pdf_sha}", state="ACTIVE")
+        refreshed = self.client.files.get(name=name)
+        if str(getattr(refreshed, "state", "")).endswith("ACTIVE"):
+            elapsed = time.time() - self._upload_started
+            self.upload_s += elapsed
+            self.log.put("upload-" + self.pdf_sha, {"elapsed_s": round(elapsed, 3)})
+        return refreshed
+
+    def request_key(self, model: str, contents: Any, config: Any) -> str:
+        texts = [p.text for c in contents for p in (c.parts or []) if getattr(p, "text", None) is not None]
+        thinking = getattr(config, "thinking_config", None)
+        payload = {
+            "model": model,
+            "temperature": getattr(config, "temperature", None),
+            "thinking_budget": getattr(thinking, "thinking_budget", None),
+            "texts": texts,
+            "pdf": self.pdf_sha,
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _generate(self, *, model: str, contents: Any, config: Any = None) -> Any:
+        key = self.request_key(model, contents, config)
+        entry = None if self.refresh and self.client is not None else self.log.get(key)
+        replayed = entry is not None
+        if entry is None:
+            if self.client is None:
+                raise RuntimeError(f"no recorded response for this {model} request (key {key[:12]}); run once online")
+            t0 = time.time()
+            resp = self.client.models.generate_content(model=model, contents=contents, config=config)
+            entry = {
+                "model": model,
+                "text": getattr(resp, "text", "") or "",
+                "usage": usage_dict(getattr(resp, "usage_metadata", None)),
+                "elapsed_s": round(time.time() - t0, 3),
+            }
+            self.log.put(key, entry)
+        self.calls.append({"model": model, "replayed": replayed, "elapsed_s": entry["elapsed_s"], "usage": entry["usage"]})
+        return SimpleNamespace(text=entry["text"], usage_metadata=SimpleNamespace(**entry["usage"]))
+
+    def totals(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {k: sum(c["usage"].get(k, 0) for c in self.calls) for k in USAGE_FIELDS}
+        out["calls"] = len(self.calls)
+        out["replayed"] = sum(1 for c in self.calls if c["replayed"])
+        # Calls in run_grouping are sequential, so their latencies add up
+        out["api_s"] = round(self.upload_s + sum(c["elapsed_s"] for c in self.calls), 2)
+        return out
+
+
+def config_plan(config: Dict[str, Any], n_items: int) -> Dict[str, Any]:
+    model = str(config.get("model", "gemini-2.5-pro"))
+    plan = manual_plan(model, model == "gemini-2.5-flash", n_items)
+    for key in ("thinking_budget", "temperature", "retry_model", "retry_thinking_budget"):
+        if key in config:
+            plan[key] = config[key]
+    return plan
+
+
+def run_config(
+    study: Dict[str, str],
+    config: Dict[str, Any],
+    *,
+    log: ResponseLog,
+    client: Any,
+    workdir: str,
+    refresh: bool = False,
+) -> Dict[str, Any]:
+    from step2_group_with_pdf_gemini import run_grouping
+    from step3_emit_groups import emit_groups_file
+
+    reference = os.path.join(ROOT, study["reference"])
+    pdf = os.path.join(ROOT, study["pdf"])
+    metadata = os.path.join(reference, "step1_metadata.json")
+    outdir = os.path.join(workdir, f"{study['name']}__{config['name']}")
+    os.makedirs(outdir, exist_ok=True)
+    grouped = os.path.join(outdir, "step2_grouped_questions.json")
+    groups = os.path.join(outdir, "step3_groups.json")
+    # Context caching stays off: replayed requests must carry the full prompt to match their key
+    options: Dict[str, Any] = {"auto": bool(config.get("auto")), "context_cache_mode": "off"}
+    if config.get("auto"):
+        for key in ("max_latency", "max_cost"):
+            if key in config:
+                options[key] = config[key]
+    else:
+        with open(metadata, "r", encoding="utf-8") as f:
+            n_items = len(json.load(f))
+        plan_path = os.path.join(outdir, "config.plan.json")
+        with open(plan_path, "w", encoding="utf-8") as f:
+            json.dump(config_plan(config, n_items), f, ensure_ascii=False, indent=2)
+        options["plan_path"] = plan_path
+
+    recorder = RecordingClient(log, sha256_file(pdf), client, refresh=refresh)
+    logs = io.StringIO()
+    t0 = time.time()
+    error = ""
+    try:
+        with contextlib.redirect_stdout(logs):
+            run_grouping(pdf, metadata, grouped, client=recorder, **options)
+            emit_groups_file(grouped, groups)
+    except SystemExit as exc:
+        error = f"step2 exited with {exc.code}"
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    wall = time.time() - t0
+    row: Dict[str, Any] = {"study": study["name"], "config": config["name"], "ok": not error, "error": error}
+    row.update(recorder.totals())
+    row["wall_s"] = round(wall, 2)
+    if not error:
+        row.update(score_groups(load_groups(reference), load_groups(groups)))
+    else:
+        row["log"] = logs.getvalue()[-2000:]
+    return row
+
+
+def summarize(rows: List[Dict[str, Any]], configs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    summary: List[Dict[str, Any]] = []
+    for config in configs:
+        mine = [r for r in rows if r["config"] == config["name"]]
+        ok = [r for r in mine if r["ok"]]
+        n = max(1, len(ok))
+        summary.append({
+            "config": config["name"],
+            "studies": len(mine),
+            "failed": len(mine) - len(ok),
+            "precision": round(sum(r["precision"] for r in ok) / n, 4),
+            "recall": round(sum(r["recall"] for r in ok) / n, 4),
+            "f1": round(sum(r["f1"] for r in ok) / n, 4),
+            "jaccard": round(sum(r["jaccard"] for r in ok) / n, 4),
+            "api_s": round(sum(r["api_s"] for r in mine), 2),
+            "total_tokens": sum(r["total_token_count"] for r in mine),
+            "thoughts_tokens": sum(r["thoughts_token_count"] for r in mine),
+        })
+    return summary
+
+
+def pick_fastest(summary: List[Dict[str, Any]], *, min_f1: float, min_jaccard: float) -> Optional[Dict[str, Any]]:
+    good = [s for s in summary if not s["failed"] and s["f1"] >= min_f1 and s["jaccard"] >= min_jaccard]
+    return min(good, key=lambda s: (s["api_s"], s["total_tokens"])) if good else None
+
+
+def load_list(path: Optional[str], default: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if not path:
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise SystemExit(f"{path} must contain a JSON list")
+    return data
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Score grouping configurations against reference runs (accuracy vs latency and tokens).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_score = sub.add_parser("score", help="Score one step3_groups.json against a reference run")
+    p_score.add_argument("--reference", required=True, help="Reference run directory or step3_groups.json")
+    p_score.add_argument("--candidate", required=True, help="Run directory or step3_groups.json to score")
+    p_run = sub.add_parser("run", help="Group every study with every configuration and score the results")
+    p_run.add_argument("--studies", help="JSON list of {name, reference, pdf} (paths relative to the repo root); default: the tracked Output runs")
+    p_run.add_argument("--configs", help="JSON list of {name, model, thinking_budget[, temperature]} or {name, auto[, max_latency, max_cost]}")
+    p_run.add_argument("--only", nargs="+", help="Run only these configuration names")
+    p_run.add_argument("--responses", default=DEFAULT_RESPONSES, help="Directory of recorded responses (default: Output/eval/responses)")
+    p_run.add_argument("--offline", action="store_true", help="Replay recorded responses only; never call Gemini")
+    p_run.add_argument("--refresh", action="store_true", help="Call Gemini even when a recording exists, and overwrite it")
+    p_run.add_argument("--api-key", dest="api_key")
+    p_run.add_argument("--min-f1", type=float, default=0.9, help="Quality bar: mean exact-group F1 (default: 0.9)")
+    p_run.add_argument("--min-jaccard", type=float, default=0.0, help="Quality bar: mean best-match Jaccard (default: 0)")
+    p_run.add_argument("--keep", help="Keep each configuration's outputs under this directory")
+    p_run.add_argument("--output", help="Write the full report as JSON")
+    args = parser.parse_args()
+
+    if args.command == "score":
+        print(json.dumps(score_groups(load_groups(args.reference), load_groups(args.candidate)), indent=2))
+        return
+
+    studies = load_list(args.studies, DEFAULT_STUDIES)
+    configs = load_list(args.configs, DEFAULT_CONFIGS)
+    if args.only:
+        configs = [c for c in configs if c["name"] in set(args.only)]
+    client = None
+    if not args.offline:
+        from step2_group_with_pdf_gemini import make_client
+
+        api_key = args.api_key or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise SystemExit("Set --api-key or GOOGLE_API_KEY, or use --offline to replay recorded responses.")
+        client = make_client(api_key)
+    log = ResponseLog(args.responses)
+    workdir = args.keep or tempfile.mkdtemp(prefix="eval_")
+    rows: List[Dict[str, Any]] = []
+    try:
+        for study in studies:
+            for config in configs:
+                row = run_config(study, config, log=log, client=client, workdir=workdir, refresh=args.refresh)
+                rows.append(row)
+                if row["ok"]:
+                    print(
+                        f"[eval] {row['study']:<22} {row['config']:<12} f1={row['f1']:.3f} jaccard={row['jaccard']:.3f} "
+                        f"api={row['api_s']:.1f}s tokens={row['total_token_count']} ({row['replayed']}/{row['calls']} replayed)",
+                        flush=True,
+                    )
+                else:
+                    print(f"[eval] {row['study']:<22} {row['config']:<12} FAILED: {row['error']}", flush=True)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(rows, configs)
+    print(f"\n{'config':<14}{'f1':>7}{'jacc':>7}{'prec':>7}{'rec':>7}{'api_s':>9}{'tokens':>10}{'failed':>8}")
+    for s in summary:
+        print(
+            f"{s['config']:<14}{s['f1']:>7.3f}{s['jaccard']:>7.3f}{s['precision']:>7.3f}{s['recall']:>7.3f}"
+            f"{s['api_s']:>9.1f}{s['total_tokens']:>10}{s['failed']:>8}"
+        )
+    best = pick_fastest(summary, min_f1=args.min_f1, min_jaccard=args.min_jaccard)
+    if best:
+        print(f"[eval] Fastest configuration meeting f1>={args.min_f1} jaccard>={args.min_jaccard}: {best['config']}")
+    else:
+        print(f"[eval] No configuration meets f1>={args.min_f1} jaccard>={args.min_jaccard}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"rows": rows, "summary": summary, "fastest": best and best["config"]}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from step2_planner import compute_base  # noqa: E402
+
+# Local stand-in for the subset of the Gemini REST API used by step2 (file upload/get/delete,
+# cachedContents create/get/delete, generateContent). Point the SDK at it with
+# GEMINI_BASE_URL=http://127.0.0.1:<port>/
+
+# Token accounting is approximate: 4 characters per token, a file part counts as ~10 PDF pages
+FILE_PART_TOKENS = 2580
+
+
+def stub_grouping(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Deterministic prefix grouping so step3 has real groups to emit
+    by_base: Dict[str, List[Dict[str, Any]]] = {}
+    for it in items:
+        code = str(it.get("question_code", ""))
+        if code:
+            by_base.setdefault(compute_base(code), []).append(it)
+    out: List[Dict[str, Any]] = []
+    for base, members in by_base.items():
+        grouped = len(members) >= 2 and all(m.get("pa_type") != "range" for m in members)
+        if grouped:
+            out.append({
+                "question_code": f"{base}_GROUP",
+                "question_text": base,
+                "question_type": "multi-select",
+                "sub_questions": [{"question_code": m["question_code"], "possible_answers": {}} for m in members],
+            })
+        else:
+            for m in members:
+                out.append({
+                    "question_code": m["question_code"],
+                    "question_text": m.get("question_text"),
+                    "question_type": "integer" if m.get("pa_type") == "range" else "single-select",
+                    "possible_answers": {},
+                })
+    return out
+
+
+def count_tokens(contents: List[Dict[str, Any]]) -> int:
+    tokens = 0
+    for c in contents:
+        for p in c.get("parts", []):
+            tokens += len(p.get("text", "")) // 4 if "text" in p else FILE_PART_TOKENS if "fileData" in p else 0
+    return tokens
+
+
+def parse_ttl(ttl: Any) -> float:
+    try:
+        return float(str(ttl).rstrip("s"))
+    except ValueError:
+        return 3600.0
+
+
+class StubState:
+    def __init__(
+        self,
+        *,
+        latency: float = 0.0,
+        activate_after: float = 0.0,
+        fail_rate: float = 0.0,
+        cache_min_tokens: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.activate_after = activate_after
+        self.fail_rate = fail_rate
+        self.cache_min_tokens = cache_min_tokens
+        self.lock = threading.Lock()
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.caches: Dict[str, Dict[str, Any]] = {}
+        self.uploads: Dict[str, Dict[str, Any]] = {}
+        self.counter = 0
+        self.calls: Dict[str, int] = {}
+
+    def next_id(self) -> str:
+        with self.lock:
+            self.counter += 1
+            return f"{self.counter:06d}"
+
+    def count(self, kind: str) -> int:
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            return self.calls[kind]
+
+
+def make_handler(state: StubState) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _body(self) -> bytes:
+            length = int(self.headers.get("Content-Length", "0") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _base(self) -> str:
+            return f"http://{self.headers.get('Host', '127.0.0.1')}"
+
+        def _file_view(self, name: str) -> Dict[str, Any]:
+            f = dict(state.files[name])
+            ready = time.time() - f.pop("_created") >= state.activate_after
+            f["state"] = "ACTIVE" if ready else "PROCESSING"
+            return f
+
+        def do_POST(self) -> None:
+            path = self.path.split("?")[0]
+            body = self._body()
+            if path.endswith("/upload/v1beta/files") and "upload_id=" not in self.path:
+                meta = json.loads(body or b"{}").get("file", {})
+                upload_id = state.next_id()
+                state.uploads[upload_id] = {"meta": meta, "size": 0}
+                url = f"{self._base()}/upload/v1beta/files?upload_id={upload_id}"
+                self._send(200, {}, {"x-goog-upload-url": url, "x-goog-upload-status": "active"})
+                return
+            if path.endswith("/upload/v1beta/files"):
+                upload_id = self.path.split("upload_id=")[1].split("&")[0]
+                upload = state.uploads.get(upload_id)
+                if upload is None:
+                    self._send(404, {"error": {"code": 404, "message": "unknown upload"}})
+                    return
+                upload["size"] += len(body)
+                if "finalize" not in (self.headers.get("X-Goog-Upload-Command") or ""):
+                    self._send(200, {}, {"x-goog-upload-status": "active"})
+                    return
+                name = f"files/stub{upload_id}"
+                with state.lock:
+                    state.files[name] = {
+                        "name": name,
+                        "uri": f"{self._base()}/v1beta/{name}",
+                        "mimeType": upload["meta"].get("mimeType", "application/pdf"),
+                        "sizeBytes": str(upload["size"]),
+                        "_created": time.time(),
+                    }
+                    state.uploads.pop(upload_id, None)
+                state.count("upload")
+                self._send(200, {"file": self._file_view(name)}, {"x-goog-upload-status": "final"})
+                return
+            if path.endswith("/v1beta/cachedContents"):
+                self._create_cache(json.loads(body or b"{}"))
+                return
+            m = re.search(r"/v1beta/models/([^/:]+):generateContent$", path)
+            if m:
+                self._generate(m.group(1), json.loads(body or b"{}"))
+                return
+            self._send(404, {"error": {"code": 404, "message": f"not found: {path}"}})
+
+        def _cache_view(self, name: str) -> Optional[Dict[str, Any]]:
+            with state.lock:
+                entry = state.caches.get(name)
+                if entry is not None and entry["_expires"] <= time.time():
+                    state.caches.pop(name, None)
+                    entry = None
+            if entry is None:
+                return None
+            return {k: v for k, v in entry.items() if not k.startswith("_")}
+
+        def _create_cache(self, request: Dict[str, Any]) -> None:
+            contents = request.get("contents", [])
+            tokens = count_tokens(contents)
+            if tokens < state.cache_min_tokens:
+                self._send(400, {"error": {
+                    "code": 400,
+                    "message": f"Cached content is too small. total_token_count={tokens}, min_total_token_count={state.cache_min_tokens}",
+                    "status": "INVALID_ARGUMENT",
+                }})
+                return
+            state.count("cache")
+            name = f"cachedContents/stub{state.next_id()}"
+            expires = time.time() + parse_ttl(request.get("ttl", "3600s"))
+            with state.lock:
+                state.caches[name] = {
+                    "name": name,
+                    "model": request.get("model", ""),
+                    "displayName": request.get("displayName", ""),
+                    "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(expires)),
+                    "usageMetadata": {"totalTokenCount": tokens},
+                    "_contents": contents,
+                    "_expires": expires,
+                }
+            self._send(200, self._cache_view(name))
+
+        def _generate(self, model: str, request: Dict[str, Any]) -> None:
+            n = state.count("generate")
+            if state.latency:
+                time.sleep(state.latency)
+            # Deterministic failures: exactly fail_rate of calls, evenly spread
+            if state.fail_rate and int(n * state.fail_rate) != int((n - 1) * state.fail_rate):
+                self._send(503, {"error": {"code": 503, "message": "stub overloaded", "status": "UNAVAILABLE"}})
+                return
+            contents = request.get("contents", [])
+            cached_tokens = 0
+            if request.get("cachedContent"):
+                with state.lock:
+                    entry = state.caches.get(request["cachedContent"])
+                if entry is None or entry["_expires"] <= time.time():
+                    self._send(404, {"error": {"code": 404, "message": "cached content not found", "status": "NOT_FOUND"}})
+                    return
+                cached_tokens = entry["usageMetadata"]["totalTokenCount"]
+                contents = entry["_contents"] + contents
+            texts = [p.get("text", "") for c in contents for p in c.get("parts", []) if "text" in p]
+            items: List[Dict[str, Any]] = []
+            for t in texts:
+                if t.startswith("SPSS_METADATA_COMPACT_JSON:"):
+                    items = json.loads(t.split("\n", 1)[1] or "[]")
+            out_text = json.dumps(stub_grouping(items))
+            # Like the real API, promptTokenCount includes the cached prefix
+            prompt_tokens = count_tokens(contents)
+            usage = {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": len(out_text) // 4,
+                "totalTokenCount": prompt_tokens + len(out_text) // 4,
+            }
+            if cached_tokens:
+                usage["cachedContentTokenCount"] = cached_tokens
+            self._send(200, {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": out_text}]},
+                    "finishReason": "STOP",
+                    "index": 0,
+                }],
+                "usageMetadata": usage,
+                "modelVersion": model,
+            })
+
+        def do_GET(self) -> None:
+            m = re.search(r"/v1beta/(files/[^/?]+)$", self.path.split("?")[0])
+            if m and m.group(1) in state.files:
+                self._send(200, self._file_view(m.group(1)))
+                return
+            m = re.search(r"/v1beta/(cachedContents/[^/?]+)$", self.path.split("?")[0])
+            view = self._cache_view(m.group(1)) if m else None
+            if view is not None:
+                self._send(200, view)
+                return
+            self._send(404, {"error": {"code": 404, "message": "not found"}})
+
+        def do_DELETE(self) -> None:
+            m = re.search(r"/v1beta/((?:files|cachedContents)/[^/?]+)$", self.path.split("?")[0])
+            if m:
+                with state.lock:
+                    state.files.pop(m.group(1), None)
+                    state.caches.pop(m.group(1), None)
+            self._send(200, {})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+def start_stub(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    *,
+    latency: float = 0.0,
+    activate_after: float = 0.0,
+    fail_rate: float = 0.0,
+    cache_min_tokens: int = 0,
+) -> Tuple[ThreadingHTTPServer, StubState, str]:
+    # Runs in a daemon thread; returns (server, state, base_url)
+    state = StubState(latency=latency, activate_after=activate_after, fail_rate=fail_rate, cache_min_tokens=cache_min_tokens)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://{host}:{server.server_address[1]}/"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local Gemini API stub for tests and load runs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to sleep in generateContent")
+    parser.add_argument("--activate-after", type=float, default=0.0, help="Seconds before an uploaded file reports ACTIVE")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of generateContent calls answered with 503")
+    parser.add_argument("--cache-min-tokens", type=int, default=0, help="Reject cachedContents smaller than this many tokens (400)")
+    args = parser.parse_args()
+
+    server, _, url = start_stub(
+        args.host,
+        args.port,
+        latency=args.latency,
+        activate_after=args.activate_after,
+        fail_rate=args.fail_rate,
+        cache_min_tokens=args.cache_min_tokens,
+    )
+    print(f"[stub] Gemini stub on {url} (export GEMINI_BASE_URL={url})", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
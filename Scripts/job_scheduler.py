@@ -0,0 +1,147 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# Admission control for pipeline_worker.py. Every job names a priority and a user; the scheduler
+# decides when it may start.
+#
+#   resources    each step draws on one pool with its own concurrency limit: step1/step3 parse
+#                files (cpu), upload/step2 wait on Gemini (net)
+#   priorities   interactive jobs (Streamlit) always start before queued batch jobs, and batch
+#                work may not take the last `reserve` slots of a pool, so a click never waits
+#                behind a backfill that fills the pool
+#   fair share   within a priority, the next slot goes to the user with the fewest running jobs,
+#                then the least recent service time (decayed), FIFO per user
+#   preemption   queued batch jobs can be cancelled (`pipeline_worker.py cancel`); they finish with
+#                PREEMPTED_RC without running. Running jobs are never interrupted.
+
+PRIORITIES = ("interactive", "batch")
+STEP_RESOURCES = {"step1": "cpu", "step3": "cpu", "upload": "net", "step2": "net"}
+DEFAULT_LIMITS = {"cpu": max(1, (os.cpu_count() or 2) // 2), "net": 8}
+DEFAULT_RESERVE = 1
+# Service time counts half after this many seconds, so yesterday's backfill is not held against a user
+USAGE_HALF_LIFE_S = 300.0
+PREEMPTED_RC = 75
+
+
+class Preempted(Exception):
+    pass
+
+
+class _Ticket:
+    __slots__ = ("seq", "step", "resource", "priority", "user", "queued_at", "started_at", "event", "cancelled")
+
+    def __init__(self, seq: int, step: str, resource: str, priority: str, user: str) -> None:
+        self.seq = seq
+        self.step = step
+        self.resource = resource
+        self.priority = priority
+        self.user = user
+        self.queued_at = time.time()
+        self.started_at = 0.0
+        self.event = threading.Event()
+        self.cancelled = False
+
+
+class JobScheduler:
+    def __init__(self, limits: Optional[Dict[str, int]] = None, *, reserve: int = DEFAULT_RESERVE) -> None:
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._queued: List[_Ticket] = []
+        self._running: List[_Ticket] = []
+        self._usage: Dict[str, float] = {}
+        self._usage_at = time.time()
+        self.stats = {"started": 0, "preempted": 0, "wait_s": 0.0}
+
+    def _decay(self, now: float) -> None:
+        factor = 0.5 ** ((now - self._usage_at) / USAGE_HALF_LIFE_S)
+        self._usage_at = now
+        for user in list(self._usage):
+            self._usage[user] *= factor
+            if self._usage[user] < 1e-3:
+                del self._usage[user]
+
+    def _batch_cap(self, resource: str) -> int:
+        return max(1, self.limits[resource] - self.reserve)
+
+    def _dispatch(self) -> None:
+        # Called with the lock held after every submit and release
+        now = time.time()
+        self._decay(now)
+        for resource, limit in self.limits.items():
+            while True:
+                running = [t for t in self._running if t.resource == resource]
+                if len(running) >= limit:
+                    break
+                waiting = [t for t in self._queued if t.resource == resource]
+                if not waiting:
+                    break
+                level = min(PRIORITIES.index(t.priority) for t in waiting)
+                if PRIORITIES[level] == "batch" and sum(1 for t in running if t.priority == "batch") >= self._batch_cap(resource):
+                    break
+                per_user: Dict[str, int] = {}
+                for t in running:
+                    per_user[t.user] = per_user.get(t.user, 0) + 1
+                nxt = min(
+                    (t for t in waiting if PRIORITIES.index(t.priority) == level),
+                    key=lambda t: (per_user.get(t.user, 0), self._usage.get(t.user, 0.0), t.seq),
+                )
+                self._queued.remove(nxt)
+                nxt.started_at = now
+                self._running.append(nxt)
+                self.stats["started"] += 1
+                self.stats["wait_s"] += now - nxt.queued_at
+                nxt.event.set()
+
+    @contextmanager
+    def slot(self, step: str, *, priority: str = "interactive", user: str = "") -> Iterator[float]:
+        # Blocks until the job may run; yields the seconds spent queued. Raises Preempted if the
+        # job was cancelled while waiting.
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority!r} (expected one of {', '.join(PRIORITIES)})")
+        resource = STEP_RESOURCES.get(step, "cpu")
+        ticket = _Ticket(next(self._seq), step, resource, priority, user or "anonymous")
+        with self._lock:
+            self._queued.append(ticket)
+            self._dispatch()
+        ticket.event.wait()
+        if ticket.cancelled:
+            raise Preempted(f"{step} job of {ticket.user} cancelled while queued")
+        try:
+            yield ticket.started_at - ticket.queued_at
+        finally:
+            with self._lock:
+                self._running.remove(ticket)
+                self._usage[ticket.user] = self._usage.get(ticket.user, 0.0) + (time.time() - ticket.started_at)
+                self._dispatch()
+
+    def cancel_queued(self, *, user: Optional[str] = None, priority: str = "batch") -> int:
+        with self._lock:
+            victims = [t for t in self._queued if t.priority == priority and (user is None or t.user == user)]
+            for t in victims:
+                self._queued.remove(t)
+                t.cancelled = True
+                t.event.set()
+            self.stats["preempted"] += len(victims)
+            self._dispatch()
+        return len(victims)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            def describe(t: _Ticket, since: float) -> Dict[str, Any]:
+                return {"step": t.step, "priority": t.priority, "user": t.user, "for_s": round(now - since, 1)}
+
+            return {
+                "limits": dict(self.limits),
+                "reserve": self.reserve,
+                "running": [describe(t, t.started_at) for t in self._running],
+                "queued": [describe(t, t.queued_at) for t in sorted(self._queued, key=lambda t: (PRIORITIES.index(t.priority), t.seq))],
+                "usage_s": {u: round(v, 1) for u, v in self._usage.items()},
+                "stats": dict(self.stats, wait_s=round(self.stats["wait_s"], 1)),
+            }
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from gemini_stub import start_stub  # noqa: E402
+
+# Runs N simultaneous app sessions against a local Gemini stub and reports latency,
+# failures and resource peaks per concurrency level. Each session executes the same
+# function the Streamlit "Run Grouping" button calls (ui_pipeline.run_ui_pipeline).
+
+
+def _proc_tree_linux(root_pid: int) -> List[int]:
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    out, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        out.append(pid)
+        stack.extend(children.get(pid, []))
+    return out
+
+
+def _rss_linux(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def tree_usage(root_pid: int) -> Tuple[int, int]:
+    # (total RSS bytes, process count) for root_pid and all of its descendants
+    try:
+        import psutil
+
+        root = psutil.Process(root_pid)
+        procs = [root] + root.children(recursive=True)
+        rss = 0
+        for p in procs:
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss, len(procs)
+    except ImportError:
+        pids = _proc_tree_linux(root_pid)
+        return sum(_rss_linux(p) for p in pids), len(pids)
+
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, interval: float = 0.1) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_procs = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        pid = os.getpid()
+        while not self._stop_event.is_set():
+            rss, procs = tree_usage(pid)
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_procs = max(self.peak_procs, procs)
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def run_level(
+    concurrency: int,
+    rounds: int,
+    data_path: str,
+    doc_path: str,
+    *,
+    api_key: str,
+    use_flash: bool,
+    use_auto: bool,
+    keep_outputs: bool,
+) -> Dict[str, Any]:
+    with open(data_path, "rb") as f:
+        data_bytes = f.read()
+    with open(doc_path, "rb") as f:
+        doc_bytes = f.read()
+
+    from artifact_store import ArtifactStore
+    from ui_pipeline import run_ui_pipeline
+
+    # Every session must do the full work, so memoized stage outputs are never reused; unless
+    # outputs are kept, runs land in a throwaway store instead of Output/store
+    store = ArtifactStore() if keep_outputs else ArtifactStore(tempfile.mkdtemp(prefix="loadtest_store_"))
+
+    def session(i: int) -> Dict[str, Any]:
+        t0 = time.time()
+        try:
+            res = run_ui_pipeline(
+                os.path.basename(data_path),
+                data_bytes,
+                os.path.basename(doc_path),
+                doc_bytes,
+                api_key=api_key,
+                use_flash=use_flash,
+                use_auto=use_auto,
+                reuse=False,
+                store=store,
+                # Each simulated analyst gets their own fair share on the worker
+                user=f"loadtest-{i}",
+            )
+        except Exception as exc:
+            res = {"ok": False, "failed_step": "exception", "error": str(exc), "outdir": ""}
+        res["latency"] = time.time() - t0
+        return res
+
+    sampler = ResourceSampler()
+    sampler.start()
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(session, range(concurrency * rounds)))
+    wall = time.time() - t0
+    sampler.stop()
+    if not keep_outputs:
+        shutil.rmtree(store.root, ignore_errors=True)
+
+    latencies = [r["latency"] for r in results]
+    failures: Dict[str, int] = {}
+    for r in results:
+        if not r.get("ok"):
+            step = str(r.get("failed_step"))
+            failures[step] = failures.get(step, 0) + 1
+    outdirs = [r.get("outdir") for r in results if r.get("outdir")]
+    return {
+        "concurrency": concurrency,
+        "sessions": len(results),
+        "wall_s": round(wall, 2),
+        "p50_s": round(percentile(latencies, 50), 2),
+        "p95_s": round(percentile(latencies, 95), 2),
+        "mean_s": round(statistics.mean(latencies), 2) if latencies else 0.0,
+        "failure_rate": round(sum(failures.values()) / max(1, len(results)), 3),
+        "failures": failures,
+        "outdir_collisions": len(outdirs) - len(set(outdirs)),
+        "peak_rss_mb": round(sampler.peak_rss / (1 << 20), 1),
+        "peak_procs": sampler.peak_procs,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the Streamlit pipeline.")
+    parser.add_argument("--data", required=True, help="Data file each session uploads (.sav/.xlsx/.csv/.parquet)")
+    parser.add_argument("--pdf", required=True, help="Questionnaire each session uploads (PDF or DOCX)")
+    parser.add_argument("--levels", default="1,2,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument("--rounds", type=int, default=1, help="Sessions per slot at each level")
+    parser.add_argument("--auto", action="store_true", help="Run sessions with the auto planner toggle")
+    parser.add_argument("--pro", action="store_true", help="Run sessions with the Flash toggle off")
+    parser.add_argument("--use-worker", action="store_true", help="Route jobs to the pipeline worker if one is running")
+    parser.add_argument("--real-api", action="store_true", help="Call the real Gemini API instead of the local stub")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="Seconds the stub spends per generateContent")
+    parser.add_argument("--stub-activate-after", type=float, default=0.0, help="Seconds before stub uploads are ACTIVE")
+    parser.add_argument("--stub-fail-rate", type=float, default=0.0, help="Share of stub generateContent calls that fail")
+    parser.add_argument("--keep-outputs", action="store_true", help="Commit each session's run to the artifact store (Output/store)")
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    levels = [int(x) for x in args.levels.split(",") if x.strip()]
+    api_key: Optional[str] = os.environ.get("GOOGLE_API_KEY", "")
+    server = None
+    if not args.real_api:
+        server, _, base_url = start_stub(
+            latency=args.stub_latency,
+            activate_after=args.stub_activate_after,
+            fail_rate=args.stub_fail_rate,
+        )
+        # Subprocess steps inherit these, so step2 talks to the stub
+        os.environ["GEMINI_BASE_URL"] = base_url
+        api_key = "stub-key"
+        os.environ["GOOGLE_API_KEY"] = api_key
+        print(f"[load] Gemini stub on {base_url}", file=sys.stderr)
+    if not args.use_worker:
+        os.environ["PIPELINE_WORKER_DISABLE"] = "1"
+    if not api_key:
+        raise SystemExit("Set GOOGLE_API_KEY to use --real-api")
+
+    report: List[Dict[str, Any]] = []
+    for level in levels:
+        print(f"[load] {level} concurrent session(s) x {args.rounds} round(s)…", file=sys.stderr)
+        row = run_level(
+            level,
+            args.rounds,
+            args.data,
+            args.pdf,
+            api_key=api_key,
+            use_flash=not args.pro,
+            use_auto=args.auto,
+            keep_outputs=args.keep_outputs,
+        )
+        report.append(row)
+        print(
+            f"[load] c={row['concurrency']:<3} n={row['sessions']:<4} p50={row['p50_s']:.2f}s "
+            f"p95={row['p95_s']:.2f}s fail={row['failure_rate']:.1%} "
+            f"rss={row['peak_rss_mb']:.0f}MB procs={row['peak_procs']} wall={row['wall_s']:.1f}s"
+            + (f" failures={row['failures']}" if row["failures"] else "")
+            + (f" outdir_collisions={row['outdir_collisions']}" if row["outdir_collisions"] else ""),
+            file=sys.stderr,
+        )
+
+    if server is not None:
+        server.shutdown()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"levels": report}, f, ensure_ascii=False, indent=2)
+    print(json.dumps({"levels": report}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
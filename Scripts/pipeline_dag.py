@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+def stage(
+    name: str,
+    run: Callable[[], int],
+    *,
+    deps: Sequence[str] = (),
+    inputs: Sequence[str] = (),
+    outputs: Sequence[str] = (),
+    params: Optional[Dict[str, Any]] = None,
+    optional: bool = False,
+    fresh: Optional[Callable[[], bool]] = None,
+) -> Dict[str, Any]:
+    # inputs/outputs are file paths; params are extra values that change the result (flags, models)
+    return {
+        "name": name,
+        "run": run,
+        "deps": list(deps),
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "params": params or {},
+        "optional": optional,
+        "fresh": fresh,
+    }
+
+
+class FileHasher:
+    # Content hashes cached by (size, mtime) so unchanged multi-GB inputs are not re-read
+    def __init__(self, cache: Dict[str, Any]) -> None:
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def digest(self, path: str) -> str:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return "missing"
+        key = os.path.abspath(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit and hit.get("stamp") == stamp:
+                return hit["sha256"]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self.lock:
+            self.cache[key] = {"stamp": stamp, "sha256": digest}
+        return digest
+
+
+def fingerprint(st: Dict[str, Any], hasher: FileHasher) -> str:
+    payload = {
+        "stage": st["name"],
+        "params": st["params"],
+        "inputs": {os.path.abspath(p): hasher.digest(p) for p in st["inputs"]},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def load_state(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            state.setdefault("stages", {})
+            state.setdefault("files", {})
+            return state
+    except Exception:
+        pass
+    return {"stages": {}, "files": {}}
+
+
+def save_state(path: str, state: Dict[str, Any]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def check_graph(stages: List[Dict[str, Any]]) -> None:
+    # run_dag would wait forever on a dep that never finishes; reject such graphs up front
+    by_name: Dict[str, Dict[str, Any]] = {}
+    for st in stages:
+        if st["name"] in by_name:
+            raise ValueError(f"Duplicate stage name: {st['name']!r}")
+        by_name[st["name"]] = st
+    for st in stages:
+        unknown = [d for d in st["deps"] if d not in by_name]
+        if unknown:
+            raise ValueError(f"Stage {st['name']!r} depends on unknown stage(s): {', '.join(map(repr, unknown))}")
+    done: Dict[str, bool] = {}
+
+    def visit(name: str, path: List[str]) -> None:
+        if done.get(name):
+            return
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ValueError(f"Stage dependency cycle: {' -> '.join(cycle)}")
+        for d in by_name[name]["deps"]:
+            visit(d, path + [name])
+        done[name] = True
+
+    for st in stages:
+        visit(st["name"], [])
+
+
+def run_dag(
+    stages: List[Dict[str, Any]],
+    state_path: str,
+    *,
+    force: bool = False,
+    max_workers: int = 4,
+    log: Callable[[str], None] = print,
+) -> Dict[str, Dict[str, Any]]:
+    check_graph(stages)
+    by_name = {s["name"]: s for s in stages}
+    state = load_state(state_path)
+    hasher = FileHasher(state["files"])
+    lock = threading.Lock()
+    results: Dict[str, Dict[str, Any]] = {}
+    t_origin = time.time()
+    emit = log
+
+    def log(msg: str) -> None:
+        # Stage threads log concurrently and print() writes the text and newline separately
+        with lock:
+            emit(msg)
+
+    def up_to_date(st: Dict[str, Any], fp: str) -> bool:
+        prev = state["stages"].get(st["name"])
+        if force or not prev or prev.get("fingerprint") != fp:
+            return False
+        if not all(os.path.exists(p) for p in st["outputs"]):
+            return False
+        return st["fresh"]() if st["fresh"] else True
+
+    def execute(st: Dict[str, Any]) -> Dict[str, Any]:
+        start = time.time() - t_origin
+        fp = fingerprint(st, hasher)
+        if up_to_date(st, fp):
+            log(f"[skip] {st['name']}: up to date")
+            return {"status": "skipped", "rc": 0, "start": start, "end": start, "duration": 0.0}
+        log(f"[step] {st['name']}…")
+        t0 = time.time()
+        try:
+            rc = int(st["run"]())
+        except Exception as exc:
+            log(f"[error] {st['name']}: {exc}")
+            rc = 1
+        duration = time.time() - t0
+        if rc == 0:
+            with lock:
+                # Record the fingerprint of the inputs that were actually consumed
+                state["stages"][st["name"]] = {"fingerprint": fp, "finished_at": time.time(), "duration": duration}
+                save_state(state_path, state)
+        log(f"[time] {st['name']}: {duration:.1f}s" + ("" if rc == 0 else f" (exit {rc})"))
+        return {
+            "status": "ran" if rc == 0 else "failed",
+            "rc": rc,
+            "start": start,
+            "end": start + duration,
+            "duration": duration,
+        }
+
+    pending = dict(by_name)
+    running: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, st in list(pending.items()):
+                dep_results = [results.get(d) for d in st["deps"]]
+                if any(r is None for r in dep_results):
+                    continue
+                del pending[name]
+                if any(r["status"] in ("failed", "blocked") and not by_name[d]["optional"] for d, r in zip(st["deps"], dep_results)):
+                    log(f"[skip] {name}: blocked by failed dependency")
+                    now = time.time() - t_origin
+                    results[name] = {"status": "blocked", "rc": 1, "start": now, "end": now, "duration": 0.0}
+                    continue
+                running[pool.submit(execute, st)] = name
+            if not running:
+                continue
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in done:
+                results[running.pop(fut)] = fut.result()
+    return results
+
+
+def critical_path(stages: List[Dict[str, Any]], results: Dict[str, Dict[str, Any]]) -> Tuple[List[str], float]:
+    # Longest chain of (actual) stage durations through the dependency graph
+    by_name = {s["name"]: s for s in stages}
+    best: Dict[str, Tuple[float, List[str]]] = {}
+
+    def visit(name: str) -> Tuple[float, List[str]]:
+        if name not in best:
+            chains = [visit(d) for d in by_name[name]["deps"]]
+            prev = max(chains, key=lambda c: c[0]) if chains else (0.0, [])
+            best[name] = (prev[0] + results.get(name, {}).get("duration", 0.0), prev[1] + [name])
+        return best[name]
+
+    total, path = max((visit(n) for n in by_name), key=lambda c: c[0], default=(0.0, []))
+    return path, total
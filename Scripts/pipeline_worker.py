@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+import argparse
+import http.client
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Tuple
+
+SCRIPTS_DIR = os.path.abspath(os.path.dirname(__file__))
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+
+from job_scheduler import PREEMPTED_RC, PRIORITIES, JobScheduler, Preempted  # noqa: E402
+from profiling import profiled  # noqa: E402
+from worker_client import DEFAULT_HOST, DEFAULT_PORT, cancel_queued, queue_status, worker_url  # noqa: E402
+
+
+class _ThreadLocalStdout(io.TextIOBase):
+    # Routes writes from job threads into their own buffer; everything else
+    # (server logs, main thread) still goes to the real stream.
+    def __init__(self, fallback: Any) -> None:
+        self._fallback = fallback
+        self._local = threading.local()
+
+    def capture(self, buf: "io.StringIO | None") -> None:
+        self._local.buf = buf
+
+    def write(self, s: str) -> int:
+        buf = getattr(self._local, "buf", None)
+        if buf is not None:
+            return buf.write(s)
+        return self._fallback.write(s)
+
+    def flush(self) -> None:
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            self._fallback.flush()
+
+
+class Worker:
+    def __init__(self, scheduler: "JobScheduler | None" = None) -> None:
+        self.scheduler = scheduler or JobScheduler()
+        self._clients: Dict[str, Any] = {}
+        self._clients_lock = threading.Lock()
+        self.started_at = time.time()
+        self.jobs_done = 0
+        self._stdout = _ThreadLocalStdout(sys.stdout)
+        self._stderr = _ThreadLocalStdout(sys.stderr)
+        sys.stdout = self._stdout
+        sys.stderr = self._stderr
+        self._warm_imports()
+
+    def _warm_imports(self) -> None:
+        t0 = time.time()
+        import align_text  # noqa: F401
+        import data_readers  # noqa: F401
+        import step1_extract_metadata  # noqa: F401
+        import step1_extract_spss_metadata  # noqa: F401
+        import step1_extract_xlsx_metadata  # noqa: F401
+        import step2_group_with_pdf_gemini  # noqa: F401
+        import step3_emit_groups  # noqa: F401
+        try:
+            import fitz  # noqa: F401
+        except Exception:
+            pass
+        print(f"[worker] Modules imported in {time.time() - t0:.1f}s", flush=True)
+
+    def gemini_client(self, api_key: str) -> Any:
+        # genai.Client keeps its own HTTP connection pool; reuse one per key
+        from step2_group_with_pdf_gemini import make_client
+
+        with self._clients_lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = make_client(api_key)
+                self._clients[api_key] = client
+            return client
+
+    def _step1(self, params: Dict[str, Any]) -> None:
+        import step1_extract_metadata as mod
+
+        mod.extract_metadata(
+            params["input"],
+            params.get("output"),
+            fmt=params.get("format"),
+            sheet=params.get("sheet", 0),
+            columns=params.get("columns"),
+            include_empty=bool(params.get("include_empty", False)),
+            sample=params.get("sample"),
+            exact_ranges=bool(params.get("exact_ranges", False)),
+        )
+
+    def _step2(self, params: Dict[str, Any]) -> None:
+        import step2_group_with_pdf_gemini as mod
+
+        api_key = params.get("api_key") or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+        mod.run_grouping(
+            params["pdf"],
+            params["metadata"],
+            params["output"],
+            client=self.gemini_client(api_key),
+            model=params.get("model", "gemini-2.5-pro"),
+            flash=bool(params.get("flash", False)),
+            fallback=bool(params.get("fallback", False)),
+            auto=bool(params.get("auto", False)),
+            max_latency=params.get("max_latency"),
+            max_cost=params.get("max_cost"),
+            plan_path=params.get("plan"),
+            uploaded_path=params.get("uploaded"),
+            alignment_path=params.get("alignment"),
+            template_index_path=params.get("template_index"),
+            context_cache_mode=params.get("context_cache", "auto"),
+            cache_ttl=float(params.get("cache_ttl", 600.0)),
+        )
+
+    def _upload(self, params: Dict[str, Any]) -> None:
+        import step2_group_with_pdf_gemini as mod
+
+        api_key = params.get("api_key") or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+        mod.run_upload(params["pdf"], params["output"], client=self.gemini_client(api_key))
+
+    def _step3(self, params: Dict[str, Any]) -> None:
+        import step3_emit_groups as mod
+
+        mod.emit_groups_file(
+            params["input"],
+            params["output"],
+            min_columns=int(params.get("min_columns", 2)),
+            recodes_path=params.get("recodes"),
+            recode_mode=params.get("recode_mode", "verify"),
+            index_output=params.get("index_output"),
+            index_parquet=params.get("index_parquet"),
+            previous_path=params.get("previous"),
+            delta_output=params.get("delta_output"),
+        )
+
+    def handlers(self) -> Dict[str, Callable[[Dict[str, Any]], None]]:
+        return {"step1": self._step1, "upload": self._upload, "step2": self._step2, "step3": self._step3}
+
+    def run_job(self, step: str, params: Dict[str, Any]) -> Tuple[int, str, float]:
+        handler = self.handlers().get(step)
+        if handler is None:
+            return 2, f"[worker] Unknown step: {step}\n", 0.0
+        buf = io.StringIO()
+        self._stdout.capture(buf)
+        self._stderr.capture(buf)
+        start = time.time()
+        rc = 0
+        try:
+            # params["profile"]: directory to write this job's profile into (see profiling.py)
+            with profiled(step, params.get("profile")):
+                handler(params)
+        except SystemExit as exc:
+            code = exc.code
+            if code is None:
+                rc = 0
+            elif isinstance(code, int):
+                rc = code
+            else:
+                buf.write(f"{code}\n")
+                rc = 1
+        except Exception:
+            buf.write(traceback.format_exc())
+            rc = 1
+        finally:
+            self._stdout.capture(None)
+            self._stderr.capture(None)
+        self.jobs_done += 1
+        return rc, buf.getvalue(), time.time() - start
+
+    def schedule_job(self, step: str, params: Dict[str, Any], *, priority: str, user: str) -> Tuple[int, str, float, float]:
+        # Waits for a slot (see job_scheduler.py), then runs; returns (rc, logs, elapsed, queued_s)
+        try:
+            with self.scheduler.slot(step, priority=priority, user=user) as queued:
+                rc, logs, elapsed = self.run_job(step, params)
+        except Preempted as exc:
+            return PREEMPTED_RC, f"[scheduler] {exc}\n", 0.0, 0.0
+        return rc, logs, elapsed, queued
+
+
+def make_handler(worker: Worker) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self._send_json(200, {
+                    "status": "ok",
+                    "pid": os.getpid(),
+                    "uptime": time.time() - worker.started_at,
+                    "jobs_done": worker.jobs_done,
+                })
+            elif self.path == "/queue":
+                self._send_json(200, worker.scheduler.snapshot())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if self.path not in ("/jobs", "/jobs/cancel"):
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", "0"))
+                job = json.loads(self.rfile.read(length) or b"{}")
+                step = str(job.get("step", ""))
+                params = job.get("params") or {}
+                if not isinstance(params, dict):
+                    raise ValueError("params must be an object")
+                priority = str(job.get("priority") or "interactive")
+                if priority not in PRIORITIES:
+                    raise ValueError(f"priority must be one of {', '.join(PRIORITIES)}")
+                user = str(job.get("user") or "")
+            except Exception as exc:
+                self._send_json(400, {"error": f"bad request: {exc}"})
+                return
+            if self.path == "/jobs/cancel":
+                # Drops queued (not running) jobs of this priority, optionally only one user's
+                cancelled = worker.scheduler.cancel_queued(user=user or None, priority=priority)
+                self._send_json(200, {"cancelled": cancelled})
+                return
+            rc, logs, elapsed, queued = worker.schedule_job(step, params, priority=priority, user=user)
+            self._send_json(200, {"rc": rc, "logs": logs, "elapsed": elapsed, "queued": queued})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            print(f"[worker] {self.address_string()} {format % args}", flush=True)
+
+    return Handler
+
+
+def print_queue() -> None:
+    snap = queue_status()
+    if snap is None:
+        raise SystemExit(f"No pipeline worker reachable at {worker_url()}")
+    limits = ", ".join(f"{k}={v}" for k, v in snap.get("limits", {}).items())
+    print(f"[worker] {worker_url()}  slots: {limits}  reserve: {snap.get('reserve')}")
+    for label in ("running", "queued"):
+        jobs = snap.get(label, [])
+        print(f"{label}: {len(jobs)}")
+        for job in jobs:
+            print(f"  {job['step']:<7} {job['priority']:<12} {job['user'] or '-':<16} {job['for_s']:.1f}s")
+    usage = snap.get("usage_s") or {}
+    if usage:
+        print("usage: " + ", ".join(f"{u or '-'}={v:.1f}s" for u, v in sorted(usage.items(), key=lambda kv: -kv[1])))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Long-lived pipeline worker: keeps modules imported and Gemini clients pooled, serves step1/2/3 jobs over localhost HTTP."
+    )
+    parser.add_argument("--host", help=f"Address to serve on / worker to query (default: {DEFAULT_HOST}, or PIPELINE_WORKER_URL)")
+    parser.add_argument("--port", type=int, help=f"Port to serve on / worker to query (default: {DEFAULT_PORT}, or PIPELINE_WORKER_URL)")
+    parser.add_argument("--cpu-slots", type=int, help="Concurrent step1/step3 jobs (default: half the CPUs)")
+    parser.add_argument("--net-slots", type=int, help="Concurrent upload/step2 jobs (default: 8)")
+    parser.add_argument("--reserve", type=int, default=1, help="Slots per pool batch jobs may not take, kept for interactive work (default: 1)")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("serve", help="Run the worker (default)")
+    sub.add_parser("queue", help="Show running and queued jobs of a running worker")
+    p_cancel = sub.add_parser("cancel", help="Preempt queued (not yet running) jobs of a running worker")
+    p_cancel.add_argument("--user", help="Only this user's jobs (default: every user)")
+    p_cancel.add_argument("--priority", choices=PRIORITIES, default="batch", help="Priority to cancel (default: batch)")
+    args = parser.parse_args()
+
+    if args.command in ("queue", "cancel"):
+        if args.host or args.port:
+            os.environ["PIPELINE_WORKER_URL"] = f"http://{args.host or DEFAULT_HOST}:{args.port or DEFAULT_PORT}"
+        if args.command == "queue":
+            print_queue()
+            return
+        try:
+            cancelled = cancel_queued(user=args.user, priority=args.priority)
+        except (OSError, http.client.HTTPException, ValueError) as exc:
+            raise SystemExit(f"Cancel failed: {exc}")
+        if cancelled is None:
+            raise SystemExit(f"No pipeline worker reachable at {worker_url()}")
+        who = f" of {args.user}" if args.user else ""
+        print(f"[worker] Cancelled {cancelled} queued {args.priority} job(s){who}")
+        return
+
+    host = args.host or DEFAULT_HOST
+    port = args.port or DEFAULT_PORT
+    limits = {k: v for k, v in (("cpu", args.cpu_slots), ("net", args.net_slots)) if v}
+    worker = Worker(JobScheduler(limits, reserve=args.reserve))
+    server = ThreadingHTTPServer((host, port), make_handler(worker))
+    server.daemon_threads = True
+    print(f"[worker] Listening on http://{host}:{port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
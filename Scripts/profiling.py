@@ -0,0 +1,213 @@
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+# Child processes started by pipeline_new.py / the app inherit this and profile themselves
+PROFILE_ENV = "PIPELINE_PROFILE_DIR"
+SAMPLE_INTERVAL_S = 0.005
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 25
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def add_profile_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help="Record cProfile, tracemalloc and sampled stacks into DIR (default: ./profile/<timestamp>)",
+    )
+
+
+def new_profile_dir(base: str) -> str:
+    path = os.path.join(base, datetime.now().strftime("%Y%m%d_%H%M%S"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def resolve_profile_dir(arg: Optional[str], base: str = "profile") -> Optional[str]:
+    # None: profiling off unless a parent process asked for it; "": fresh per-run dir under base
+    if arg is None:
+        arg = os.environ.get(PROFILE_ENV) or None
+        if arg is None:
+            return None
+    if arg == "":
+        return new_profile_dir(base)
+    os.makedirs(arg, exist_ok=True)
+    return arg
+
+
+class StackSampler(threading.Thread):
+    # Samples one thread's Python stack at a fixed interval; output is the collapsed-stack
+    # format read by flamegraph.pl, speedscope and inferno ("root;child;leaf count")
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL_S) -> None:
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        me = sys._getframe()
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or frame is me:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(names))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda kv: -kv[1]):
+                f.write(f"{stack} {count}\n")
+
+
+def _start_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+@contextmanager
+def profiled(name: str, profile_dir: Optional[str]) -> Iterator[Optional[str]]:
+    # Writes <name>.prof, <name>.collapsed, <name>.txt and <name>.json into profile_dir.
+    # No-op when profile_dir is None and PIPELINE_PROFILE_DIR is unset.
+    profile_dir = resolve_profile_dir(profile_dir)
+    if profile_dir is None:
+        yield None
+        return
+
+    concurrent = _tracemalloc_users > 0
+    _start_tracemalloc()
+    if not concurrent:
+        tracemalloc.reset_peak()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    sampler = StackSampler(threading.get_ident())
+    profiler: Optional[cProfile.Profile] = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler owns this interpreter (3.12+ allows only one); keep the sampler
+        profiler = None
+    sampler.start()
+    t_wall = time.perf_counter()
+    t_cpu = time.thread_time()
+    t_proc = time.process_time()
+    try:
+        yield profile_dir
+    finally:
+        wall = time.perf_counter() - t_wall
+        cpu = time.thread_time() - t_cpu
+        proc_cpu = time.process_time() - t_proc
+        if profiler is not None:
+            profiler.disable()
+        sampler.stop()
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        _stop_tracemalloc()
+        _write_report(
+            profile_dir,
+            name,
+            profiler=profiler,
+            sampler=sampler,
+            snapshot=snapshot,
+            summary={
+                "stage": name,
+                "pid": os.getpid(),
+                "wall_s": round(wall, 3),
+                "thread_cpu_s": round(cpu, 3),
+                "process_cpu_s": round(proc_cpu, 3),
+                "mem_start_mb": round(mem_start / (1 << 20), 2),
+                "mem_end_mb": round(current / (1 << 20), 2),
+                "mem_peak_mb": round(peak / (1 << 20), 2),
+                "samples": sum(sampler.stacks.values()),
+                # Peaks are process-wide; overlapping jobs in one worker share them
+                "overlapping": concurrent,
+            },
+        )
+
+
+def _write_report(
+    profile_dir: str,
+    name: str,
+    *,
+    profiler: Optional[cProfile.Profile],
+    sampler: StackSampler,
+    snapshot: tracemalloc.Snapshot,
+    summary: Dict[str, object],
+) -> None:
+    base = os.path.join(profile_dir, name)
+    sampler.write(base + ".collapsed")
+    out = io.StringIO()
+    out.write(
+        f"[profile] {name}: wall {summary['wall_s']}s, cpu {summary['thread_cpu_s']}s "
+        f"(process {summary['process_cpu_s']}s), peak traced memory {summary['mem_peak_mb']} MB\n\n"
+    )
+    out.write(f"Top {TOP_ALLOCATIONS} allocation sites (live at exit):\n")
+    for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+        frame = stat.traceback[0]
+        out.write(f"  {stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}\n")
+    if profiler is not None:
+        profiler.dump_stats(base + ".prof")
+        out.write(f"\nTop {TOP_FUNCTIONS} functions by cumulative time:\n")
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(out.getvalue())
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+def load_summaries(profile_dir: str) -> Dict[str, Dict[str, object]]:
+    out: Dict[str, Dict[str, object]] = {}
+    for fname in sorted(os.listdir(profile_dir)):
+        if fname.endswith(".json"):
+            try:
+                with open(os.path.join(profile_dir, fname), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                out[str(data.get("stage", fname[:-5]))] = data
+            except Exception:
+                continue
+    return out
+
+
+def describe_summary(s: Dict[str, object]) -> str:
+    return (
+        f"[profile] {s.get('stage')}: wall {s.get('wall_s')}s cpu {s.get('thread_cpu_s')}s "
+        f"peak {s.get('mem_peak_mb')} MB"
+    )
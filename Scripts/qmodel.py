@@ -0,0 +1,230 @@
+import json
+import weakref
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Compact in-memory model for the JSON shapes passed between steps:
+#
+#   Question     step1 metadata entry   {"question_code", "question_text", "possible_answers"}
+#   LabelSet     possible_answers, interned: variables with equal labels share one instance
+#   Group        step2 grouped item     {"question_code", "question_text", "question_type",
+#                                        "possible_answers" | "sub_questions", "recode_from"}
+#   SubQuestion  entry of sub_questions {"question_code", "possible_answers", "recode_from"}
+#
+# to_dict()/dump_questions() reproduce the JSON the steps wrote before byte for byte.
+
+RANGE_KEYS = ("min", "max")
+
+
+class LabelSet:
+    __slots__ = ("keys", "values", "_key", "_json", "__weakref__")
+
+    _interned: "weakref.WeakValueDictionary[Any, LabelSet]" = weakref.WeakValueDictionary()
+
+    def __init__(self, keys: Tuple[str, ...], values: Tuple[Any, ...]) -> None:
+        self.keys = keys
+        self.values = values
+        # Types are part of the identity: 1, 1.0 and True compare equal but serialize differently
+        self._key = (keys, tuple((v.__class__, v) for v in values))
+        self._json: Optional[str] = None
+
+    @classmethod
+    def of(cls, mapping: Any) -> "LabelSet":
+        if not isinstance(mapping, dict):
+            return EMPTY
+        labels = cls(tuple(str(k) for k in mapping), tuple(mapping.values()))
+        try:
+            return cls._interned.setdefault(labels._key, labels)
+        except TypeError:
+            # Unhashable label values (nested JSON from a model): keep a private copy
+            return labels
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __bool__(self) -> bool:
+        return bool(self.keys)
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        return iter(zip(self.keys, self.values))
+
+    def __eq__(self, other: object) -> bool:
+        return self is other or (isinstance(other, LabelSet) and self._key == other._key)
+
+    def __hash__(self) -> int:
+        try:
+            return hash(self._key)
+        except TypeError:
+            return id(self)
+
+    def __repr__(self) -> str:
+        return f"LabelSet({self.to_dict()!r})"
+
+    @property
+    def is_range(self) -> bool:
+        return set(self.keys) == set(RANGE_KEYS)
+
+    @property
+    def pa_type(self) -> str:
+        # Shape summary sent to the model in place of the labels themselves
+        return "range" if self.is_range else f"labels:{len(self.keys)}"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self.values[self.keys.index(key)]
+        except ValueError:
+            return default
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(zip(self.keys, self.values))
+
+    def to_json(self) -> str:
+        # json.dumps(indent=2) of the mapping, computed once per interned set
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        return self._json
+
+
+EMPTY = LabelSet.of({})
+
+
+class Question:
+    __slots__ = ("code", "text", "labels")
+
+    def __init__(self, code: str, text: str, labels: LabelSet = EMPTY) -> None:
+        self.code = code
+        self.text = text
+        self.labels = labels
+
+    def __repr__(self) -> str:
+        return f"Question({self.code!r}, {self.text!r}, {self.labels!r})"
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Question":
+        return cls(str(d.get("question_code", "")), str(d.get("question_text") or ""), LabelSet.of(d.get("possible_answers")))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"question_code": self.code, "question_text": self.text, "possible_answers": self.labels.to_dict()}
+
+
+def questions_from_json(items: Iterable[Any]) -> List[Question]:
+    return [Question.from_dict(d) for d in items if isinstance(d, dict)]
+
+
+def load_questions(path: str) -> List[Question]:
+    with open(path, "r", encoding="utf-8") as f:
+        return questions_from_json(json.load(f))
+
+
+def dump_questions(questions: List[Question]) -> str:
+    # Same text as json.dumps([q.to_dict() ...], ensure_ascii=False, indent=2), without building
+    # the dicts; each distinct label set is serialized once
+    if not questions:
+        return "[]"
+    parts = ["["]
+    last = len(questions) - 1
+    for i, q in enumerate(questions):
+        labels = q.labels.to_json().replace("\n", "\n    ")
+        parts.append(
+            "\n  {\n"
+            f"    \"question_code\": {json.dumps(q.code, ensure_ascii=False)},\n"
+            f"    \"question_text\": {json.dumps(q.text, ensure_ascii=False)},\n"
+            f"    \"possible_answers\": {labels}\n"
+            "  }" + ("," if i < last else "")
+        )
+    parts.append("\n]")
+    return "".join(parts)
+
+
+class SubQuestion:
+    __slots__ = ("code", "labels", "recode_from")
+
+    def __init__(self, code: Optional[str], labels: LabelSet = EMPTY, recode_from: Optional[Tuple[str, ...]] = None) -> None:
+        # code is None when the model emitted a non-string code; such entries never become columns
+        self.code = code
+        self.labels = labels
+        self.recode_from = recode_from
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "SubQuestion":
+        code = d.get("question_code")
+        rf = d.get("recode_from")
+        return cls(
+            code if isinstance(code, str) else None,
+            LabelSet.of(d.get("possible_answers")),
+            tuple(str(s) for s in rf) if isinstance(rf, list) else None,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"question_code": self.code, "possible_answers": self.labels.to_dict()}
+        if self.recode_from is not None:
+            out["recode_from"] = list(self.recode_from)
+        return out
+
+
+class Group:
+    __slots__ = ("code", "text", "qtype", "labels", "subs", "recode_from")
+
+    def __init__(
+        self,
+        code: Optional[str],
+        text: Optional[str] = None,
+        qtype: Optional[str] = None,
+        *,
+        labels: Optional[LabelSet] = None,
+        subs: Optional[Tuple[SubQuestion, ...]] = None,
+        recode_from: Optional[Tuple[str, ...]] = None,
+    ) -> None:
+        self.code = code
+        self.text = text
+        self.qtype = qtype
+        # Standalone items carry labels; grouped items carry sub-questions
+        self.labels = labels
+        self.subs = subs
+        self.recode_from = recode_from
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Group":
+        code = d.get("question_code")
+        text = d.get("question_text")
+        subs = d.get("sub_questions")
+        rf = d.get("recode_from")
+        return cls(
+            None if code is None else str(code),
+            None if text is None else str(text),
+            d.get("question_type"),
+            labels=LabelSet.of(d["possible_answers"]) if "possible_answers" in d else None,
+            subs=tuple(SubQuestion.from_dict(s) for s in subs if isinstance(s, dict)) if isinstance(subs, list) else None,
+            recode_from=tuple(str(s) for s in rf) if isinstance(rf, list) else None,
+        )
+
+    @property
+    def is_grouped(self) -> bool:
+        return self.subs is not None
+
+    @property
+    def columns(self) -> List[str]:
+        return [s.code for s in self.subs or () if s.code is not None]
+
+    def members(self) -> List[str]:
+        if self.subs:
+            return self.columns
+        return [self.code] if self.code is not None else []
+
+    def display_name(self, default: str) -> str:
+        if self.text is not None:
+            return self.text
+        return self.code if self.code is not None else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"question_code": self.code, "question_text": self.text, "question_type": self.qtype}
+        if self.subs is not None:
+            out["sub_questions"] = [s.to_dict() for s in self.subs]
+        if self.labels is not None:
+            out["possible_answers"] = self.labels.to_dict()
+        if self.recode_from is not None:
+            out["recode_from"] = list(self.recode_from)
+        return out
+
+
+def groups_from_json(items: Iterable[Any]) -> List[Group]:
+    return [Group.from_dict(d) for d in items if isinstance(d, dict)]
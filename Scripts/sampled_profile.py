@@ -0,0 +1,307 @@
+import datetime
+import math
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from data_readers import NA_VALUES, read_tables, xlsx_engine  # noqa: E402
+from qmodel import Question  # noqa: E402
+from step1_extract_xlsx_metadata import build_question_objects, try_parse_numeric  # noqa: E402
+
+# Sampled step1 for exports too large to scan. Possible answers only need the value domain and
+# its cardinality, so a bounded sample of rows is read instead of the whole file:
+#
+#   sav      `windows` row_offset/row_limit windows spread evenly across the file
+#   xlsx     the first rows of each sheet plus every k-th row after them, streamed (calamine
+#            when installed, read-only openpyxl otherwise)
+#   parquet  the first rows of evenly spaced row groups
+#
+# Per column the number of distinct values is estimated from the sample (Chao1: values seen once
+# vs twice) with a 95% upper bound. A column is settled when it is numeric with more than
+# RANGE_THRESHOLD distinct values already, so more rows could only widen its min/max, or when its
+# domain looks complete: at least two values, each seen MIN_VALUE_COUNT times, and fewer than
+# half an unseen value expected. Every other column (a dummy that only showed 0, rare codes) is
+# ambiguous and re-read in full, limited to those columns. A table the sample covered entirely is
+# read normally instead. CSV has no cheap random access and is read whole.
+
+DEFAULT_SAMPLE_ROWS = 20000
+DEFAULT_WINDOWS = 8
+# Same cut-off as build_question_objects / build_label_set: above it a numeric column is a range
+RANGE_THRESHOLD = 25
+# Below this many occurrences a value is rare enough that rarer, unseen ones are likely
+MIN_VALUE_COUNT = 5
+Z_95 = 1.96
+_NA_STRINGS = frozenset(NA_VALUES)
+
+
+class DistinctEstimate(NamedTuple):
+    observed: int
+    estimate: float
+    upper: float
+    min_count: int
+
+    @property
+    def unseen(self) -> float:
+        return self.upper - self.observed
+
+
+class SampledTable(NamedTuple):
+    name: str
+    frame: pd.DataFrame
+    total_rows: Optional[int]
+    # Passed back to read_tables when columns need a full scan
+    sheet: Any
+
+
+def estimate_distinct(series: pd.Series) -> DistinctEstimate:
+    counts = series.value_counts(dropna=True)
+    observed = len(counts)
+    f1 = int((counts == 1).sum())
+    f2 = int((counts == 2).sum())
+    min_count = int(counts.min()) if observed else 0
+    if f1 == 0:
+        return DistinctEstimate(observed, float(observed), float(observed), min_count)
+    # Bias-corrected Chao1 and its variance; defined for f2 == 0 too
+    unseen = f1 * (f1 - 1) / (2.0 * (f2 + 1))
+    var = (
+        unseen
+        + f1 * (2 * f1 - 1) ** 2 / (4.0 * (f2 + 1) ** 2)
+        + f1 ** 2 * f2 * (f1 - 1) ** 2 / (4.0 * (f2 + 1) ** 4)
+    )
+    estimate = observed + unseen
+    return DistinctEstimate(observed, estimate, estimate + Z_95 * math.sqrt(var), min_count)
+
+
+def _is_numeric(series: pd.Series) -> bool:
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        return True
+    return all(try_parse_numeric(v)[0] for v in series.dropna().unique())
+
+
+def ambiguous_columns(
+    frame: pd.DataFrame,
+    total_rows: Optional[int],
+    *,
+    exact_ranges: bool = False,
+) -> Dict[str, DistinctEstimate]:
+    # Columns whose possible answers could change with the rows that were not read
+    if total_rows is not None and total_rows <= len(frame):
+        return {}
+    ambiguous: Dict[str, DistinctEstimate] = {}
+    for col in frame.columns:
+        series = frame[col].dropna()
+        est = estimate_distinct(series)
+        if est.observed < 2:
+            # Sparse columns (routed or "other, specify" answers) and dummies that only showed one
+            # side may just have their other values missing from the sample
+            ambiguous[col] = est
+        elif _is_numeric(series) and est.observed > RANGE_THRESHOLD:
+            if exact_ranges:
+                ambiguous[col] = est
+        elif est.min_count < MIN_VALUE_COUNT or est.unseen >= 0.5:
+            ambiguous[col] = est
+    return ambiguous
+
+
+def _window_offsets(total: int, rows: int, windows: int) -> List[Tuple[int, int]]:
+    windows = max(1, min(windows, rows))
+    size = max(1, rows // windows)
+    if total <= rows:
+        return [(0, total)]
+    last = total - size
+    return [(round(i * last / (windows - 1)) if windows > 1 else 0, size) for i in range(windows)]
+
+
+def _sample_sav(path: str, columns: Optional[List[str]], rows: int, windows: int) -> List[SampledTable]:
+    import pyreadstat
+
+    _, meta = pyreadstat.read_sav(path, metadataonly=True, usecols=columns)
+    total = getattr(meta, "number_rows", None)
+    if total is None or total < 0:
+        # Row count missing from the header: the head of the file is all we can window safely
+        df, _ = pyreadstat.read_sav(path, row_limit=rows, usecols=columns)
+        return [SampledTable(os.path.basename(path), df, None, 0)]
+    frames = []
+    for offset, size in _window_offsets(total, rows, windows):
+        df, _ = pyreadstat.read_sav(path, row_offset=offset, row_limit=size, usecols=columns)
+        frames.append(df)
+    frame = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    return [SampledTable(os.path.basename(path), frame, total, 0)]
+
+
+def _header_names(row: Tuple[Any, ...]) -> List[str]:
+    # Same names pandas.read_excel gives: "Unnamed: i" for blanks, ".1" suffixes for repeats
+    names: List[str] = []
+    seen: Dict[str, int] = {}
+    for i, value in enumerate(row):
+        name = f"Unnamed: {i}" if value is None or value == "" else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        seen.setdefault(name, 0)
+        names.append(name)
+    return names
+
+
+def _excel_value(value: Any) -> Any:
+    # Cell values as pandas.read_excel converts them
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in _NA_STRINGS:
+        return None
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+def _xlsx_sheets(path: str, sheet: Any) -> Iterator[Tuple[str, Iterator[Any]]]:
+    # (title, row iterator) per selected sheet; calamine streams rows far faster than openpyxl
+    if isinstance(sheet, str) and sheet.isdigit():
+        sheet = int(sheet)
+    if xlsx_engine(path) == "calamine":
+        from python_calamine import CalamineWorkbook
+
+        wb = CalamineWorkbook.from_path(path)
+        names = list(wb.sheet_names)
+        selectors = sheet if isinstance(sheet, list) else (names if sheet == "all" else [sheet])
+        for sel in selectors:
+            ws = wb.get_sheet_by_index(sel) if isinstance(sel, int) else wb.get_sheet_by_name(sel)
+            yield ws.name, iter(ws.iter_rows())
+        return
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        selectors = sheet if isinstance(sheet, list) else (wb.sheetnames if sheet == "all" else [sheet])
+        for sel in selectors:
+            ws = wb.worksheets[sel] if isinstance(sel, int) else wb[sel]
+            yield ws.title, ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _sample_xlsx(path: str, sheet: Any, columns: Optional[List[str]], rows: int) -> List[SampledTable]:
+    tables: List[SampledTable] = []
+    for title, it in _xlsx_sheets(path, sheet):
+        header = next(it, None)
+        if header is None:
+            tables.append(SampledTable(title, pd.DataFrame(), 0, title))
+            continue
+        head_rows = rows // 2
+        head: List[Any] = []
+        strided: List[Any] = []
+        stride = 1
+        total = 0
+        # pandas makes an integer column float if any cell is blank, which changes the answer keys
+        # ("1.0" not "1"); every row passes through here, so note such columns even if unsampled
+        complete = set(range(len(header)))
+        for i, row in enumerate(it):
+            total += 1
+            if complete and (len(row) < len(header) or None in row or not _NA_STRINGS.isdisjoint(row)):
+                complete.difference_update([j for j in complete if j >= len(row) or _excel_value(row[j]) is None])
+            if i < head_rows:
+                head.append(row)
+            elif (i - head_rows) % stride == 0:
+                strided.append(row)
+                if len(strided) >= rows - head_rows:
+                    # Row count is not known up front: halve the kept rows and double the stride
+                    strided = strided[::2]
+                    stride *= 2
+        names = _header_names(header)
+        df = pd.DataFrame([[_excel_value(v) for v in r] for r in head + strided], columns=names)
+        for j, name in enumerate(names):
+            if j not in complete and pd.api.types.is_integer_dtype(df[name].dtype):
+                df[name] = df[name].astype(float)
+        if columns:
+            wanted = set(columns)
+            df = df[[c for c in df.columns if c in wanted]]
+        tables.append(SampledTable(title, df, total, title))
+    return tables
+
+
+def _sample_parquet(path: str, columns: Optional[List[str]], rows: int, windows: int) -> List[SampledTable]:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        raise SystemExit(
+            "pyarrow is required for Parquet. Install dependencies with: pip install -r requirements.txt"
+        ) from exc
+    pf = pq.ParquetFile(path)
+    total = pf.metadata.num_rows
+    groups = pf.num_row_groups
+    picks = sorted({round(i * (groups - 1) / max(1, windows - 1)) for i in range(min(windows, groups))}) if groups else []
+    size = max(1, rows // max(1, len(picks)))
+    batches = []
+    for g in picks:
+        batch = next(pf.iter_batches(batch_size=size, row_groups=[g], columns=columns), None)
+        if batch is not None:
+            batches.append(batch)
+    if not batches:
+        return [SampledTable(os.path.basename(path), pq.read_table(path, columns=columns).to_pandas(), total, 0)]
+    df = pa.Table.from_batches(batches).to_pandas()
+    df.columns = [str(c) for c in df.columns]
+    return [SampledTable(os.path.basename(path), df, total, 0)]
+
+
+def sample_tables(
+    path: str,
+    *,
+    fmt: str,
+    sheet: Any = 0,
+    columns: Optional[List[str]] = None,
+    rows: int = DEFAULT_SAMPLE_ROWS,
+    windows: int = DEFAULT_WINDOWS,
+) -> List[SampledTable]:
+    if fmt == "sav":
+        return _sample_sav(path, columns, rows, windows)
+    if fmt == "xlsx" and not path.lower().endswith(".xls"):
+        return _sample_xlsx(path, sheet, columns, rows)
+    if fmt == "parquet":
+        return _sample_parquet(path, columns, rows, windows)
+    return [SampledTable(t.name, t.frame, len(t.frame), sheet) for t in read_tables(path, fmt=fmt, sheet=sheet, columns=columns)]
+
+
+def sampled_questions(
+    path: str,
+    *,
+    fmt: str,
+    sheet: Any = 0,
+    columns: Optional[List[str]] = None,
+    rows: int = DEFAULT_SAMPLE_ROWS,
+    windows: int = DEFAULT_WINDOWS,
+    exact_ranges: bool = False,
+    log: Callable[[str], None] = print,
+) -> List[Tuple[str, List[Question]]]:
+    # Returns (table name, questions) per table, like build_question_objects over a full read
+    t0 = time.time()
+    tables = sample_tables(path, fmt=fmt, sheet=sheet, columns=columns, rows=rows, windows=windows)
+    read = sum(len(t.frame) for t in tables)
+    known = [t.total_rows for t in tables if t.total_rows is not None]
+    log(f"[step1] Sampled {read} of {sum(known) if known else '?'} rows in {time.time() - t0:.1f}s")
+    out: List[Tuple[str, List[Question]]] = []
+    for table in tables:
+        if table.total_rows is not None and table.total_rows <= len(table.frame):
+            # The sample is the whole table: build from the regular reader so nothing differs
+            frame = read_tables(path, fmt=fmt, sheet=table.sheet, columns=columns)[0].frame
+            out.append((table.name, build_question_objects(frame)))
+            continue
+        questions = build_question_objects(table.frame)
+        ambiguous = ambiguous_columns(table.frame, table.total_rows, exact_ranges=exact_ranges)
+        if ambiguous:
+            t1 = time.time()
+            cols = [str(c) for c in table.frame.columns if c in ambiguous]
+            full = read_tables(path, fmt=fmt, sheet=table.sheet, columns=cols)[0].frame
+            rescanned = {q.code: q for q in build_question_objects(full)}
+            questions = [rescanned.get(q.code, q) for q in questions]
+            log(
+                f"[step1] {table.name}: {len(cols)} of {len(questions)} column(s) ambiguous in the sample, "
+                f"full scan in {time.time() - t1:.1f}s"
+            )
+        out.append((table.name, questions))
+    return out
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from artifact_store import ArtifactStore, memo_key, sha256_file  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+
+# Shrinks a questionnaire PDF before it is uploaded for grouping. Images above the target
+# resolution are resampled, fonts are subset to the glyphs used, annotations, links, embedded
+# files, thumbnails and metadata are dropped, then unused objects are collected and every stream
+# is deflated. The text layer, which is what grouping relies on, is left alone. Results are kept
+# in the artifact store keyed by the input hash and settings, so a questionnaire is slimmed once.
+
+SLIM_VERSION = 1
+DEFAULT_DPI = 150
+DEFAULT_QUALITY = 75
+
+
+def can_rewrite_images() -> bool:
+    import fitz  # PyMuPDF
+
+    # Document.rewrite_images is newer than the oldest PyMuPDF requirements.txt allows
+    return hasattr(fitz.Document, "rewrite_images")
+
+
+def slim_document(input_path: str, output_path: str, *, dpi: int = DEFAULT_DPI, quality: int = DEFAULT_QUALITY, drop_images: bool = False) -> None:
+    import fitz  # PyMuPDF
+
+    with fitz.open(input_path) as doc:
+        for page in doc:
+            for annot in list(page.annots()):
+                page.delete_annot(annot)
+            if drop_images and page.get_text("text").strip():
+                # Logos and decoration only; pages without a text layer are scans and keep theirs
+                for img in page.get_images(full=True):
+                    page.delete_image(img[0])
+        # Invisible text is often the OCR layer of a scan, and form fields may carry the answer grid
+        doc.scrub(hidden_text=False, reset_fields=False, reset_responses=False, redactions=False)
+        if dpi > 0:
+            doc.rewrite_images(dpi_threshold=int(dpi * 1.2), dpi_target=dpi, quality=quality)
+        doc.subset_fonts()
+        doc.save(
+            output_path,
+            garbage=4,
+            clean=True,
+            deflate=True,
+            deflate_images=True,
+            deflate_fonts=True,
+            use_objstms=1,
+            preserve_metadata=0,
+        )
+
+
+def slim_pdf(
+    input_path: str,
+    output_path: str,
+    *,
+    dpi: int = DEFAULT_DPI,
+    quality: int = DEFAULT_QUALITY,
+    drop_images: bool = False,
+    store: Optional[ArtifactStore] = None,
+    reuse: bool = True,
+    log: Callable[[str], None] = print,
+) -> Dict[str, Any]:
+    t0 = time.time()
+    store = store or ArtifactStore()
+    if dpi > 0 and not can_rewrite_images():
+        log("[slim] This PyMuPDF has no Document.rewrite_images; images are kept at their resolution")
+        dpi = 0
+    params = {"version": SLIM_VERSION, "dpi": dpi, "quality": quality, "drop_images": drop_images}
+    key = memo_key("slim_pdf", {"pdf": sha256_file(input_path)}, params)
+    before = os.path.getsize(input_path)
+    hit = store.memo_get(key) if reuse else None
+    if hit:
+        store.materialize(hit["pdf"], output_path, link=False)
+    else:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix=".pdf")
+        os.close(fd)
+        try:
+            try:
+                slim_document(input_path, tmp, dpi=dpi, quality=quality, drop_images=drop_images)
+            except Exception as exc:
+                # A PDF MuPDF cannot rewrite is still uploadable as is
+                log(f"[slim] Could not slim {os.path.basename(input_path)} ({exc}); keeping the original")
+                shutil.copyfile(input_path, tmp)
+            if os.path.getsize(tmp) >= before:
+                shutil.copyfile(input_path, tmp)
+            store.memo_put(key, {"pdf": store.put_file(tmp)}, {"source": os.path.abspath(input_path)})
+            os.replace(tmp, output_path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    after = os.path.getsize(output_path)
+    stats = {
+        "bytes_before": before,
+        "bytes_after": after,
+        "saved_pct": round(100.0 * (before - after) / before, 1) if before else 0.0,
+        "cached": bool(hit),
+        "elapsed_s": round(time.time() - t0, 2),
+    }
+    log(
+        f"[slim] {before} -> {after} bytes ({stats['saved_pct']}% smaller)"
+        + (" (cached)" if hit else f" in {stats['elapsed_s']}s")
+    )
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Shrink a questionnaire PDF before upload (images, fonts, annotations, metadata).")
+    parser.add_argument("--input", required=True, help="Path to the questionnaire PDF")
+    parser.add_argument("--output", required=True, help="Path to write the slimmed PDF")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help=f"Resample images above this resolution down to it; 0 keeps images as is (default: {DEFAULT_DPI})")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help=f"JPEG quality for resampled images (default: {DEFAULT_QUALITY})")
+    parser.add_argument("--drop-images", action="store_true", help="Remove images from pages that have a text layer")
+    parser.add_argument("--no-reuse", action="store_true", help="Slim again even if this PDF was slimmed with the same settings")
+    parser.add_argument("--store", help="Artifact store directory (default: $PIPELINE_STORE_DIR or Output/store)")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiled("slim", args.profile):
+        slim_pdf(
+            args.input,
+            args.output,
+            dpi=args.dpi,
+            quality=args.quality,
+            drop_images=args.drop_images,
+            store=ArtifactStore(args.store) if args.store else None,
+            reuse=not args.no_reuse,
+        )
+
+
+if __name__ == "__main__":
+    main()
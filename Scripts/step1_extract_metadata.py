@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import time
+from typing import Any, List, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from data_readers import detect_format, read_tables  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+from qmodel import Question, dump_questions  # noqa: E402
+from sampled_profile import DEFAULT_SAMPLE_ROWS, sampled_questions  # noqa: E402
+
+
+def extract_metadata(
+    input_path: str,
+    output_path: Optional[str] = None,
+    *,
+    fmt: Optional[str] = None,
+    sheet: Any = 0,
+    columns: Optional[List[str]] = None,
+    include_empty: bool = False,
+    print_json: bool = False,
+    sample: Optional[int] = None,
+    exact_ranges: bool = False,
+) -> List[Question]:
+    # sample: profile data-derived answers from about this many rows (see sampled_profile.py)
+    fmt = fmt or detect_format(input_path)
+    questions: List[Question] = []
+    if fmt == "sav":
+        import pyreadstat
+        from step1_extract_spss_metadata import build_question_objects as build_from_meta
+
+        print(f"[step1] Reading SPSS metadata from: {input_path}")
+        # SPSS carries labels in its header; no need to scan the data
+        _, meta = pyreadstat.read_sav(input_path, metadataonly=True, usecols=columns)
+        questions = build_from_meta(meta)
+        unlabeled = [q.code for q in questions if not q.labels]
+        if sample and unlabeled:
+            # Variables without value labels get their answers from a sample of the data
+            print(f"[step1] Sampling data for {len(unlabeled)} variable(s) without value labels")
+            found = {
+                q.code: q.labels
+                for _, qs in sampled_questions(input_path, fmt=fmt, columns=unlabeled, rows=sample, exact_ranges=exact_ranges)
+                for q in qs
+            }
+            for q in questions:
+                if not q.labels and q.code in found:
+                    q.labels = found[q.code]
+    elif sample:
+        print(f"[step1] Sampling {fmt} data from: {input_path}")
+        seen: set = set()
+        for name, qs in sampled_questions(input_path, fmt=fmt, sheet=sheet, columns=columns, rows=sample, exact_ranges=exact_ranges):
+            for q in qs:
+                if q.code in seen:
+                    q.code = f"{name}.{q.code}"
+                seen.add(q.code)
+                questions.append(q)
+    else:
+        from step1_extract_xlsx_metadata import build_question_objects
+
+        print(f"[step1] Reading {fmt} data from: {input_path}")
+        t0 = time.time()
+        tables = read_tables(input_path, fmt=fmt, sheet=sheet, columns=columns)
+        print(f"[step1] Read {len(tables)} table(s) in {time.time() - t0:.1f}s")
+        seen = set()
+        for table in tables:
+            for q in build_question_objects(table.frame):
+                if q.code in seen:
+                    # Same header on several sheets: keep both, qualified by sheet name
+                    q.code = f"{table.name}.{q.code}"
+                seen.add(q.code)
+                questions.append(q)
+
+    total_before = len(questions)
+    if not include_empty:
+        questions = [q for q in questions if q.labels]
+        print(f"[step1] Filtered empty questions: {total_before - len(questions)} dropped, {len(questions)} kept")
+    else:
+        print(f"[step1] Keeping all questions: {len(questions)}")
+
+    payload = dump_questions(questions)
+    if output_path:
+        print(f"[step1] Writing JSON to: {output_path}")
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        print("[step1] Done")
+    if (not output_path) or print_json:
+        print(payload)
+    return questions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Extract question metadata from a data file (.sav, .xlsx, .csv, .parquet; format auto-detected) into JSON."
+    )
+    parser.add_argument("--input", required=True, help="Path to the input data file")
+    parser.add_argument("--output", help="Optional path to write the JSON output. If omitted, prints to stdout.")
+    parser.add_argument("--format", dest="fmt", choices=["sav", "xlsx", "csv", "parquet"], help="Override format auto-detection")
+    parser.add_argument("--sheet", default=0, help="Workbook sheet index, name, or 'all' for every sheet (default: 0)")
+    parser.add_argument("--columns", nargs="+", help="Only read these columns")
+    parser.add_argument("--print", dest="print_json", action="store_true", help="Also print JSON to stdout even if --output is provided.")
+    parser.add_argument("--include-empty", dest="include_empty", action="store_true", help="Include questions with no possible answers.")
+    parser.add_argument(
+        "--sample",
+        type=int,
+        nargs="?",
+        const=DEFAULT_SAMPLE_ROWS,
+        metavar="ROWS",
+        help=f"Derive answers from a spread-out sample of about ROWS rows (default {DEFAULT_SAMPLE_ROWS}); columns the sample cannot settle are read in full",
+    )
+    parser.add_argument("--exact-ranges", action="store_true", help="With --sample: also read numeric range columns in full for exact min/max")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiled("step1", args.profile):
+        extract_metadata(
+            args.input,
+            args.output,
+            fmt=args.fmt,
+            sheet=args.sheet,
+            columns=args.columns,
+            include_empty=args.include_empty,
+            print_json=args.print_json,
+            sample=args.sample,
+            exact_ranges=args.exact_ranges,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 import argparse
-import json
+import os
+import sys
 from typing import Any, Dict, List, Tuple
 
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from profiling import add_profile_argument, profiled  # noqa: E402
+from qmodel import LabelSet, Question, dump_questions  # noqa: E402
+
 try:
     import pyreadstat
 except ImportError as exc:
@@ -41,7 +47,35 @@ def try_parse_numeric(value: Any) -> Tuple[bool, float]:
     return False, 0.0
 
 
-def build_question_objects(meta: "pyreadstat.metadata_container") -> List[Dict[str, Any]]:
+def build_label_set(possible_answers_raw: Dict[Any, str]) -> LabelSet:
+    # If all keys are numeric and there are many (>25), compress to min/max
+    possible_answers: Dict[str, Any] = {}
+    if possible_answers_raw:
+        numeric_vals: List[float] = []
+        all_numeric = True
+        for k in possible_answers_raw.keys():
+            ok, num = try_parse_numeric(k)
+            if not ok:
+                all_numeric = False
+                break
+            numeric_vals.append(num)
+
+        if all_numeric and len(numeric_vals) > 25:
+            min_val = min(numeric_vals)
+            max_val = max(numeric_vals)
+            # Use ints if all are whole numbers
+            if all(float(v).is_integer() for v in numeric_vals):
+                min_val = int(min_val)
+                max_val = int(max_val)
+            possible_answers = {"min": min_val, "max": max_val}
+        else:
+            # Fallback: full mapping, stringify keys
+            for k, v in possible_answers_raw.items():
+                possible_answers[coerce_label_key_to_string(k)] = v if v is not None else ""
+    return LabelSet.of(possible_answers)
+
+
+def build_question_objects(meta: "pyreadstat.metadata_container") -> List[Question]:
     column_names: List[str] = list(getattr(meta, "column_names", []) or [])
     column_labels: List[str] = list(getattr(meta, "column_labels", []) or [])
 
@@ -59,7 +93,9 @@ def build_question_objects(meta: "pyreadstat.metadata_container") -> List[Dict[s
     value_labels_catalog: Dict[str, Dict[Any, str]] = getattr(meta, "value_labels", {}) or {}
     variable_to_labelset: Dict[str, str] = getattr(meta, "variable_to_labelset", {}) or {}
 
-    questions: List[Dict[str, Any]] = []
+    # Variables sharing a labelset share the raw dict; convert each one once
+    converted: Dict[int, LabelSet] = {}
+    questions: List[Question] = []
     for var_name in column_names:
         # Resolve possible answers
         possible_answers_raw: Dict[Any, str] = {}
@@ -71,39 +107,45 @@ def build_question_objects(meta: "pyreadstat.metadata_container") -> List[Dict[s
             if labelset_name and labelset_name in value_labels_catalog:
                 possible_answers_raw = value_labels_catalog[labelset_name]
 
-        # If all keys are numeric and there are many (>25), compress to min/max
-        possible_answers: Dict[str, Any] = {}
-        if possible_answers_raw:
-            numeric_vals: List[float] = []
-            all_numeric = True
-            for k in possible_answers_raw.keys():
-                ok, num = try_parse_numeric(k)
-                if not ok:
-                    all_numeric = False
-                    break
-                numeric_vals.append(num)
-
-            if all_numeric and len(numeric_vals) > 25:
-                min_val = min(numeric_vals)
-                max_val = max(numeric_vals)
-                # Use ints if all are whole numbers
-                if all(float(v).is_integer() for v in numeric_vals):
-                    min_val = int(min_val)
-                    max_val = int(max_val)
-                possible_answers = {"min": min_val, "max": max_val}
-            else:
-                # Fallback: full mapping, stringify keys
-                for k, v in possible_answers_raw.items():
-                    possible_answers[coerce_label_key_to_string(k)] = v if v is not None else ""
-
-        questions.append(
-            {
-                "question_code": var_name,
-                "question_text": name_to_label.get(var_name, var_name),
-                "possible_answers": possible_answers,
-            }
-        )
+        labels = converted.get(id(possible_answers_raw))
+        if labels is None:
+            labels = converted[id(possible_answers_raw)] = build_label_set(possible_answers_raw)
+
+        questions.append(Question(var_name, name_to_label.get(var_name, var_name), labels))
+
+    return questions
+
+
+def extract_metadata(
+    input_path: str,
+    output_path: str | None = None,
+    *,
+    include_empty: bool = False,
+    print_json: bool = False,
+) -> List[Question]:
+    print(f"[step1] Reading SPSS metadata from: {input_path}")
+    # Read only metadata to keep it fast and memory efficient
+    _, meta = pyreadstat.read_sav(input_path, metadataonly=True)
+    print("[step1] Building question objects from metadata...")
+    questions = build_question_objects(meta)
+    total_before = len(questions)
+    if not include_empty:
+        questions = [q for q in questions if q.labels]  # drop empties
+        dropped = total_before - len(questions)
+        print(f"[step1] Filtered empty questions: {dropped} dropped, {len(questions)} kept")
+    else:
+        print(f"[step1] Keeping all questions: {len(questions)}")
+
+    payload = dump_questions(questions)
+
+    if output_path:
+        print(f"[step1] Writing JSON to: {output_path}")
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        print("[step1] Done")
 
+    if (not output_path) or print_json:
+        print(payload)
     return questions
 
 
@@ -134,31 +176,16 @@ def main() -> None:
         help="Include questions with no possible answers. By default, such questions are removed.",
     )
 
+    add_profile_argument(parser)
     args = parser.parse_args()
 
-    print(f"[step1] Reading SPSS metadata from: {args.input}")
-    # Read only metadata to keep it fast and memory efficient
-    _, meta = pyreadstat.read_sav(args.input, metadataonly=True)
-    print("[step1] Building question objects from metadata...")
-    questions = build_question_objects(meta)
-    total_before = len(questions)
-    if not args.include_empty:
-        questions = [q for q in questions if q.get("possible_answers")]  # drop empties
-        dropped = total_before - len(questions)
-        print(f"[step1] Filtered empty questions: {dropped} dropped, {len(questions)} kept")
-    else:
-        print(f"[step1] Keeping all questions: {len(questions)}")
-
-    payload = json.dumps(questions, ensure_ascii=False, indent=2)
-
-    if args.output:
-        print(f"[step1] Writing JSON to: {args.output}")
-        with open(args.output, "w", encoding="utf-8") as f:
-            f.write(payload)
-        print("[step1] Done")
-
-    if (not args.output) or args.print_json:
-        print(payload)
+    with profiled("step1", args.profile):
+        extract_metadata(
+            args.input,
+            args.output,
+            include_empty=args.include_empty,
+            print_json=args.print_json,
+        )
 
 
 if __name__ == "__main__":
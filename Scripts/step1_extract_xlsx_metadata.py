@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import os
+import sys
 from typing import Any, Dict, List, Tuple
 
 import pandas as pd
 
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from data_readers import read_tables  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+from qmodel import LabelSet, Question, dump_questions  # noqa: E402
+
 
 def try_parse_numeric(value: Any) -> Tuple[bool, float]:
     if value is None:
@@ -20,8 +28,8 @@ def try_parse_numeric(value: Any) -> Tuple[bool, float]:
         return False, 0.0
 
 
-def build_question_objects(df: pd.DataFrame) -> List[Dict[str, Any]]:
-    questions: List[Dict[str, Any]] = []
+def build_question_objects(df: pd.DataFrame) -> List[Question]:
+    questions: List[Question] = []
     for col in df.columns:
         series = df[col]
         # Drop NA for value analysis
@@ -61,13 +69,33 @@ def build_question_objects(df: pd.DataFrame) -> List[Dict[str, Any]]:
                     mapping[key] = key
                 possible_answers = mapping
 
-        questions.append(
-            {
-                "question_code": str(col),
-                "question_text": str(col),
-                "possible_answers": possible_answers,
-            }
-        )
+        questions.append(Question(str(col), str(col), LabelSet.of(possible_answers)))
+    return questions
+
+
+def extract_metadata(
+    input_path: str,
+    output_path: str | None = None,
+    *,
+    sheet: Any = 0,
+    include_empty: bool = False,
+    indent: int = 2,
+) -> List[Question]:
+    # Read Excel (calamine engine when installed, openpyxl otherwise)
+    df = read_tables(input_path, fmt="xlsx", sheet=sheet)[0].frame
+    questions = build_question_objects(df)
+    if not include_empty:
+        questions = [q for q in questions if q.labels]
+    if indent == 2:
+        payload = dump_questions(questions)
+    else:
+        payload = json.dumps([q.to_dict() for q in questions], ensure_ascii=False, indent=indent)
+
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+    else:
+        print(payload)
     return questions
 
 
@@ -81,21 +109,17 @@ def main() -> None:
     parser.add_argument("--sheet", default=0, help="Sheet index or name (default: 0)")
     parser.add_argument("--include-empty", action="store_true", help="Keep columns with no possible answers")
 
+    add_profile_argument(parser)
     args = parser.parse_args()
 
-    # Read Excel
-    df = pd.read_excel(args.input, sheet_name=args.sheet, engine="openpyxl")
-    questions = build_question_objects(df)
-    total_before = len(questions)
-    if not args.include_empty:
-        questions = [q for q in questions if q.get("possible_answers")]
-    payload = json.dumps(questions, ensure_ascii=False, indent=args.indent)
-
-    if args.output:
-        with open(args.output, "w", encoding="utf-8") as f:
-            f.write(payload)
-    else:
-        print(payload)
+    with profiled("step1", args.profile):
+        extract_metadata(
+            args.input,
+            args.output,
+            sheet=args.sheet,
+            include_empty=args.include_empty,
+            indent=args.indent,
+        )
 
 
 if __name__ == "__main__":
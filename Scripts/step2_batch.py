@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from profiling import add_profile_argument, profiled  # noqa: E402
+from step2_group_with_pdf_gemini import CONTEXT_CACHE_MODES, GroupingError, make_client, run_grouping_async  # noqa: E402
+
+# Runs step2 for many studies on one event loop with a shared Gemini client.
+# Jobs file: JSON list of {"pdf", "metadata", "output", optional "name" and any
+# run_grouping_async option such as "auto", "flash", "uploaded", "alignment", "template_index",
+# "context_cache"}.
+
+JOB_OPTIONS = {
+    "model",
+    "flash",
+    "fallback",
+    "auto",
+    "max_latency",
+    "max_cost",
+    "plan_path",
+    "uploaded_path",
+    "alignment_path",
+    "template_index_path",
+    "context_cache_mode",
+    "cache_ttl",
+}
+JOB_ALIASES = {
+    "plan": "plan_path",
+    "uploaded": "uploaded_path",
+    "alignment": "alignment_path",
+    "template_index": "template_index_path",
+    "context_cache": "context_cache_mode",
+}
+
+
+async def run_batch_async(
+    jobs: List[Dict[str, Any]],
+    *,
+    client: Any,
+    concurrency: int = 16,
+    upload_timeout: float = 90.0,
+    call_timeout: Optional[float] = 600.0,
+    study_timeout: Optional[float] = None,
+    defaults: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(job: Dict[str, Any]) -> Dict[str, Any]:
+        name = str(job.get("name") or os.path.splitext(os.path.basename(job["output"]))[0])
+        options = dict(defaults or {})
+        for key, value in job.items():
+            key = JOB_ALIASES.get(key, key)
+            if key in JOB_OPTIONS:
+                options[key] = value
+
+        def log(msg: str) -> None:
+            # One write per line: planning runs in worker threads and print() is not atomic
+            sys.stdout.write(f"[{name}] {msg}\n")
+            sys.stdout.flush()
+
+        async with sem:
+            t0 = time.time()
+            try:
+                await asyncio.wait_for(
+                    run_grouping_async(
+                        job["pdf"],
+                        job["metadata"],
+                        job["output"],
+                        client=client,
+                        upload_timeout=upload_timeout,
+                        call_timeout=call_timeout,
+                        log=log,
+                        **options,
+                    ),
+                    study_timeout,
+                )
+                error = ""
+            except asyncio.TimeoutError:
+                error = f"study timed out after {study_timeout}s"
+            except GroupingError as exc:
+                error = str(exc)
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+            elapsed = time.time() - t0
+        if error:
+            log(f"[error] {error}")
+        return {"name": name, "output": job["output"], "ok": not error, "error": error, "elapsed": round(elapsed, 2)}
+
+    return list(await asyncio.gather(*(one(job) for job in jobs)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run step2 grouping for many studies concurrently on one event loop.")
+    parser.add_argument("--jobs", required=True, help="JSON list of {pdf, metadata, output, ...} jobs")
+    parser.add_argument("--api-key", dest="api_key")
+    parser.add_argument("--concurrency", type=int, default=16, help="Studies in flight at once (default: 16)")
+    parser.add_argument("--upload-timeout", type=float, default=90.0, help="Seconds to wait for an uploaded PDF to become ACTIVE")
+    parser.add_argument("--call-timeout", type=float, default=600.0, help="Seconds per generateContent call")
+    parser.add_argument("--study-timeout", type=float, help="Seconds for a whole study (plan, upload, calls, retry)")
+    parser.add_argument("--flash", action="store_true", help="Default for jobs that do not set it")
+    parser.add_argument("--auto", action="store_true", help="Default for jobs that do not set it")
+    parser.add_argument("--fallback", action="store_true", help="Default for jobs that do not set it")
+    parser.add_argument("--template-index", help="Default template_index.py directory for jobs that do not set one")
+    parser.add_argument("--context-cache", choices=CONTEXT_CACHE_MODES, default="auto", help="Default context caching mode for jobs that do not set one")
+    parser.add_argument("--report", help="Optional path to write per-study results JSON")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    api_key = args.api_key or os.environ.get("GOOGLE_API_KEY") or ""
+    if not api_key:
+        raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+    with open(args.jobs, "r", encoding="utf-8") as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list):
+        raise SystemExit("Jobs file must contain a JSON list")
+
+    with profiled("step2-batch", args.profile):
+        t0 = time.time()
+        results = asyncio.run(run_batch_async(
+            jobs,
+            client=make_client(api_key),
+            concurrency=args.concurrency,
+            upload_timeout=args.upload_timeout,
+            call_timeout=args.call_timeout,
+            study_timeout=args.study_timeout,
+            defaults={
+                "flash": args.flash,
+                "auto": args.auto,
+                "fallback": args.fallback,
+                "template_index_path": args.template_index,
+                "context_cache_mode": args.context_cache,
+            },
+        ))
+        failed = sum(1 for r in results if not r["ok"])
+        print(f"[batch] {len(results) - failed}/{len(results)} studies grouped in {time.time() - t0:.1f}s", flush=True)
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import hashlib
 import json
 import os
 import sys
+import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 try:
     from google import genai
@@ -15,6 +18,31 @@ except Exception as exc:
         "google-genai is required. Install with: pip install google-genai"
     ) from exc
 
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from step2_planner import (  # noqa: E402
+    CHARS_PER_TOKEN,
+    MODEL_PROFILES,
+    TOKENS_PER_PDF_PAGE,
+    compute_base,
+    describe_plan,
+    make_plan,
+    manual_plan,
+    pdf_page_count,
+)
+from align_text import cluster_ids, grouping_hints, load_alignment  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+from qmodel import Group, Question, SubQuestion, questions_from_json  # noqa: E402
+from template_index import TemplateIndex, describe_match, merge_carried  # noqa: E402
+
+
+def make_client(api_key: str) -> "genai.Client":
+    # GEMINI_BASE_URL points the SDK at a local stub (Scripts/gemini_stub.py) for tests and load runs
+    base_url = os.environ.get("GEMINI_BASE_URL")
+    if base_url:
+        return genai.Client(api_key=api_key, http_options=types.HttpOptions(base_url=base_url))
+    return genai.Client(api_key=api_key)
+
 
 def build_prompt() -> str:
     return (
@@ -39,58 +67,151 @@ def build_prompt() -> str:
     )
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser(
-        description="Group metadata using the questionnaire PDF + SPSS metadata in a single Gemini call."
-    )
-    parser.add_argument("--pdf", required=True, help="Path to the questionnaire PDF")
-    parser.add_argument("--metadata", required=True, help="Path to metadata questions JSON (from step1)")
-    parser.add_argument("--output", required=True, help="Path to write the combined grouped JSON")
-    parser.add_argument("--model", default="gemini-2.5-pro")
-    parser.add_argument("--api-key", dest="api_key")
-    parser.add_argument("--fallback", action="store_true", help="If no groups from API, emit heuristic prefix-based groups instead of failing")
-    parser.add_argument("--flash", action="store_true", help="Use Gemini 2.5 Flash with higher thinking budget (4096)")
+# Extract JSON array safely (and helpers for robust recovery)
+def extract_json_array_str(s: str) -> str:
+    start = s.find("[")
+    if start == -1:
+        raise ValueError("no '[' found")
+    depth = 0
+    for i in range(start, len(s)):
+        ch = s[i]
+        if ch == '[':
+            depth += 1
+        elif ch == ']':
+            depth -= 1
+            if depth == 0:
+                return s[start:i+1]
+    raise ValueError("no matching ']' found")
 
-    args = parser.parse_args()
 
-    api_key = args.api_key or os.environ.get("GOOGLE_API_KEY") or ""
-    if not api_key:
-        raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+def extract_code_fence(s: str) -> str:
+    tick = "```"
+    start = s.find(tick)
+    if start == -1:
+        return ""
+    # Skip optional language tag
+    lang_end = s.find("\n", start + len(tick))
+    if lang_end == -1:
+        return ""
+    end = s.find(tick, lang_end + 1)
+    if end == -1:
+        return ""
+    return s[lang_end + 1:end]
 
-    client = genai.Client(api_key=api_key)
 
-    # Choose model and thinking budget
-    model_name = args.model
-    thinking_budget = 1024
-    temperature = 0.0
-    if args.flash:
-        model_name = "gemini-2.5-flash"
-        thinking_budget = 256
-        temperature = 0.1
+def extract_json_object_str(s: str) -> str:
+    start = s.find("{")
+    if start == -1:
+        raise ValueError("no '{' found")
+    depth = 0
+    for i in range(start, len(s)):
+        ch = s[i]
+        if ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return s[start:i+1]
+    raise ValueError("no matching '}' found")
 
-    # Load metadata and compact
-    with open(args.metadata, "r", encoding="utf-8") as f:
-        full_meta: List[Dict[str, Any]] = json.load(f)
 
-    compact_items: List[Dict[str, Any]] = []
-    for q in full_meta:
-        code = q.get("question_code")
-        text = q.get("question_text")
-        pa = q.get("possible_answers")
-        if isinstance(pa, dict) and set(pa.keys()) == {"min", "max"}:
-            pa_type = "range"
-        elif isinstance(pa, dict):
-            pa_type = f"labels:{len(pa)}"
-        else:
-            pa_type = "labels:0"
-        compact_items.append({"question_code": code, "question_text": text, "pa_type": pa_type})
-    # Light size cap for faster calls while staying smart
-    if len(compact_items) > 1200:
-        compact_items = compact_items[:1200]
-    compact_json = json.dumps(compact_items, ensure_ascii=False)
-
-    # Upload PDF
-    with open(args.pdf, "rb") as f:
+def balance_brackets_fragment(fragment: str) -> str:
+    # Best-effort: count brackets/braces and append closing ones
+    open_sq = fragment.count('[')
+    open_br = fragment.count('{')
+    close_br = fragment.count('}')
+    balanced = fragment
+    # Close braces first, then brackets
+    balanced += '}' * max(0, open_br - close_br)
+    balanced += ']' * max(0, open_sq - balanced.count(']'))
+    return balanced
+
+
+def parse_grouped_json(text: str) -> List[Any]:
+    # Raises ValueError when no JSON array can be recovered from the response
+    try:
+        data = json.loads(text)
+        if isinstance(data, list):
+            return data
+    except Exception:
+        pass
+    # Try code-fenced content first
+    cf = extract_code_fence(text)
+    if cf:
+        try:
+            data = json.loads(cf)
+            if isinstance(data, dict):
+                data = [data]
+            if isinstance(data, list):
+                return data
+        except Exception:
+            pass
+    try:
+        data = json.loads(extract_json_array_str(text))
+        if isinstance(data, list):
+            return data
+    except Exception:
+        pass
+    # Try object top-level → wrap in list
+    try:
+        return [json.loads(extract_json_object_str(text))]
+    except Exception:
+        pass
+    # Try balancing missing closers on array fragment
+    start_idx = text.find('[')
+    if start_idx == -1:
+        raise ValueError("no '[' found")
+    try:
+        data = json.loads(balance_brackets_fragment(text[start_idx:]))
+    except Exception as exc:
+        raise ValueError(str(exc)) from exc
+    if not isinstance(data, list):
+        raise ValueError("not a list")
+    return data
+
+
+# Warn if model returned no groups (or only standalones)
+def has_groups(items: List[Dict[str, Any]]) -> bool:
+    for it in items:
+        if isinstance(it, dict):
+            subs = it.get("sub_questions")
+            if isinstance(subs, list) and len(subs) >= 2:
+                return True
+    return False
+
+
+def compact_metadata(full_meta: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {"question_code": q.code, "question_text": q.text, "pa_type": q.labels.pa_type}
+        for q in questions_from_json(full_meta)
+    ]
+
+
+def heuristic_groups(full_meta: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Heuristic fallback grouping by base prefix
+    questions = [q for q in questions_from_json(full_meta) if q.code]
+    base_to_members: Dict[str, List[Question]] = {}
+    for q in questions:
+        base_to_members.setdefault(compute_base(q.code), []).append(q)
+    grouped: List[Group] = []
+    member_codes = set()
+    for base, members in base_to_members.items():
+        if len(members) >= 2:
+            grouped.append(Group(
+                f"{base}_GROUP",
+                base,
+                "multi-select",
+                subs=tuple(SubQuestion(m.code, m.labels) for m in members),
+            ))
+            member_codes.update(m.code for m in members)
+    for q in questions:
+        if q.code not in member_codes:
+            grouped.append(Group(q.code, q.text, "integer" if q.labels.is_range else "single-select", labels=q.labels))
+    return [g.to_dict() for g in grouped]
+
+
+def upload_pdf(client: "genai.Client", pdf_path: str, *, timeout: float = 90.0) -> Any:
+    with open(pdf_path, "rb") as f:
         file_obj = client.files.upload(file=f, config=UploadFileConfig(mime_type="application/pdf"))
 
     # Wait until ACTIVE
@@ -100,258 +221,727 @@ def main() -> None:
         refreshed = client.files.get(name=name)
         state = getattr(refreshed, "state", None)
         if state in ("ACTIVE", "SUCCEEDED", "READY"):
-            file_obj = refreshed
-            break
-        if time.time() - start > 90:
+            return refreshed
+        if time.time() - start > timeout:
             raise SystemExit("Timed out waiting for PDF to be ready.")
         time.sleep(1.0)
 
-    # Prepare request
+
+# Gemini keeps uploaded files for 48h; treat records as stale a little earlier
+UPLOAD_MAX_AGE_S = 47 * 3600
+
+
+def write_upload_record(path: str, file_obj: Any, pdf_path: str) -> None:
+    record = {
+        "name": getattr(file_obj, "name", None),
+        "uri": getattr(file_obj, "uri", None),
+        "pdf": os.path.abspath(pdf_path),
+        "uploaded_at": time.time(),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+
+
+def load_upload_record(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            record = json.load(f)
+    except Exception:
+        return None
+    if not isinstance(record, dict) or not record.get("uri"):
+        return None
+    if time.time() - float(record.get("uploaded_at", 0)) > UPLOAD_MAX_AGE_S:
+        return None
+    return record
+
+
+def run_upload(pdf_path: str, output_path: str, *, api_key: str | None = None, client: "genai.Client | None" = None) -> None:
+    if client is None:
+        api_key = api_key or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+        client = make_client(api_key)
+    file_obj = upload_pdf(client, pdf_path)
+    write_upload_record(output_path, file_obj, pdf_path)
+    print(f"[upload] {getattr(file_obj, 'name', '')} ready; record written to: {output_path}")
+
+
+def shard_note(index: int, total: int) -> str:
+    return (
+        f"SHARD {index + 1} of {total}: the metadata below is one contiguous slice of the study. "
+        "Group and emit ONLY these variables; other slices are handled separately.\n"
+    )
+
+
+def hints_part(hints: List[Dict[str, Any]]) -> str:
+    return (
+        "LOCAL_ALIGNMENT_HINTS_JSON: each entry lists metadata variables whose labels matched the same "
+        "question stem in the PDF (page is 1-based). Treat them as strong evidence for a shared group, "
+        "but confirm against the PDF.\n" + json.dumps(hints, ensure_ascii=False)
+    )
+
+
+def write_raw(path: str, text: str) -> None:
+    try:
+        with open(path, "w", encoding="utf-8") as rf:
+            rf.write(text)
+    except Exception:
+        pass
+
+
+class GroupingError(RuntimeError):
+    # Raised by the shared grouping helpers; run_grouping turns it into SystemExit(code) for the
+    # CLI and worker, the async API lets it propagate so one failed study does not stop the loop
+    def __init__(self, message: str, code: int = 2) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+def prepare_grouping(
+    pdf_path: str,
+    metadata_path: str,
+    output_path: str,
+    *,
+    model: str = "gemini-2.5-pro",
+    flash: bool = False,
+    auto: bool = False,
+    max_latency: Optional[float] = None,
+    max_cost: Optional[float] = None,
+    plan_path: Optional[str] = None,
+    alignment_path: Optional[str] = None,
+    template_index_path: Optional[str] = None,
+    log: Callable[[str], None] = print,
+) -> Dict[str, Any]:
+    # Load metadata and compact
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        full_meta: List[Dict[str, Any]] = json.load(f)
+    job: Dict[str, Any] = {"study_meta": full_meta, "template_index": template_index_path, "carried": []}
+    if template_index_path:
+        # Items of earlier studies with identical members are reused; the model sees the rest
+        match = TemplateIndex(template_index_path).match(full_meta)
+        log(describe_match(match, len(full_meta)))
+        job["carried"] = match.carried
+        full_meta = [q for q in full_meta if str(q.get("question_code", "")) not in match.covered]
+        if not full_meta:
+            log("[template] Every variable resolved from indexed studies; skipping the model")
+            job.update(full_meta=full_meta, prompt="", alignment=None, plan=None, shards=[])
+            return job
+    compact_items = compact_metadata(full_meta)
     prompt = build_prompt()
-    contents = [
-        Content(
-            role="user",
-            parts=[
-                Part.from_uri(file_uri=file_obj.uri, mime_type="application/pdf"),
-                Part.from_text(text=prompt),
-                Part.from_text(text="SPSS_METADATA_COMPACT_JSON:\n" + compact_json),
-            ],
+    pdf_pages = pdf_page_count(pdf_path)
+    pdf_sha = pdf_digest(pdf_path)
+    alignment = load_alignment(alignment_path) if alignment_path else None
+    codes = [str(q.get("question_code", "")) for q in compact_items]
+
+    # Choose model, thinking budget and sharding
+    if plan_path:
+        with open(plan_path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        plan["reason"] = f"replayed from {os.path.basename(plan_path)}"
+    elif auto:
+        plan = make_plan(
+            compact_items,
+            full_meta,
+            pdf_pages=pdf_pages,
+            prompt_chars=len(prompt),
+            max_latency=max_latency,
+            max_cost=max_cost,
+            clusters=cluster_ids(alignment, codes) if alignment else None,
         )
-    ]
+    else:
+        # Light size cap for faster calls while staying smart
+        plan = manual_plan(model, flash, len(compact_items))
+    log(f"[plan] {describe_plan(plan)}")
+    if auto or plan_path:
+        write_raw(output_path + ".plan.json", json.dumps(plan, ensure_ascii=False, indent=2))
+
+    job.update(
+        full_meta=full_meta,
+        prompt=prompt,
+        pdf_pages=pdf_pages,
+        pdf_sha=pdf_sha,
+        alignment=alignment,
+        plan=plan,
+        shards=[compact_items[s:e] for s, e in plan["shards"]],
+        usage={"calls": 0, "prompt": 0, "cached": 0, "output": 0},
+    )
+    return job
+
 
-    generate_cfg = types.GenerateContentConfig(
+def generate_config(temperature: float, thinking_budget: int) -> "types.GenerateContentConfig":
+    return types.GenerateContentConfig(
         temperature=temperature,
         thinking_config=types.ThinkingConfig(
             thinking_budget=thinking_budget,
             include_thoughts=False,
         ),
     )
-    def call_model(curr_model: str, cfg: "types.GenerateContentConfig") -> str:
-        resp = client.models.generate_content(
-            model=curr_model,
-            contents=contents,
-            config=cfg,
-        )
-        return getattr(resp, "text", "") or "[]"
 
-    text = call_model(model_name, generate_cfg)
+
+def shard_parts(job: Dict[str, Any], file_obj: Any, index: int) -> List[Any]:
+    shards = job["shards"]
+    items = shards[index]
+    parts = [
+        Part.from_uri(file_uri=file_obj.uri, mime_type="application/pdf"),
+        Part.from_text(text=job["prompt"]),
+    ]
+    if len(shards) > 1:
+        parts.append(Part.from_text(text=shard_note(index, len(shards))))
+    if job["alignment"]:
+        hints = grouping_hints(job["alignment"], [str(it.get("question_code", "")) for it in items])
+        if hints:
+            parts.append(Part.from_text(text=hints_part(hints)))
+    parts.append(Part.from_text(text="SPSS_METADATA_COMPACT_JSON:\n" + json.dumps(items, ensure_ascii=False)))
+    return parts
+
+
+def shared_prefix_len(job: Dict[str, Any], parts: List[Any]) -> int:
+    # Shards share the PDF and the instructions; a single call's parts are all reused by its retry
+    return 2 if len(job["shards"]) > 1 else len(parts)
+
+
+def build_parts(job: Dict[str, Any], file_obj: Any, index: int, cached: Optional[str] = None) -> List[Any]:
+    parts = shard_parts(job, file_obj, index)
+    if cached:
+        # The prefix lives in the cache; a request still needs a turn of its own
+        parts = parts[shared_prefix_len(job, parts):] or [Part.from_text(text=CACHED_TURN)]
+    return [Content(role="user", parts=parts)]
+
+
+# Explicit context caching: the prefix every call of a study repeats (PDF, instructions and, for
+# a single shard, the metadata) is stored once per model as cachedContent and referenced by the
+# shard calls, the retry and later runs of this process on the same PDF.
+CONTEXT_CACHE_MODES = ("auto", "on", "off")
+CACHED_TURN = "Group the SPSS metadata provided above following the instructions."
+# Entries this close to expiry are recreated rather than referenced
+CACHE_EXPIRY_MARGIN_S = 60.0
+_context_caches: Dict[Tuple[str, str], Tuple[str, float]] = {}
+_context_caches_lock = threading.Lock()
+
+
+def pdf_digest(pdf_path: str) -> str:
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(model: str, job: Dict[str, Any], parts: List[Any]) -> Tuple[str, str]:
+    # The PDF counts by content, not upload URI, so a re-uploaded questionnaire still hits
+    h = hashlib.sha256()
+    for p in parts:
+        file_data = getattr(p, "file_data", None)
+        h.update((job["pdf_sha"] if file_data else p.text or "").encode("utf-8") + b"\0")
+    return model, h.hexdigest()
+
+
+def lookup_cache(key: Tuple[str, str]) -> Optional[str]:
+    with _context_caches_lock:
+        entry = _context_caches.get(key)
+        if entry is None:
+            return None
+        if entry[1] - time.time() < CACHE_EXPIRY_MARGIN_S:
+            del _context_caches[key]
+            return None
+        return entry[0]
+
+
+def forget_cache(name: str) -> None:
+    with _context_caches_lock:
+        for key in [k for k, v in _context_caches.items() if v[0] == name]:
+            del _context_caches[key]
+
+
+def prefix_tokens(job: Dict[str, Any], parts: List[Any]) -> int:
+    chars = sum(len(getattr(p, "text", None) or "") for p in parts)
+    return job["pdf_pages"] * TOKENS_PER_PDF_PAGE + int(chars / CHARS_PER_TOKEN)
+
+
+def cache_wanted(job: Dict[str, Any], model: str, mode: str, tokens: int, log: Callable[[str], None] = print) -> bool:
+    if mode == "off":
+        return False
+    minimum = int(MODEL_PROFILES.get(model, {}).get("min_cache_tokens", 0))
+    if tokens < minimum:
+        if mode == "on":
+            log(f"[cache] Shared prefix (~{tokens} tokens) is below the {model} minimum of {minimum}; sending it inline")
+        return False
+    # auto: only pays off when the prefix is sent more than once
+    return mode == "on" or len(job["shards"]) > 1
+
+
+def cache_config(parts: List[Any], ttl: float) -> "types.CreateCachedContentConfig":
+    return types.CreateCachedContentConfig(
+        contents=[Content(role="user", parts=parts)],
+        ttl=f"{int(ttl)}s",
+        display_name="step2-prefix",
+    )
+
+
+def remember_cache(key: Tuple[str, str], cached: Any, created: float, ttl: float, tokens: int, log: Callable[[str], None] = print) -> str:
+    with _context_caches_lock:
+        _context_caches[key] = (cached.name, created + ttl)
+    usage = getattr(cached, "usage_metadata", None)
+    tokens = getattr(usage, "total_token_count", None) or tokens
+    log(f"[cache] Cached {tokens} prefix tokens for {key[0]} as {cached.name} (ttl {int(ttl)}s)")
+    return cached.name
+
+
+def context_cache(
+    client: "genai.Client",
+    job: Dict[str, Any],
+    file_obj: Any,
+    model: str,
+    mode: str,
+    ttl: float,
+    log: Callable[[str], None] = print,
+) -> Optional[str]:
+    if mode == "off":
+        return None
+    parts = shard_parts(job, file_obj, 0)
+    parts = parts[:shared_prefix_len(job, parts)]
+    key = cache_key(model, job, parts)
+    name = lookup_cache(key)
+    tokens = prefix_tokens(job, parts)
+    if name or not cache_wanted(job, model, mode, tokens, log):
+        return name
+    created = time.time()
+    try:
+        cached = client.caches.create(model=model, config=cache_config(parts, ttl))
+    except Exception as exc:
+        log(f"[cache] Could not cache the shared prefix for {model}; sending it inline ({exc})")
+        return None
+    return remember_cache(key, cached, created, ttl, tokens, log)
+
+
+async def context_cache_async(
+    client: "genai.Client",
+    job: Dict[str, Any],
+    file_obj: Any,
+    model: str,
+    mode: str,
+    ttl: float,
+    log: Callable[[str], None] = print,
+) -> Optional[str]:
+    if mode == "off":
+        return None
+    parts = shard_parts(job, file_obj, 0)
+    parts = parts[:shared_prefix_len(job, parts)]
+    key = cache_key(model, job, parts)
+    name = lookup_cache(key)
+    tokens = prefix_tokens(job, parts)
+    if name or not cache_wanted(job, model, mode, tokens, log):
+        return name
+    created = time.time()
+    try:
+        cached = await client.aio.caches.create(model=model, config=cache_config(parts, ttl))
+    except Exception as exc:
+        log(f"[cache] Could not cache the shared prefix for {model}; sending it inline ({exc})")
+        return None
+    return remember_cache(key, cached, created, ttl, tokens, log)
+
+
+def cached_config(cfg: "types.GenerateContentConfig", cached: Optional[str]) -> "types.GenerateContentConfig":
+    return cfg.model_copy(update={"cached_content": cached}) if cached else cfg
+
+
+def add_usage(usage: Dict[str, int], resp: Any) -> None:
+    usage["calls"] += 1
+    meta = getattr(resp, "usage_metadata", None)
+    if meta is None:
+        return
+    usage["prompt"] += getattr(meta, "prompt_token_count", None) or 0
+    usage["cached"] += getattr(meta, "cached_content_token_count", None) or 0
+    usage["output"] += (getattr(meta, "candidates_token_count", None) or 0) + (getattr(meta, "thoughts_token_count", None) or 0)
+
+
+def describe_usage(usage: Dict[str, int]) -> str:
+    share = usage["cached"] / usage["prompt"] if usage["prompt"] else 0.0
+    return (
+        f"[usage] {usage['calls']} call(s): {usage['prompt']} prompt tokens "
+        f"({usage['cached']} from cache, {share:.0%}), {usage['output']} output tokens"
+    )
+
+
+def shard_suffix(index: int, total: int) -> str:
+    return f".shard{index + 1}" if total > 1 else ""
+
+
+def parse_shard(text: Any, output_path: str, index: int, total: int, log: Callable[[str], None] = print) -> List[Any]:
+    suffix = shard_suffix(index, total)
     if not isinstance(text, str) or not text.strip():
         # Write raw empty output marker and exit
-        try:
-            with open(args.output + ".raw.txt", "w", encoding="utf-8") as rf:
-                rf.write("(empty response)\n")
-        except Exception:
-            pass
-        print("[error] Model returned empty response.")
-        raise SystemExit(2)
-
-    # Extract JSON array safely (and helpers for robust recovery)
-    def extract_json_array_str(s: str) -> str:
-        start = s.find("[")
-        if start == -1:
-            raise ValueError("no '[' found")
-        depth = 0
-        for i in range(start, len(s)):
-            ch = s[i]
-            if ch == '[':
-                depth += 1
-            elif ch == ']':
-                depth -= 1
-                if depth == 0:
-                    return s[start:i+1]
-        raise ValueError("no matching ']' found")
-
-    def extract_code_fence(s: str) -> str:
-        tick = "```"
-        start = s.find(tick)
-        if start == -1:
-            return ""
-        # Skip optional language tag
-        lang_end = s.find("\n", start + len(tick))
-        if lang_end == -1:
-            return ""
-        end = s.find(tick, lang_end + 1)
-        if end == -1:
-            return ""
-        return s[lang_end + 1:end]
-
-    def extract_json_object_str(s: str) -> str:
-        start = s.find("{")
-        if start == -1:
-            raise ValueError("no '{' found")
-        depth = 0
-        for i in range(start, len(s)):
-            ch = s[i]
-            if ch == '{':
-                depth += 1
-            elif ch == '}':
-                depth -= 1
-                if depth == 0:
-                    return s[start:i+1]
-        raise ValueError("no matching '}' found")
-
-    def balance_brackets_fragment(fragment: str) -> str:
-        # Best-effort: count brackets/braces and append closing ones
-        open_sq = fragment.count('[')
-        close_sq = fragment.count(']')
-        open_br = fragment.count('{')
-        close_br = fragment.count('}')
-        balanced = fragment
-        # Close braces first, then brackets
-        balanced += '}' * max(0, open_br - close_br)
-        balanced += ']' * max(0, open_sq - balanced.count(']'))
-        return balanced
+        write_raw(output_path + suffix + ".raw.txt", "(empty response)\n")
+        log("[error] Model returned empty response.")
+        raise GroupingError("Model returned empty response.")
+    try:
+        return parse_grouped_json(text)
+    except ValueError as exc2:
+        write_raw(output_path + suffix + ".raw.txt", text)
+        log(f"[error] Failed to parse JSON array from model response: {exc2}")
+        raise GroupingError(f"Failed to parse JSON array from model response: {exc2}")
+
 
+def parse_retry_shard(text: Any, output_path: str, index: int, total: int) -> List[Any]:
+    if not isinstance(text, str) or not text.strip():
+        return []
     try:
-        data = json.loads(text)
-        if not isinstance(data, list):
-            raise ValueError("not a list")
-    except Exception:
-        # Try code-fenced content first
-        cf = extract_code_fence(text)
-        if cf:
+        return parse_grouped_json(text)
+    except ValueError:
+        # persist raw retry output
+        write_raw(output_path + shard_suffix(index, total) + ".retry.raw.txt", text)
+        return []
+
+
+def retry_config(plan: Dict[str, Any]) -> "types.GenerateContentConfig":
+    return generate_config(0.0, plan["retry_thinking_budget"])
+
+
+def resolve_retry(job: Dict[str, Any], data2: List[Any], fallback: bool, log: Callable[[str], None] = print) -> List[Any]:
+    if has_groups(data2):
+        return data2
+    if fallback:
+        log("[warn] No groups after retry; using heuristic fallback grouping.")
+        return heuristic_groups(job["full_meta"])
+    log("[error] Grouping produced no groups after retry. Aborting.")
+    raise GroupingError("Grouping produced no groups after retry.")
+
+
+def write_grouped(output_path: str, data: List[Any], log: Callable[[str], None] = print) -> None:
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    log(f"[group] Written grouped questions to: {output_path}")
+
+
+def finish_grouping(job: Dict[str, Any], output_path: str, data: List[Any], log: Callable[[str], None] = print) -> List[Any]:
+    if job["carried"]:
+        data = merge_carried(job["carried"], data, job["study_meta"])
+    write_grouped(output_path, data, log)
+    if job["template_index"]:
+        sid = TemplateIndex(job["template_index"]).add(job["study_meta"], data, source=output_path)
+        log(f"[template] Indexed this study as {sid}")
+    return data
+
+
+def reuse_upload(uploaded_path: Optional[str]) -> Any:
+    record = load_upload_record(uploaded_path) if uploaded_path else None
+    if record is None:
+        return None
+    # PDF already uploaded (e.g. concurrently with step1); reuse it
+    return types.File(name=record["name"], uri=record["uri"])
+
+
+def run_grouping(
+    pdf_path: str,
+    metadata_path: str,
+    output_path: str,
+    *,
+    api_key: str | None = None,
+    client: "genai.Client | None" = None,
+    model: str = "gemini-2.5-pro",
+    flash: bool = False,
+    fallback: bool = False,
+    auto: bool = False,
+    max_latency: Optional[float] = None,
+    max_cost: Optional[float] = None,
+    plan_path: Optional[str] = None,
+    uploaded_path: Optional[str] = None,
+    alignment_path: Optional[str] = None,
+    template_index_path: Optional[str] = None,
+    context_cache_mode: str = "auto",
+    cache_ttl: float = 600.0,
+) -> None:
+    if client is None:
+        api_key = api_key or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+        client = make_client(api_key)
+
+    job: Dict[str, Any] = {}
+    try:
+        job = prepare_grouping(
+            pdf_path,
+            metadata_path,
+            output_path,
+            model=model,
+            flash=flash,
+            auto=auto,
+            max_latency=max_latency,
+            max_cost=max_cost,
+            plan_path=plan_path,
+            alignment_path=alignment_path,
+            template_index_path=template_index_path,
+        )
+        plan = job["plan"]
+        shards = job["shards"]
+        if not shards:
+            finish_grouping(job, output_path, [])
+            return
+        file_obj = reuse_upload(uploaded_path) or upload_pdf(client, pdf_path)
+
+        def call_model(curr_model: str, cfg: "types.GenerateContentConfig", index: int, cached: Optional[str]) -> str:
             try:
-                data = json.loads(cf)
-                if isinstance(data, dict):
-                    data = [data]
-                if not isinstance(data, list):
-                    raise ValueError
-            except Exception:
-                pass
-        if 'data' not in locals():
+                resp = client.models.generate_content(
+                    model=curr_model,
+                    contents=build_parts(job, file_obj, index, cached),
+                    config=cached_config(cfg, cached),
+                )
+            except Exception as exc:
+                if not cached:
+                    raise
+                # Deleted or expired behind our back: send the prefix inline instead
+                print(f"[cache] {cached} unusable ({exc}); resending the prefix")
+                forget_cache(cached)
+                return call_model(curr_model, cfg, index, None)
+            add_usage(job["usage"], resp)
+            return getattr(resp, "text", "") or "[]"
+
+        generate_cfg = generate_config(plan["temperature"], plan["thinking_budget"])
+        cached = context_cache(client, job, file_obj, plan["model"], context_cache_mode, cache_ttl)
+        data: List[Any] = []
+        for index in range(len(shards)):
+            data.extend(parse_shard(call_model(plan["model"], generate_cfg, index, cached), output_path, index, len(shards)))
+
+        if not has_groups(job["carried"] + data):
+            # Retry once with alternate model/settings
             try:
-                snippet = extract_json_array_str(text)
-                data = json.loads(snippet)
-                if not isinstance(data, list):
-                    raise ValueError
-            except Exception:
-                # Try object top-level → wrap in list
-                try:
-                    obj = extract_json_object_str(text)
-                    obj_json = json.loads(obj)
-                    data = [obj_json]
-                except Exception:
-                    # Try balancing missing closers on array fragment
-                    try:
-                        start_idx = text.find('[')
-                        if start_idx != -1:
-                            frag = balance_brackets_fragment(text[start_idx:])
-                            data = json.loads(frag)
-                            if not isinstance(data, list):
-                                raise ValueError
-                        else:
-                            raise ValueError("no '[' found")
-                    except Exception as exc2:
-                        try:
-                            with open(args.output + ".raw.txt", "w", encoding="utf-8") as rf:
-                                rf.write(text)
-                        except Exception:
-                            pass
-                        print(f"[error] Failed to parse JSON array from model response: {exc2}")
-                        raise SystemExit(2)
-
-    # Warn if model returned no groups (or only standalones)
-    def has_groups(items: List[Dict[str, Any]]) -> bool:
-        for it in items:
-            if isinstance(it, dict):
-                subs = it.get("sub_questions")
-                if isinstance(subs, list) and len(subs) >= 2:
-                    return True
-        return False
+                alt_model = plan["retry_model"]
+                alt_cfg = retry_config(plan)
+                print(f"[warn] No groups found; retrying with {alt_model}…")
+                alt_cached = context_cache(client, job, file_obj, alt_model, context_cache_mode, cache_ttl)
+                data2: List[Any] = []
+                for index in range(len(shards)):
+                    data2.extend(parse_retry_shard(call_model(alt_model, alt_cfg, index, alt_cached), output_path, index, len(shards)))
+                data = resolve_retry(job, data2, fallback)
+            except GroupingError:
+                raise
+            except Exception as exc:
+                print(f"[error] Retry failed: {exc}")
+                raise GroupingError(f"Retry failed: {exc}")
+    except GroupingError as exc:
+        raise SystemExit(exc.code)
+    finally:
+        if job.get("usage", {}).get("calls"):
+            print(describe_usage(job["usage"]))
+
+    finish_grouping(job, output_path, data)
+
+
+async def delete_file_async(client: "genai.Client", name: Optional[str]) -> None:
+    if not name:
+        return
+    try:
+        await client.aio.files.delete(name=name)
+    except Exception:
+        pass
+
+
+async def upload_pdf_async(
+    client: "genai.Client",
+    pdf_path: str,
+    *,
+    timeout: float = 90.0,
+    poll_interval: float = 1.0,
+) -> Any:
+    file_obj = await client.aio.files.upload(file=pdf_path, config=UploadFileConfig(mime_type="application/pdf"))
+    name = getattr(file_obj, "name", None)
+
+    async def wait_active() -> Any:
+        while True:
+            refreshed = await client.aio.files.get(name=name)
+            if getattr(refreshed, "state", None) in ("ACTIVE", "SUCCEEDED", "READY"):
+                return refreshed
+            await asyncio.sleep(poll_interval)
+
+    try:
+        return await asyncio.wait_for(wait_active(), timeout)
+    except asyncio.TimeoutError:
+        await delete_file_async(client, name)
+        raise GroupingError("Timed out waiting for PDF to be ready.")
+    except asyncio.CancelledError:
+        await asyncio.shield(delete_file_async(client, name))
+        raise
+
+
+async def gather_or_cancel(*aws: Awaitable[Any]) -> List[Any]:
+    # Like asyncio.gather, but the first failure cancels the remaining shard calls
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run_grouping_async(
+    pdf_path: str,
+    metadata_path: str,
+    output_path: str,
+    *,
+    api_key: str | None = None,
+    client: "genai.Client | None" = None,
+    model: str = "gemini-2.5-pro",
+    flash: bool = False,
+    fallback: bool = False,
+    auto: bool = False,
+    max_latency: Optional[float] = None,
+    max_cost: Optional[float] = None,
+    plan_path: Optional[str] = None,
+    uploaded_path: Optional[str] = None,
+    alignment_path: Optional[str] = None,
+    template_index_path: Optional[str] = None,
+    context_cache_mode: str = "auto",
+    cache_ttl: float = 600.0,
+    upload_timeout: float = 90.0,
+    call_timeout: Optional[float] = 600.0,
+    log: Callable[[str], None] = print,
+) -> List[Any]:
+    # Same behaviour and outputs as run_grouping, but never blocks the event loop: shards run
+    # concurrently, waits use asyncio.sleep, and cancelling the task deletes a PDF it uploaded.
+    # Failures raise GroupingError.
+    if client is None:
+        api_key = api_key or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise GroupingError("Set --api-key or GOOGLE_API_KEY.", code=1)
+        client = make_client(api_key)
 
-    if not has_groups(data):
-        # Retry once with alternate model/settings
+    job = await asyncio.to_thread(
+        prepare_grouping,
+        pdf_path,
+        metadata_path,
+        output_path,
+        model=model,
+        flash=flash,
+        auto=auto,
+        max_latency=max_latency,
+        max_cost=max_cost,
+        plan_path=plan_path,
+        alignment_path=alignment_path,
+        template_index_path=template_index_path,
+        log=log,
+    )
+    plan = job["plan"]
+    shards = job["shards"]
+    if not shards:
+        return await asyncio.to_thread(finish_grouping, job, output_path, [], log)
+    file_obj = reuse_upload(uploaded_path)
+    uploaded_here = file_obj is None
+    if file_obj is None:
+        file_obj = await upload_pdf_async(client, pdf_path, timeout=upload_timeout)
+
+    async def call_model(curr_model: str, cfg: "types.GenerateContentConfig", index: int, cached: Optional[str]) -> str:
         try:
-            alt_model = "gemini-2.5-pro" if model_name == "gemini-2.5-flash" else "gemini-2.5-flash"
-            alt_cfg = types.GenerateContentConfig(
-                temperature=0.0,
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=1024,
-                    include_thoughts=False,
+            resp = await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=curr_model,
+                    contents=build_parts(job, file_obj, index, cached),
+                    config=cached_config(cfg, cached),
                 ),
+                call_timeout,
             )
-            print(f"[warn] No groups found; retrying with {alt_model}…")
-            text2 = call_model(alt_model, alt_cfg)
-            if not isinstance(text2, str) or not text2.strip():
-                data2 = []
-            else:
-                try:
-                    data2 = json.loads(text2)
-                    if not isinstance(data2, list):
-                        raise ValueError
-                except Exception:
-                    try:
-                        snippet2 = extract_json_array_str(text2)
-                        data2 = json.loads(snippet2)
-                        if not isinstance(data2, list):
-                            data2 = []
-                    except Exception:
-                        # persist raw retry output
-                        try:
-                            with open(args.output + ".retry.raw.txt", "w", encoding="utf-8") as rf:
-                                rf.write(text2)
-                        except Exception:
-                            pass
-                        data2 = []
-            if has_groups(data2):
-                data = data2
-            else:
-                if getattr(args, "fallback", False):
-                    print("[warn] No groups after retry; using heuristic fallback grouping.")
-                    # Heuristic fallback grouping by base prefix
-                    def compute_base(code: str) -> str:
-                        if "_" in code:
-                            parts = code.split("_")
-                            if len(parts) > 1:
-                                return "_".join(parts[:-1])
-                        import re
-                        m = re.match(r"^(.*?)([A-Za-z]?\d{1,3})$", code)
-                        return m.group(1) if m else code
-                    base_to_members: Dict[str, List[Dict[str, Any]]] = {}
-                    for q in full_meta:
-                        c = str(q.get("question_code", ""))
-                        if not c:
-                            continue
-                        b = compute_base(c)
-                        base_to_members.setdefault(b, []).append(q)
-                    grouped_items: List[Dict[str, Any]] = []
-                    for base, members in base_to_members.items():
-                        if len(members) >= 2:
-                            grouped_items.append({
-                                "question_code": f"{base}_GROUP",
-                                "question_text": base,
-                                "question_type": "multi-select",
-                                "sub_questions": [
-                                    {"question_code": m.get("question_code"), "possible_answers": m.get("possible_answers", {})}
-                                    for m in members
-                                ],
-                            })
-                    member_codes = {m.get("question_code") for members in base_to_members.values() if len(members) >= 2 for m in members}
-                    for q in full_meta:
-                        c = q.get("question_code")
-                        if c in member_codes:
-                            continue
-                        pa = q.get("possible_answers")
-                        qtype = "integer" if isinstance(pa, dict) and set(pa.keys()) == {"min", "max"} else "single-select"
-                        grouped_items.append({
-                            "question_code": c,
-                            "question_text": q.get("question_text"),
-                            "question_type": qtype,
-                            "possible_answers": pa,
-                        })
-                    data = grouped_items
-                else:
-                    print("[error] Grouping produced no groups after retry. Aborting.")
-                    raise SystemExit(2)
-        except SystemExit:
-            raise
+        except asyncio.TimeoutError:
+            log(f"[error] {curr_model} call timed out after {call_timeout}s")
+            raise GroupingError(f"{curr_model} call timed out after {call_timeout}s")
         except Exception as exc:
-            print(f"[error] Retry failed: {exc}")
-            raise SystemExit(2)
+            if not cached:
+                raise
+            log(f"[cache] {cached} unusable ({exc}); resending the prefix")
+            forget_cache(cached)
+            return await call_model(curr_model, cfg, index, None)
+        add_usage(job["usage"], resp)
+        return getattr(resp, "text", "") or "[]"
 
-    with open(args.output, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"[group] Written grouped questions to: {args.output}")
+    try:
+        generate_cfg = generate_config(plan["temperature"], plan["thinking_budget"])
+        cached = await context_cache_async(client, job, file_obj, plan["model"], context_cache_mode, cache_ttl, log)
+        texts = await gather_or_cancel(*(call_model(plan["model"], generate_cfg, i, cached) for i in range(len(shards))))
+        data: List[Any] = []
+        for index, text in enumerate(texts):
+            data.extend(parse_shard(text, output_path, index, len(shards), log))
+
+        if not has_groups(job["carried"] + data):
+            try:
+                alt_model = plan["retry_model"]
+                alt_cfg = retry_config(plan)
+                log(f"[warn] No groups found; retrying with {alt_model}…")
+                alt_cached = await context_cache_async(client, job, file_obj, alt_model, context_cache_mode, cache_ttl, log)
+                texts2 = await gather_or_cancel(*(call_model(alt_model, alt_cfg, i, alt_cached) for i in range(len(shards))))
+                data2: List[Any] = []
+                for index, text in enumerate(texts2):
+                    data2.extend(parse_retry_shard(text, output_path, index, len(shards)))
+                data = resolve_retry(job, data2, fallback, log)
+            except GroupingError:
+                raise
+            except Exception as exc:
+                log(f"[error] Retry failed: {exc}")
+                raise GroupingError(f"Retry failed: {exc}")
+    except asyncio.CancelledError:
+        if uploaded_here:
+            await asyncio.shield(delete_file_async(client, getattr(file_obj, "name", None)))
+        raise
+    finally:
+        if job["usage"]["calls"]:
+            log(describe_usage(job["usage"]))
+
+    return await asyncio.to_thread(finish_grouping, job, output_path, data, log)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Group metadata using the questionnaire PDF + SPSS metadata in a single Gemini call."
+    )
+    parser.add_argument("--pdf", required=True, help="Path to the questionnaire PDF")
+    parser.add_argument("--metadata", help="Path to metadata questions JSON (from step1)")
+    parser.add_argument("--output", required=True, help="Path to write the combined grouped JSON")
+    parser.add_argument("--model", default="gemini-2.5-pro")
+    parser.add_argument("--api-key", dest="api_key")
+    parser.add_argument("--fallback", action="store_true", help="If no groups from API, emit heuristic prefix-based groups instead of failing")
+    parser.add_argument("--flash", action="store_true", help="Use Gemini 2.5 Flash with higher thinking budget (4096)")
+    parser.add_argument("--auto", action="store_true", help="Pick model, thinking budget and sharding from the study size (overrides --model/--flash)")
+    parser.add_argument("--max-latency", type=float, help="With --auto: target wall time in seconds for the model calls")
+    parser.add_argument("--max-cost", type=float, help="With --auto: target cost in USD for the model calls")
+    parser.add_argument("--plan", dest="plan_path", help="Replay a saved <output>.plan.json instead of planning")
+    parser.add_argument("--upload-only", action="store_true", help="Only upload the PDF, wait for ACTIVE and write an upload record to --output")
+    parser.add_argument("--uploaded", dest="uploaded_path", help="Reuse the PDF from an upload record written by --upload-only")
+    parser.add_argument("--alignment", dest="alignment_path", help="align_text.py output: send stem clusters as hints and keep them within one shard")
+    parser.add_argument("--template-index", dest="template_index_path", help="template_index.py directory: reuse items of matching earlier studies, group only the rest, then index this study")
+    parser.add_argument("--context-cache", dest="context_cache_mode", choices=CONTEXT_CACHE_MODES, default="auto", help="Cache the PDF + instructions prefix shared by calls: auto (when sent more than once), on, off")
+    parser.add_argument("--cache-ttl", type=float, default=600.0, help="Seconds a context cache lives (default: 600)")
+
+    add_profile_argument(parser)
+    args = parser.parse_args()
+
+    with profiled("upload" if args.upload_only else "step2", args.profile):
+        api_key = args.api_key or os.environ.get("GOOGLE_API_KEY") or ""
+        if not api_key:
+            raise SystemExit("Set --api-key or GOOGLE_API_KEY.")
+
+        if args.upload_only:
+            run_upload(args.pdf, args.output, api_key=api_key)
+            return
+        if not args.metadata:
+            parser.error("--metadata is required unless --upload-only is given")
+
+        run_grouping(
+            args.pdf,
+            args.metadata,
+            args.output,
+            api_key=api_key,
+            model=args.model,
+            flash=args.flash,
+            fallback=args.fallback,
+            auto=args.auto,
+            max_latency=args.max_latency,
+            max_cost=args.max_cost,
+            plan_path=args.plan_path,
+            uploaded_path=args.uploaded_path,
+            alignment_path=args.alignment_path,
+            template_index_path=args.template_index_path,
+            context_cache_mode=args.context_cache_mode,
+            cache_ttl=args.cache_ttl,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+import json
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+PLANNER_VERSION = 1
+
+# Rough public figures per model; only relative values matter for the decision.
+# price: USD per 1M tokens (output includes thinking); speed: output tokens per second;
+# min_cache_tokens: smallest prefix the API accepts as explicit cached content
+MODEL_PROFILES: Dict[str, Dict[str, float]] = {
+    "gemini-2.5-flash": {
+        "input_price": 0.30,
+        "output_price": 2.50,
+        "speed": 220.0,
+        "max_output": 65536,
+        "min_budget": 0,
+        "max_budget": 24576,
+        "temperature": 0.1,
+        "quality": 1,
+        "min_cache_tokens": 1024,
+    },
+    "gemini-2.5-pro": {
+        "input_price": 1.25,
+        "output_price": 10.00,
+        "speed": 90.0,
+        "max_output": 65536,
+        "min_budget": 128,
+        "max_budget": 32768,
+        "temperature": 0.0,
+        "quality": 2,
+        "min_cache_tokens": 4096,
+    },
+}
+
+TOKENS_PER_PDF_PAGE = 258
+CHARS_PER_TOKEN = 3.5
+# Per-request latency that does not depend on output size (upload already done, prefill, queueing)
+BASE_LATENCY_S = 4.0
+# Keep shard outputs well below the model cap so thinking + JSON never truncates
+SHARD_OUTPUT_FRACTION = 0.5
+SMALL_STUDY_VARS = 60
+
+
+def compute_base(code: str) -> str:
+    if "_" in code:
+        parts = code.split("_")
+        if len(parts) > 1:
+            return "_".join(parts[:-1])
+    m = re.match(r"^(.*?)([A-Za-z]?\d{1,3})$", code)
+    return m.group(1) if m else code
+
+
+def pdf_page_count(pdf_path: str) -> int:
+    try:
+        import fitz  # PyMuPDF
+
+        with fitz.open(pdf_path) as doc:
+            return int(doc.page_count)
+    except Exception:
+        with open(pdf_path, "rb") as f:
+            return max(1, len(re.findall(rb"/Type\s*/Page[^s]", f.read())))
+
+
+def estimate_output_tokens(full_meta: List[Dict[str, Any]]) -> List[int]:
+    # The model echoes code, type and possible_answers for every variable
+    sizes: List[int] = []
+    for q in full_meta:
+        item = {
+            "question_code": q.get("question_code"),
+            "question_type": "single-select",
+            "possible_answers": q.get("possible_answers"),
+        }
+        sizes.append(int(len(json.dumps(item, ensure_ascii=False)) / CHARS_PER_TOKEN) + 4)
+    return sizes
+
+
+def thinking_budget_for(model: str, n_vars: int) -> int:
+    profile = MODEL_PROFILES[model]
+    # ~2 thinking tokens per variable for flash, 4 for pro, rounded to powers of two
+    per_var = 2 if model == "gemini-2.5-flash" else 4
+    raw = max(256, per_var * n_vars)
+    budget = 1 << int(math.ceil(math.log2(raw)))
+    return int(min(max(budget, profile["min_budget"]), profile["max_budget"]))
+
+
+def split_shards(
+    codes: List[str],
+    sizes: List[int],
+    limit: int,
+    clusters: Optional[List[str]] = None,
+) -> List[Tuple[int, int]]:
+    # Contiguous [start, end) ranges under `limit` output tokens, cut only where the code stem
+    # changes; with `clusters` (align_text.py stem clusters per code) also never inside a cluster
+    shards: List[Tuple[int, int]] = []
+    start = 0
+    total = 0
+    for i, size in enumerate(sizes):
+        boundary = compute_base(codes[i]) != compute_base(codes[i - 1]) if i else False
+        if clusters is not None and i:
+            boundary = boundary and clusters[i] != clusters[i - 1]
+        if i > start and total + size > limit and boundary:
+            shards.append((start, i))
+            start, total = i, 0
+        total += size
+    if start < len(sizes) or not shards:
+        shards.append((start, len(sizes)))
+    return shards
+
+
+def estimate_config(model: str, input_tokens: int, output_sizes: List[int], shards: List[Tuple[int, int]]) -> Dict[str, Any]:
+    profile = MODEL_PROFILES[model]
+    latency = 0.0
+    cost = 0.0
+    budgets: List[int] = []
+    for start, end in shards:
+        out = sum(output_sizes[start:end])
+        budget = thinking_budget_for(model, end - start)
+        budgets.append(budget)
+        latency += BASE_LATENCY_S + (out + budget) / profile["speed"]
+        cost += input_tokens * profile["input_price"] / 1e6 + (out + budget) * profile["output_price"] / 1e6
+    return {
+        "model": model,
+        "thinking_budget": max(budgets),
+        "est_latency_s": round(latency, 1),
+        "est_cost_usd": round(cost, 4),
+    }
+
+
+def make_plan(
+    compact_items: List[Dict[str, Any]],
+    full_meta: List[Dict[str, Any]],
+    *,
+    pdf_pages: int,
+    prompt_chars: int,
+    max_latency: Optional[float] = None,
+    max_cost: Optional[float] = None,
+    clusters: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    n_vars = len(compact_items)
+    codes = [str(q.get("question_code", "")) for q in compact_items]
+    compact_tokens = int(len(json.dumps(compact_items, ensure_ascii=False)) / CHARS_PER_TOKEN)
+    input_tokens = compact_tokens + int(prompt_chars / CHARS_PER_TOKEN) + pdf_pages * TOKENS_PER_PDF_PAGE
+    output_sizes = estimate_output_tokens(full_meta[:n_vars])
+    output_tokens = sum(output_sizes)
+
+    limit = int(min(p["max_output"] for p in MODEL_PROFILES.values()) * SHARD_OUTPUT_FRACTION)
+    shards = split_shards(codes, output_sizes, limit, clusters)
+
+    candidates = [estimate_config(m, input_tokens, output_sizes, shards) for m in MODEL_PROFILES]
+    meets = [
+        c for c in candidates
+        if (max_latency is None or c["est_latency_s"] <= max_latency)
+        and (max_cost is None or c["est_cost_usd"] <= max_cost)
+    ]
+    if meets:
+        if n_vars <= SMALL_STUDY_VARS and max_latency is None and max_cost is None:
+            # Tiny studies: the fast model groups them reliably, pro only adds latency
+            chosen = min(meets, key=lambda c: c["est_latency_s"])
+            reason = f"small study ({n_vars} vars)"
+        else:
+            chosen = max(meets, key=lambda c: (MODEL_PROFILES[c["model"]]["quality"], -c["est_latency_s"]))
+            reason = "best quality within targets"
+    else:
+        chosen = min(candidates, key=lambda c: (c["est_latency_s"], c["est_cost_usd"]))
+        reason = "no config meets targets; fastest"
+
+    retry_model = "gemini-2.5-pro" if chosen["model"] == "gemini-2.5-flash" else "gemini-2.5-flash"
+    return {
+        "planner_version": PLANNER_VERSION,
+        "inputs": {
+            "variables": n_vars,
+            "pdf_pages": pdf_pages,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "max_latency_s": max_latency,
+            "max_cost_usd": max_cost,
+            "stem_clusters": clusters is not None,
+        },
+        "candidates": candidates,
+        "reason": reason,
+        "model": chosen["model"],
+        "temperature": MODEL_PROFILES[chosen["model"]]["temperature"],
+        "thinking_budget": chosen["thinking_budget"],
+        "retry_model": retry_model,
+        "retry_thinking_budget": thinking_budget_for(retry_model, max(e - s for s, e in shards)),
+        "shards": [[s, e] for s, e in shards],
+        "est_latency_s": chosen["est_latency_s"],
+        "est_cost_usd": chosen["est_cost_usd"],
+    }
+
+
+def manual_plan(model: str, flash: bool, n_items: int, *, cap: int = 1200) -> Dict[str, Any]:
+    # The historical fixed settings: --flash or the given model, one call, capped metadata
+    model_name = "gemini-2.5-flash" if flash else model
+    return {
+        "planner_version": PLANNER_VERSION,
+        "reason": "manual",
+        "model": model_name,
+        "temperature": 0.1 if flash else 0.0,
+        "thinking_budget": 256 if flash else 1024,
+        "retry_model": "gemini-2.5-pro" if model_name == "gemini-2.5-flash" else "gemini-2.5-flash",
+        "retry_thinking_budget": 1024,
+        "shards": [[0, min(n_items, cap)]],
+    }
+
+
+def describe_plan(plan: Dict[str, Any]) -> str:
+    shards = plan.get("shards") or []
+    parts = [
+        f"model={plan.get('model')}",
+        f"thinking_budget={plan.get('thinking_budget')}",
+        f"shards={len(shards)}",
+        f"reason={plan.get('reason')}",
+    ]
+    if "est_latency_s" in plan:
+        parts.append(f"est_latency={plan['est_latency_s']}s")
+        parts.append(f"est_cost=${plan['est_cost_usd']}")
+    return " ".join(parts)
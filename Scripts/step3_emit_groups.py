@@ -3,7 +3,14 @@ import argparse
 import hashlib
 import json
 import os
-from typing import Any, Dict, List
+import sys
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from column_index import build_index, write_index, write_index_parquet  # noqa: E402
+from profiling import add_profile_argument, profiled  # noqa: E402
+from qmodel import groups_from_json  # noqa: E402
 
 
 def load_json(path: str) -> Any:
@@ -11,81 +18,242 @@ def load_json(path: str) -> Any:
         return json.load(f)
 
 
-def emit_groups_and_recodes(grouped_items: List[Dict[str, Any]], *, min_columns: int = 2) -> Dict[str, Any]:
+def group_id(columns: List[str]) -> str:
+    # Derived from the member set, so a group keeps its id when other groups come and go
+    key = json.dumps({"c": sorted(columns)}, sort_keys=True)
+    return "group_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:10]
+
+
+def emit_groups_and_recodes(
+    grouped_items: List[Dict[str, Any]],
+    *,
+    min_columns: int = 2,
+    detected_recodes: Optional[List[Dict[str, Any]]] = None,
+    recode_mode: str = "verify",
+) -> Dict[str, Any]:
     groups: List[Dict[str, Any]] = []
     recodings: List[Dict[str, Any]] = []
-    gid = 0
+    seen_ids: Set[str] = set()
 
-    def add_recode_entry(target_code: str, question_text: str, sources: List[str]) -> None:
+    # Data-driven recodes (from detect_recodes.py) keyed by target code
+    detected: Dict[str, Set[str]] = {}
+    for d in detected_recodes or []:
+        if isinstance(d, dict) and d.get("target"):
+            srcs = set(str(s) for s in d.get("sources", []) or [])
+            srcs.update(str(s) for s in d.get("alternatives", []) or [])
+            detected[str(d["target"])] = srcs
+
+    def add_recode_entry(target_code: str, question_text: str, sources: List[str], origin: str = "llm") -> None:
         try:
             key = json.dumps({"t": target_code, "s": sorted(sources)}, sort_keys=True)
         except Exception:
             key = target_code + "|" + ",".join(sorted(sources))
         hid = hashlib.sha1(key.encode("utf-8")).hexdigest()[:10]
-        recodings.append({
+        entry: Dict[str, Any] = {
             "id": hid,
             "name": target_code,
             "codes": sources,
             # recode should be only the variable name for downstream algo
             "recode": target_code,
-        })
+        }
+        if detected_recodes is not None:
+            if origin == "data":
+                entry["origin"] = "data"
+            else:
+                # verified when the data shows the target is a function of one of the proposed sources
+                entry["verified"] = bool(detected.get(target_code, set()) & set(sources))
+        recodings.append(entry)
 
-    for item in grouped_items:
-        if not isinstance(item, dict):
-            continue
+    for item in groups_from_json(grouped_items):
         # collect group-level recode if present
-        if isinstance(item.get("recode_from"), list) and item.get("question_code"):
-            add_recode_entry(
-                str(item.get("question_code")),
-                str(item.get("question_text", item.get("question_code", ""))),
-                [str(s) for s in item.get("recode_from", [])],
-            )
-
-        # build groups list
-        subs = item.get("sub_questions")
-        if isinstance(subs, list) and len(subs) >= min_columns:
+        if item.recode_from is not None and item.code:
+            add_recode_entry(item.code, item.display_name(""), list(item.recode_from))
+
+        # build groups list; standalone items only contribute the recode captured above
+        if item.subs is not None and len(item.subs) >= min_columns:
             columns: List[str] = []
-            for sq in subs:
-                if isinstance(sq, dict):
-                    scode = sq.get("question_code")
-                    if isinstance(scode, str):
-                        columns.append(scode)
+            for sq in item.subs:
+                if sq.code is not None:
+                    columns.append(sq.code)
                     # sub-question recode
-                    if isinstance(sq.get("recode_from"), list) and isinstance(scode, str):
-                        add_recode_entry(
-                            scode,
-                            str(item.get("question_text", scode)),
-                            [str(s) for s in sq.get("recode_from", [])],
-                        )
+                    if sq.recode_from is not None:
+                        add_recode_entry(sq.code, item.text if item.text is not None else sq.code, list(sq.recode_from))
             if len(columns) >= min_columns:
+                gid = group_id(columns)
+                if gid in seen_ids:
+                    # The same member set emitted twice; suffix in order of appearance
+                    n = 2
+                    while f"{gid}-{n}" in seen_ids:
+                        n += 1
+                    gid = f"{gid}-{n}"
+                seen_ids.add(gid)
                 groups.append({
-                    "id": f"group_{gid}",
-                    "name": str(item.get("question_text", item.get("question_code", f"group_{gid}"))),
+                    "id": gid,
+                    "name": item.display_name(gid),
                     "columns": columns,
                 })
-                gid += 1
-        else:
-            # standalone sub-question list is absent; check item itself for being standalone recode captured above
-            pass
+
+    if recode_mode == "add":
+        known = {r["name"] for r in recodings}
+        for d in detected_recodes or []:
+            target = str(d.get("target", "")) if isinstance(d, dict) else ""
+            if target and target not in known:
+                add_recode_entry(target, target, [str(s) for s in d.get("sources", [])], origin="data")
+                known.add(target)
 
     return {"groups": groups, "recodings": recodings}
 
 
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def member_keys(groups: List[Dict[str, Any]]) -> Dict[Tuple[Tuple[str, ...], int], Dict[str, Any]]:
+    # (sorted members, occurrence) per group: the n-th group with a member set matches the n-th
+    # one on the other side, like the "-n" id suffixes
+    keyed: Dict[Tuple[Tuple[str, ...], int], Dict[str, Any]] = {}
+    counts: Dict[Tuple[str, ...], int] = {}
+    for g in groups:
+        if not isinstance(g, dict):
+            continue
+        members = tuple(sorted(str(c) for c in g.get("columns", [])))
+        counts[members] = counts.get(members, 0) + 1
+        keyed[(members, counts[members])] = g
+    return keyed
+
+
+def groups_delta(previous: List[Dict[str, Any]], current: List[Dict[str, Any]], *, min_overlap: float = 0.5) -> Dict[str, Any]:
+    # Groups are keyed by their members, not their stored id, so files written with positional
+    # ids diff just as well. A removed and an added group with the same name, or else with at
+    # least min_overlap Jaccard overlap, are reported as one changed group. A group whose members
+    # stayed but whose id moved (positional ids from older files) counts as changed too, since
+    # downstream caches are keyed on the id.
+    prev = member_keys(previous)
+    curr = member_keys(current)
+    changed: List[Dict[str, Any]] = []
+    for key in [k for k in curr if k in prev]:
+        if prev[key].get("name") != curr[key]["name"] or prev[key].get("id") != curr[key]["id"]:
+            changed.append({
+                "id": curr[key]["id"],
+                "previous_id": prev[key].get("id"),
+                "name": curr[key]["name"],
+                "previous_name": prev[key].get("name"),
+                "columns_added": [],
+                "columns_removed": [],
+            })
+    removed = [k for k in prev if k not in curr]
+    added = [k for k in curr if k not in prev]
+    unmatched_added: List[str] = []
+    for key in added:
+        cols = set(curr[key]["columns"])
+        same_name = [k for k in removed if prev[k].get("name") == curr[key]["name"]]
+        candidates = same_name or [k for k in removed if jaccard(cols, set(map(str, prev[k].get("columns", [])))) >= min_overlap]
+        if not candidates:
+            unmatched_added.append(key)
+            continue
+        old = max(candidates, key=lambda k: jaccard(cols, set(map(str, prev[k].get("columns", [])))))
+        removed.remove(old)
+        old_cols = [str(c) for c in prev[old].get("columns", [])]
+        changed.append({
+            "id": curr[key]["id"],
+            "previous_id": prev[old].get("id"),
+            "name": curr[key]["name"],
+            "previous_name": prev[old].get("name"),
+            "columns_added": [c for c in curr[key]["columns"] if c not in set(old_cols)],
+            "columns_removed": [c for c in old_cols if c not in cols],
+        })
+    return {
+        "added": [curr[k] for k in unmatched_added],
+        "removed": [prev[k] for k in removed],
+        "changed": changed,
+        "unchanged": len(curr) - len(unmatched_added) - len(changed),
+    }
+
+
+def emit_groups_file(
+    input_path: str,
+    output_path: str,
+    *,
+    min_columns: int = 2,
+    recodes_path: Optional[str] = None,
+    recode_mode: str = "verify",
+    index_output: Optional[str] = None,
+    index_parquet: Optional[str] = None,
+    previous_path: Optional[str] = None,
+    delta_output: Optional[str] = None,
+) -> Dict[str, Any]:
+    data = load_json(input_path)
+    # Read before writing: the previous file is often the output path itself
+    previous = None
+    if previous_path and os.path.exists(previous_path):
+        prev_obj = load_json(previous_path)
+        previous = prev_obj.get("groups", []) if isinstance(prev_obj, dict) else []
+    if not isinstance(data, list):
+        raise SystemExit("Input must be a JSON array")
+    detected = load_json(recodes_path) if recodes_path else None
+    if detected is not None and not isinstance(detected, list):
+        raise SystemExit("Recodes input must be a JSON array")
+    out = emit_groups_and_recodes(
+        data,
+        min_columns=min_columns,
+        detected_recodes=detected,
+        recode_mode=recode_mode,
+    )
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(out, f, ensure_ascii=False, indent=2)
+    print(f"[groups] Written: {output_path}")
+    if previous is not None:
+        delta = groups_delta(previous, out["groups"])
+        delta_path = delta_output or os.path.splitext(output_path)[0] + ".delta.json"
+        with open(delta_path, "w", encoding="utf-8") as f:
+            json.dump(delta, f, ensure_ascii=False, indent=2)
+        print(
+            f"[groups] Delta vs {os.path.basename(previous_path or '')}: {len(delta['added'])} added, "
+            f"{len(delta['removed'])} removed, {len(delta['changed'])} changed, {delta['unchanged']} unchanged: {delta_path}"
+        )
+    if index_output or index_parquet:
+        index = build_index(out)
+        if index_output:
+            write_index(index, index_output)
+            print(f"[groups] Column index ({len(index['columns'])} columns): {index_output}")
+        if index_parquet:
+            write_index_parquet(index, index_parquet)
+            print(f"[groups] Column index table: {index_parquet}")
+    return out
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Emit compact groups JSON from step2 grouped questions JSON.")
     parser.add_argument("--input", required=True, help="Path to step2_grouped_questions.json")
     parser.add_argument("--output", required=True, help="Path to write groups JSON (with key 'groups')")
     parser.add_argument("--min-columns", type=int, default=2)
+    parser.add_argument("--recodes", help="Optional detect_recodes.py output used to verify or extend LLM recodes")
+    parser.add_argument(
+        "--recode-mode",
+        choices=["verify", "add"],
+        default="verify",
+        help="verify: flag LLM recodes confirmed by the data; add: also emit data-detected recodes the LLM missed",
+    )
+    parser.add_argument("--index-output", help="Also write a column -> group/recode lookup index (column_index.py) as JSON")
+    parser.add_argument("--index-parquet", help="Also write the lookup index as a Parquet table (needs pyarrow)")
+    parser.add_argument("--previous", help="Earlier step3 groups JSON (may be --output itself) to diff against")
+    parser.add_argument("--delta-output", help="Where to write the delta from --previous (default: <output>.delta.json)")
+    add_profile_argument(parser)
     args = parser.parse_args()
 
-    data = load_json(args.input)
-    if not isinstance(data, list):
-        raise SystemExit("Input must be a JSON array")
-    out = emit_groups_and_recodes(data, min_columns=args.min_columns)
-    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
-    with open(args.output, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
-    print(f"[groups] Written: {args.output}")
+    with profiled("step3", args.profile):
+        emit_groups_file(
+            args.input,
+            args.output,
+            min_columns=args.min_columns,
+            recodes_path=args.recodes,
+            recode_mode=args.recode_mode,
+            index_output=args.index_output,
+            index_parquet=args.index_parquet,
+            previous_path=args.previous,
+            delta_output=args.delta_output,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import numpy as np  # noqa: E402
+
+from align_text import fold  # noqa: E402
+
+# Index of past step2 results for studies built from the same vendor template.
+#
+#   <root>/index.json           per study: name, source, MinHash over variable signatures
+#   <root>/studies/<id>.json    per study: variable fingerprints and the grouped items
+#
+# A signature is (code pattern, label-set hash), e.g. "A#r#|3f1c..." for A07r4 with Yes/No
+# answers, so renumbered or reworded studies of one template still look alike. LSH banding over
+# the MinHash finds neighbours without scanning every study; carrying groups over then requires
+# exact fingerprints (code, label and answers) for every member.
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Output", "template_index")
+NUM_PERM = 128
+BANDS = 32
+MIN_SIMILARITY = 0.5
+MAX_NEIGHBOURS = 3
+_MERSENNE = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_process_lock = threading.Lock()
+_digits = re.compile(r"\d+")
+
+
+def _make_perms(n: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    # Fixed seed: stored MinHashes stay comparable across processes and releases.
+    # a, b < 2^31 and 32-bit inputs keep a * x + b inside uint64.
+    a, b = [], []
+    for i in range(n):
+        h = hashlib.blake2b(f"perm{i}".encode("ascii"), digest_size=8).digest()
+        a.append(int.from_bytes(h[:4], "big") % (1 << 31) or 1)
+        b.append(int.from_bytes(h[4:], "big") % (1 << 31))
+    return np.array(a, dtype=np.uint64)[:, None], np.array(b, dtype=np.uint64)[:, None]
+
+
+_PERM_A, _PERM_B = _make_perms(NUM_PERM)
+
+
+def _hash32(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=4).digest(), "big")
+
+
+def code_pattern(code: str) -> str:
+    return _digits.sub("#", code)
+
+
+def answers_key(answers: Any) -> List[Tuple[str, str]]:
+    if not isinstance(answers, dict):
+        return []
+    return sorted((str(k), fold(str(v))) for k, v in answers.items())
+
+
+def label_set_hash(answers: Any) -> str:
+    return hashlib.sha1(json.dumps(answers_key(answers)).encode("utf-8")).hexdigest()[:12]
+
+
+def signature(q: Dict[str, Any]) -> str:
+    return f"{code_pattern(str(q.get('question_code', '')))}|{label_set_hash(q.get('possible_answers'))}"
+
+
+def fingerprint(q: Dict[str, Any]) -> str:
+    payload = [str(q.get("question_code", "")), fold(str(q.get("question_text") or "")), answers_key(q.get("possible_answers"))]
+    return hashlib.sha1(json.dumps(payload).encode("utf-8")).hexdigest()[:16]
+
+
+def minhash(signatures: Set[str]) -> List[int]:
+    if not signatures:
+        return [_MAX_HASH] * NUM_PERM
+    x = np.fromiter((_hash32(s) for s in signatures), dtype=np.uint64, count=len(signatures))[None, :]
+    hashed = ((_PERM_A * x + _PERM_B) % np.uint64(_MERSENNE)) & np.uint64(_MAX_HASH)
+    return [int(v) for v in hashed.min(axis=1)]
+
+
+def similarity(m1: List[int], m2: List[int]) -> float:
+    return sum(1 for x, y in zip(m1, m2) if x == y) / max(1, len(m1))
+
+
+def band_keys(mh: List[int]) -> List[Tuple[int, Tuple[int, ...]]]:
+    rows = len(mh) // BANDS
+    return [(b, tuple(mh[b * rows:(b + 1) * rows])) for b in range(BANDS)]
+
+
+def item_members(item: Dict[str, Any]) -> List[str]:
+    subs = item.get("sub_questions")
+    if isinstance(subs, list) and subs:
+        return [str(s.get("question_code", "")) for s in subs if isinstance(s, dict)]
+    return [str(item.get("question_code", ""))]
+
+
+class TemplateMatch(NamedTuple):
+    carried: List[Dict[str, Any]]
+    # Codes resolved by a previous study: members of carried items, or excluded there as well
+    covered: Set[str]
+    neighbours: List[Tuple[str, float]]
+
+
+def _write_json(path: str, payload: Any) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class TemplateIndex:
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = os.path.abspath(root or DEFAULT_ROOT)
+        self.studies_dir = os.path.join(self.root, "studies")
+        os.makedirs(self.studies_dir, exist_ok=True)
+        self.index_path = os.path.join(self.root, "index.json")
+        self.studies: Dict[str, Dict[str, Any]] = {}
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[str]] = {}
+        self.reload()
+
+    def reload(self) -> None:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.studies = json.load(f).get("studies", {})
+        except (OSError, ValueError):
+            self.studies = {}
+        self.buckets = {}
+        for sid, entry in self.studies.items():
+            for key in band_keys(entry["minhash"]):
+                self.buckets.setdefault(key, []).append(sid)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with _process_lock:
+            try:
+                import fcntl
+            except ImportError:
+                yield
+                return
+            with open(os.path.join(self.root, ".lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, metadata: List[Dict[str, Any]], grouped: List[Any], *, name: str = "", source: str = "") -> str:
+        variables = {str(q.get("question_code", "")): fingerprint(q) for q in metadata if q.get("question_code")}
+        # Same metadata -> same id, so re-adding a study replaces its groups
+        sid = hashlib.sha1("\n".join(f"{c}|{fp}" for c, fp in sorted(variables.items())).encode("utf-8")).hexdigest()[:16]
+        body = {"variables": variables, "groups": [it for it in grouped if isinstance(it, dict)]}
+        entry = {
+            "name": name or (os.path.basename(os.path.dirname(os.path.abspath(source))) if source else ""),
+            "source": os.path.abspath(source) if source else "",
+            "added": time.time(),
+            "variables": len(variables),
+            "minhash": minhash({signature(q) for q in metadata if q.get("question_code")}),
+        }
+        with self._locked():
+            _write_json(os.path.join(self.studies_dir, sid + ".json"), body)
+            self.reload()
+            self.studies[sid] = entry
+            _write_json(self.index_path, {"num_perm": NUM_PERM, "bands": BANDS, "studies": self.studies})
+            self.reload()
+        return sid
+
+    def remove(self, sid: str) -> bool:
+        with self._locked():
+            self.reload()
+            if self.studies.pop(sid, None) is None:
+                return False
+            _write_json(self.index_path, {"num_perm": NUM_PERM, "bands": BANDS, "studies": self.studies})
+            try:
+                os.remove(os.path.join(self.studies_dir, sid + ".json"))
+            except OSError:
+                pass
+            self.reload()
+        return True
+
+    def load_study(self, sid: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.studies_dir, sid + ".json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def neighbours(
+        self,
+        metadata: List[Dict[str, Any]],
+        *,
+        limit: int = MAX_NEIGHBOURS,
+        min_similarity: float = MIN_SIMILARITY,
+    ) -> List[Tuple[str, float]]:
+        mh = minhash({signature(q) for q in metadata if q.get("question_code")})
+        candidates: Set[str] = set()
+        for key in band_keys(mh):
+            candidates.update(self.buckets.get(key, ()))
+        scored = [(sid, similarity(mh, self.studies[sid]["minhash"])) for sid in candidates]
+        scored = [(sid, s) for sid, s in scored if s >= min_similarity]
+        scored.sort(key=lambda kv: (-kv[1], -self.studies[kv[0]].get("added", 0.0)))
+        return scored[:limit]
+
+    def match(
+        self,
+        metadata: List[Dict[str, Any]],
+        *,
+        limit: int = MAX_NEIGHBOURS,
+        min_similarity: float = MIN_SIMILARITY,
+    ) -> TemplateMatch:
+        current = {str(q.get("question_code", "")): fingerprint(q) for q in metadata if q.get("question_code")}
+        neighbours = self.neighbours(metadata, limit=limit, min_similarity=min_similarity)
+        carried: List[Dict[str, Any]] = []
+        covered: Set[str] = set()
+        for sid, _ in neighbours:
+            study = self.load_study(sid)
+            if study is None:
+                continue
+            previous = study["variables"]
+            grouped_codes: Set[str] = set()
+            for item in study["groups"]:
+                members = item_members(item)
+                grouped_codes.update(members)
+                # Carry an item only if every member is unchanged and still unresolved
+                if all(m in current and previous.get(m) == current[m] and m not in covered for m in members):
+                    carried.append(item)
+                    covered.update(members)
+            # Unchanged variables the previous run left out of every item stay excluded
+            for code, fp in previous.items():
+                if code not in grouped_codes and current.get(code) == fp:
+                    covered.add(code)
+        return TemplateMatch(carried, covered, neighbours)
+
+
+def merge_carried(carried: List[Dict[str, Any]], data: List[Any], metadata: List[Dict[str, Any]]) -> List[Any]:
+    # Interleave reused and freshly grouped items in questionnaire (metadata) order
+    position = {str(q.get("question_code", "")): i for i, q in enumerate(metadata)}
+
+    def first(item: Any) -> int:
+        if not isinstance(item, dict):
+            return len(position)
+        return min((position.get(m, len(position)) for m in item_members(item)), default=len(position))
+
+    return sorted(carried + list(data), key=first)
+
+
+def describe_match(match: TemplateMatch, total: int) -> str:
+    near = ", ".join(f"{sid[:8]}~{s:.2f}" for sid, s in match.neighbours) or "none"
+    return (
+        f"[template] neighbours: {near}; reused {len(match.carried)} item(s), "
+        f"{len(match.covered)}/{total} variables resolved, {total - len(match.covered)} left for the model"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Index past step2 results and match new studies against them.")
+    parser.add_argument("--index", help="Index directory (default: Output/template_index)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_add = sub.add_parser("add", help="Add a study's step1 metadata and step2 grouping")
+    p_add.add_argument("--metadata", required=True)
+    p_add.add_argument("--grouped", required=True)
+    p_add.add_argument("--name", default="")
+    p_build = sub.add_parser("build", help="Add every run directory holding step1_metadata.json and step2_grouped_questions.json")
+    p_build.add_argument("dirs", nargs="+")
+    p_query = sub.add_parser("query", help="Show neighbours and what would be reused for a metadata file")
+    p_query.add_argument("--metadata", required=True)
+    p_query.add_argument("--min-similarity", type=float, default=MIN_SIMILARITY)
+    p_rm = sub.add_parser("rm", help="Remove a study")
+    p_rm.add_argument("study_id")
+    sub.add_parser("ls", help="List indexed studies")
+    args = parser.parse_args()
+
+    index = TemplateIndex(args.index)
+    if args.command == "add":
+        with open(args.metadata, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        with open(args.grouped, "r", encoding="utf-8") as f:
+            grouped = json.load(f)
+        sid = index.add(metadata, grouped, name=args.name, source=args.grouped)
+        print(f"[template] Added {sid} ({len(metadata)} variables, {len(grouped)} items)")
+    elif args.command == "build":
+        for root in args.dirs:
+            for base, _, names in os.walk(root):
+                if "step1_metadata.json" in names and "step2_grouped_questions.json" in names:
+                    with open(os.path.join(base, "step1_metadata.json"), "r", encoding="utf-8") as f:
+                        metadata = json.load(f)
+                    grouped_path = os.path.join(base, "step2_grouped_questions.json")
+                    with open(grouped_path, "r", encoding="utf-8") as f:
+                        grouped = json.load(f)
+                    sid = index.add(metadata, grouped, source=grouped_path)
+                    print(f"[template] Added {sid} from {base}")
+    elif args.command == "query":
+        with open(args.metadata, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        t0 = time.perf_counter()
+        match = index.match(metadata, min_similarity=args.min_similarity)
+        ms = (time.perf_counter() - t0) * 1000
+        print(describe_match(match, len(metadata)) + f" ({ms:.1f} ms)")
+        for sid, s in match.neighbours:
+            entry = index.studies[sid]
+            print(f"  {sid}  {s:.2f}  {entry.get('name') or '-'}  {entry.get('source')}")
+    elif args.command == "rm":
+        if not index.remove(args.study_id):
+            raise SystemExit(f"No study {args.study_id}")
+        print(f"[template] Removed {args.study_id}")
+    else:
+        for sid, entry in sorted(index.studies.items(), key=lambda kv: kv[1].get("added", 0.0)):
+            print(f"{sid}  {entry['variables']:5d} vars  {entry.get('name') or '-'}  {entry.get('source')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SCRIPTS_DIR = os.path.abspath(os.path.dirname(__file__))
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+
+from artifact_store import ArtifactStore, memo_key, new_run_id, sha256_file  # noqa: E402
+from slim_pdf import slim_pdf  # noqa: E402
+from worker_client import submit_job  # noqa: E402
+
+# One Streamlit "Run Grouping" click, without any Streamlit calls, so the app and the
+# load-test harness (loadtest_streamlit.py) execute exactly the same work per session.
+
+# Code each cached stage runs; its hash is part of the memo key so an edited step is not served
+# from results of the old code
+STAGE_SCRIPTS = {
+    "step1": [
+        "step1_extract_metadata.py",
+        "step1_extract_spss_metadata.py",
+        "step1_extract_xlsx_metadata.py",
+        "sampled_profile.py",
+        "data_readers.py",
+        "qmodel.py",
+    ],
+    "step2": ["step2_group_with_pdf_gemini.py", "step2_planner.py", "align_text.py", "template_index.py", "qmodel.py"],
+    "step3": ["step3_emit_groups.py", "column_index.py", "qmodel.py"],
+}
+
+
+def code_digest(stage: str) -> str:
+    return memo_key(stage + ":code", {name: sha256_file(os.path.join(SCRIPTS_DIR, name)) for name in STAGE_SCRIPTS[stage]})
+
+
+def run_step(cmd: List[str]) -> Tuple[int, str, float]:
+    start = time.time()
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        elapsed = time.time() - start
+        logs = (proc.stdout or "") + (proc.stderr or "")
+        return proc.returncode, logs, elapsed
+    except Exception:
+        elapsed = time.time() - start
+        return 1, traceback.format_exc(), elapsed
+
+
+def run_job(
+    step: str,
+    params: Dict[str, Any],
+    cmd: List[str],
+    profile_dir: Optional[str] = None,
+    user: Optional[str] = None,
+) -> Tuple[int, str, float]:
+    # Prefer the warm pipeline worker (queued as interactive work); fall back to running locally
+    if profile_dir:
+        params = dict(params, profile=profile_dir)
+        cmd = cmd + ["--profile", profile_dir]
+    result = submit_job(step, params, priority="interactive", user=user)
+    if result is not None:
+        return result
+    return run_step(cmd)
+
+
+def docx_to_pdf(docx_path: str, workdir: str) -> str:
+    # Convert to a temporary PDF by extracting text and writing a simple PDF
+    from docx import Document
+    import fitz  # PyMuPDF
+
+    doc = Document(docx_path)
+    text = []
+    for p in doc.paragraphs:
+        if p.text:
+            text.append(p.text)
+    text_content = "\n".join(text) or "(empty document)"
+    pdf_out = os.path.join(workdir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+    # Write a very basic PDF with the extracted text
+    pdf_doc = fitz.open()
+    page = pdf_doc.new_page()
+    rect = page.rect
+    page.insert_textbox(rect, text_content, fontsize=11, fontname="helv")
+    pdf_doc.save(pdf_out)
+    pdf_doc.close()
+    return pdf_out
+
+
+def run_cached(
+    store: ArtifactStore,
+    key: str,
+    outputs: Dict[str, str],
+    required: str,
+    run: Callable[[], Tuple[int, str, float]],
+    reuse: bool,
+) -> Tuple[int, str, float, bool]:
+    # Replays a stage from the store when the same inputs+params ran before; returns (rc, logs, t, hit)
+    t0 = time.time()
+    if reuse:
+        hit = store.memo_get(key)
+        if hit and required in hit:
+            for name, sha in hit.items():
+                if name in outputs:
+                    store.materialize(sha, outputs[name], link=False)
+            return 0, f"[cache] Reused stored {required} ({hit[required][:12]})\n", time.time() - t0, True
+    rc, logs, elapsed = run()
+    if rc == 0 and os.path.exists(outputs[required]):
+        store.memo_put(key, {name: store.put_file(path) for name, path in outputs.items() if os.path.exists(path)})
+    return rc, logs, elapsed, False
+
+
+def run_ui_pipeline(
+    data_name: str,
+    data_bytes: bytes,
+    doc_name: str,
+    doc_bytes: bytes,
+    *,
+    api_key: str,
+    use_flash: bool = True,
+    use_auto: bool = False,
+    slim: bool = False,
+    xlsx_all_sheets: bool = False,
+    profile: bool = False,
+    reuse: bool = True,
+    store: Optional[ArtifactStore] = None,
+    status: Optional[Callable[[str], None]] = None,
+    user: Optional[str] = None,
+) -> Dict[str, Any]:
+    say = status or (lambda _msg: None)
+    store = store or ArtifactStore()
+    run_id = new_run_id()
+    result: Dict[str, Any] = {
+        "ok": False,
+        "failed_step": None,
+        "rc": 0,
+        "error": "",
+        "cmd": [],
+        "logs": {"step1": "", "step2": "", "step3": ""},
+        "times": {},
+        "cached": [],
+        "run_id": run_id,
+        "outdir": "",
+        "paths": {},
+        "profile_dir": "",
+    }
+    # Stages work in a scratch dir; everything worth keeping is committed to the store at the end
+    workdir = tempfile.mkdtemp(prefix="ui_run_")
+    outdir = os.path.join(workdir, "out")
+    os.makedirs(outdir)
+    # Passed explicitly, not via PIPELINE_PROFILE_DIR: sessions share this process's environment
+    profile_dir = os.path.join(outdir, "profile") if profile else None
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    meta_out = os.path.join(outdir, "step1_metadata.json")
+    grouped_path = os.path.join(outdir, "step2_grouped_questions.json")
+    groups_path = os.path.join(outdir, "step3_groups.json")
+    index_path = os.path.join(outdir, "step3_column_index.json")
+    sav_path = os.path.join(workdir, os.path.basename(data_name))
+    pdf_path = os.path.join(workdir, os.path.basename(doc_name))
+    try:
+        # Identical uploads are stored once and linked into the scratch dir
+        data_sha = store.put_bytes(data_bytes)
+        doc_sha = store.put_bytes(doc_bytes)
+        store.materialize(data_sha, sav_path)
+        store.materialize(doc_sha, pdf_path)
+        # If DOCX uploaded, convert to a temporary PDF
+        if pdf_path.lower().endswith(".docx"):
+            try:
+                pdf_path = docx_to_pdf(pdf_path, workdir)
+            except Exception as e:
+                result.update(failed_step="convert", rc=1, error=f"Failed to convert DOCX to PDF: {e}")
+                return result
+
+        # Step 1: metadata (any supported data format)
+        say("[step] 1/2 Extract metadata…")
+        step1_cmd = [
+            sys.executable, os.path.join(SCRIPTS_DIR, "step1_extract_metadata.py"),
+            "--input", sav_path,
+            "--output", meta_out,
+            "--include-empty",
+        ]
+        if xlsx_all_sheets:
+            step1_cmd += ["--sheet", "all"]
+        sheet = "all" if xlsx_all_sheets else 0
+        rc1, logs1, t1, hit1 = run_cached(
+            store,
+            memo_key("step1", {"data": data_sha, "code": code_digest("step1")}, {"ext": os.path.splitext(sav_path)[1].lower(), "sheet": sheet}),
+            {"step1_metadata.json": meta_out},
+            "step1_metadata.json",
+            lambda: run_job(
+                "step1",
+                {"input": sav_path, "output": meta_out, "include_empty": True, "sheet": sheet},
+                step1_cmd,
+                profile_dir,
+                user,
+            ),
+            reuse,
+        )
+        result["logs"]["step1"] = logs1
+        result["times"]["step1"] = t1
+        if hit1:
+            result["cached"].append("step1")
+        if rc1 != 0:
+            result.update(failed_step="step1", rc=rc1, cmd=step1_cmd)
+            return result
+        say(f"[time] 1/2 Extract metadata: {t1:.1f}s" + (" (cached)" if hit1 else ""))
+
+        # Step 2: group with PDF+metadata
+        slim_logs = ""
+        if slim:
+            slim_path = os.path.splitext(pdf_path)[0] + ".slim.pdf"
+            stats = slim_pdf(pdf_path, slim_path, store=store, reuse=reuse, log=say)
+            slim_logs = f"[slim] {stats['bytes_before']} -> {stats['bytes_after']} bytes\n"
+            result["times"]["slim"] = stats["elapsed_s"]
+            pdf_path = slim_path
+        say("[step] 2/2 Group with PDF+metadata…")
+        step2_cmd = [
+            sys.executable, os.path.join(SCRIPTS_DIR, "step2_group_with_pdf_gemini.py"),
+            "--pdf", pdf_path,
+            "--metadata", meta_out,
+            "--output", grouped_path,
+        ]
+        if use_auto:
+            step2_cmd.append("--auto")
+        elif use_flash:
+            step2_cmd.append("--flash")
+        if not api_key:
+            result.update(
+                failed_step="config",
+                rc=1,
+                error="Gemini API key is not configured. Set Streamlit secret 'google-gemini-key' or env 'GOOGLE_API_KEY'.",
+            )
+            return result
+        step2_cmd += ["--api-key", api_key]
+        rc2, logs2, t2, hit2 = run_cached(
+            store,
+            memo_key(
+                "step2",
+                {"metadata": sha256_file(meta_out), "questionnaire": doc_sha, "code": code_digest("step2")},
+                {"flash": use_flash and not use_auto, "auto": use_auto, "slim": slim},
+            ),
+            {"step2_grouped_questions.json": grouped_path, "step2_grouped_questions.json.plan.json": grouped_path + ".plan.json"},
+            "step2_grouped_questions.json",
+            lambda: run_job(
+                "step2",
+                {
+                    "pdf": pdf_path,
+                    "metadata": meta_out,
+                    "output": grouped_path,
+                    "api_key": api_key,
+                    "flash": use_flash and not use_auto,
+                    "auto": use_auto,
+                },
+                step2_cmd,
+                profile_dir,
+                user,
+            ),
+            reuse,
+        )
+        result["logs"]["step2"] = slim_logs + logs2
+        result["times"]["step2"] = t2
+        if hit2:
+            result["cached"].append("step2")
+        if rc2 != 0:
+            result.update(failed_step="step2", rc=rc2, cmd=step2_cmd)
+            return result
+        say(f"[time] 2/2 Group with PDF+metadata: {t2:.1f}s" + (" (cached)" if hit2 else ""))
+
+        if not os.path.exists(grouped_path):
+            result.update(failed_step="output", rc=1, error="Grouping output not found. See logs below.")
+            return result
+
+        # Step 3: emit compact groups JSON (final output shape)
+        say("[step] Emit compact groups…")
+        step3_cmd = [
+            sys.executable, os.path.join(SCRIPTS_DIR, "step3_emit_groups.py"),
+            "--input", grouped_path,
+            "--output", groups_path,
+            "--index-output", index_path,
+        ]
+        rc3, logs3, t3, hit3 = run_cached(
+            store,
+            memo_key("step3", {"grouped": sha256_file(grouped_path), "code": code_digest("step3")}),
+            {"step3_groups.json": groups_path, "step3_column_index.json": index_path},
+            "step3_groups.json",
+            lambda: run_job("step3", {"input": grouped_path, "output": groups_path, "index_output": index_path}, step3_cmd, profile_dir, user),
+            reuse,
+        )
+        result["logs"]["step3"] = logs3
+        result["times"]["step3"] = t3
+        if hit3:
+            result["cached"].append("step3")
+        if rc3 != 0 or (not os.path.exists(groups_path)):
+            result.update(failed_step="step3", rc=rc3 or 1, cmd=step3_cmd)
+            return result
+
+        result["ok"] = True
+        return result
+    finally:
+        # Commit uploads, outputs, logs and profiles as one run; scratch files go away
+        files = {
+            "inputs/" + os.path.basename(sav_path): sav_path,
+            "inputs/" + os.path.basename(doc_name): os.path.join(workdir, os.path.basename(doc_name)),
+        }
+        for base, _, names in os.walk(outdir):
+            for n in names:
+                full = os.path.join(base, n)
+                files[os.path.relpath(full, outdir).replace(os.sep, "/")] = full
+        try:
+            store.commit_run(run_id, files, {
+                "ok": result["ok"],
+                "failed_step": result["failed_step"],
+                "flash": use_flash,
+                "auto": use_auto,
+                "slim": slim,
+                "cached": result["cached"],
+                "times": result["times"],
+            })
+            run_dir = store.run_dir(run_id)
+            result["outdir"] = run_dir
+            if result["ok"]:
+                result["paths"] = {
+                    "step1": os.path.join(run_dir, "step1_metadata.json"),
+                    "step2": os.path.join(run_dir, "step2_grouped_questions.json"),
+                    "step3": os.path.join(run_dir, "step3_groups.json"),
+                    "index": os.path.join(run_dir, "step3_column_index.json"),
+                }
+            if profile_dir:
+                result["profile_dir"] = os.path.join(run_dir, "profile")
+            store.evict()
+        finally:
+            # Clean up temp uploads
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,112 @@
+import getpass
+import http.client
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Scheduling defaults for callers that do not pass priority/user (see job_scheduler.py)
+PRIORITY_ENV = "PIPELINE_PRIORITY"
+USER_ENV = "PIPELINE_USER"
+
+
+def worker_url() -> str:
+    return os.environ.get("PIPELINE_WORKER_URL", f"http://{DEFAULT_HOST}:{DEFAULT_PORT}").rstrip("/")
+
+
+def worker_available(timeout: float = 0.5) -> bool:
+    if os.environ.get("PIPELINE_WORKER_DISABLE"):
+        return False
+    try:
+        with urllib.request.urlopen(worker_url() + "/health", timeout=timeout) as resp:
+            return resp.status == 200
+    except Exception:
+        return False
+
+
+def default_user() -> str:
+    try:
+        return os.environ.get(USER_ENV) or getpass.getuser()
+    except Exception:
+        return "anonymous"
+
+
+def _post(path: str, payload: Dict[str, Any], timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+    # None when the worker could not be reached. Once the request is out, failures raise instead:
+    # HTTPError for an error status, and http.client/OSError/ValueError from reading the response
+    # (a worker that died mid-job, a timeout, a truncated body), which urlopen does not wrap.
+    req = urllib.request.Request(
+        worker_url() + path,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read() or b"{}")
+    except urllib.error.HTTPError:
+        raise
+    except urllib.error.URLError:
+        return None
+
+
+def _error_text(exc: urllib.error.HTTPError) -> str:
+    try:
+        return str(json.loads(exc.read() or b"{}").get("error") or exc.reason)
+    except Exception:
+        return str(exc.reason)
+
+
+def submit_job(
+    step: str,
+    params: Dict[str, Any],
+    *,
+    priority: Optional[str] = None,
+    user: Optional[str] = None,
+    timeout: Optional[float] = 1800.0,
+) -> Optional[Tuple[int, str, float]]:
+    # Returns (rc, logs, elapsed) or None when no worker is reachable, so callers can run locally.
+    # timeout covers time queued behind other jobs as well as the run itself.
+    if not worker_available():
+        return None
+    t0 = time.time()
+    try:
+        out = _post("/jobs", {
+            "step": step,
+            "params": params,
+            "priority": priority or os.environ.get(PRIORITY_ENV) or "interactive",
+            "user": user or default_user(),
+        }, timeout)
+    except urllib.error.HTTPError as exc:
+        return 1, f"[worker] {step} rejected: HTTP {exc.code} {_error_text(exc)}\n", time.time() - t0
+    except (OSError, http.client.HTTPException, ValueError) as exc:
+        # The job may have started on the worker, so do not run it a second time locally
+        return 1, f"[worker] {step} failed: {type(exc).__name__}: {exc}\n", time.time() - t0
+    if out is None:
+        return None
+    return int(out.get("rc", 1)), str(out.get("logs", "")), float(out.get("elapsed", 0.0))
+
+
+def cancel_queued(*, user: Optional[str] = None, priority: str = "batch", timeout: float = 5.0) -> Optional[int]:
+    # Preempts queued (not yet running) jobs on the worker; returns how many were dropped, or None
+    # when no worker is reachable
+    if not worker_available():
+        return None
+    out = _post("/jobs/cancel", {"priority": priority, "user": user or ""}, timeout)
+    if out is None:
+        return None
+    return int(out.get("cancelled", 0))
+
+
+def queue_status(timeout: float = 2.0) -> Optional[Dict[str, Any]]:
+    if not worker_available():
+        return None
+    try:
+        with urllib.request.urlopen(worker_url() + "/queue", timeout=timeout) as resp:
+            return json.loads(resp.read() or b"{}")
+    except Exception:
+        return None
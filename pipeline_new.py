@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import os
 import shlex
 import subprocess
@@ -7,6 +8,13 @@ import sys
 import time
 
 ROOT = os.path.abspath(os.path.dirname(__file__))
+SCRIPTS_DIR = os.path.join(ROOT, "Scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+from pipeline_dag import critical_path, run_dag, stage  # noqa: E402
+from profiling import PROFILE_ENV, describe_summary, load_summaries, resolve_profile_dir  # noqa: E402
+from sampled_profile import DEFAULT_SAMPLE_ROWS  # noqa: E402
+from worker_client import PRIORITY_ENV, USER_ENV, submit_job  # noqa: E402
 
 
 def run(cmd: str, quiet: bool = False) -> int:
@@ -17,8 +25,38 @@ def run(cmd: str, quiet: bool = False) -> int:
     return subprocess.call(cmd, shell=True)
 
 
-def step1_extract_metadata(sav_path: str, output_json: str, include_empty: bool = False, *, quiet: bool = False) -> int:
-    script = os.path.join(ROOT, "Scripts", "step1_extract_spss_metadata.py")
+def run_on_worker(step: str, params: dict, *, quiet: bool = False) -> int | None:
+    # Submit to a running pipeline_worker.py; None means run locally instead
+    if os.environ.get(PROFILE_ENV):
+        params = dict(params, profile=os.environ[PROFILE_ENV])
+    # Batch jobs may queue behind interactive work for a long time; wait as long as it takes
+    result = submit_job(step, params, timeout=None)
+    if result is None:
+        return None
+    rc, logs, elapsed = result
+    if not quiet:
+        print(f"[worker] {step} finished in {elapsed:.1f}s")
+        if logs:
+            print(logs, end="" if logs.endswith("\n") else "\n")
+    return rc
+
+
+def step1_extract_metadata(
+    sav_path: str,
+    output_json: str,
+    include_empty: bool = False,
+    *,
+    sample: int | None = None,
+    exact_ranges: bool = False,
+    quiet: bool = False,
+) -> int:
+    params = {"input": os.path.abspath(sav_path), "output": os.path.abspath(output_json), "include_empty": include_empty}
+    if sample:
+        params.update(sample=sample, exact_ranges=exact_ranges)
+    rc = run_on_worker("step1", params, quiet=quiet)
+    if rc is not None:
+        return rc
+    script = os.path.join(ROOT, "Scripts", "step1_extract_metadata.py")
     args = [
         sys.executable,
         shlex.quote(script),
@@ -28,10 +66,111 @@ def step1_extract_metadata(sav_path: str, output_json: str, include_empty: bool
     ]
     if include_empty:
         args.append("--include-empty")
+    if sample:
+        args += ["--sample", str(sample)]
+        if exact_ranges:
+            args.append("--exact-ranges")
+    return run(" ".join(args), quiet=quiet)
+
+
+def detect_data_groups(data_path: str, output_json: str) -> int:
+    # Data-only grouping evidence; independent of step1 so it runs next to it
+    script = os.path.join(ROOT, "Scripts", "detect_data_groups.py")
+    return subprocess.call(
+        [sys.executable, script, "--input", data_path, "--output", output_json],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def align_text(pdf_path: str, metadata_path: str, output_json: str, *, quiet: bool = False) -> int:
+    script = os.path.join(ROOT, "Scripts", "align_text.py")
+    args = [
+        sys.executable,
+        shlex.quote(script),
+        "--pdf", shlex.quote(pdf_path),
+        "--metadata", shlex.quote(metadata_path),
+        "--output", shlex.quote(output_json),
+    ]
+    return run(" ".join(args), quiet=quiet)
+
+
+def slim_pdf(pdf_path: str, output_pdf: str, *, quiet: bool = False) -> int:
+    script = os.path.join(ROOT, "Scripts", "slim_pdf.py")
+    args = [
+        sys.executable,
+        shlex.quote(script),
+        "--input", shlex.quote(pdf_path),
+        "--output", shlex.quote(output_pdf),
+    ]
     return run(" ".join(args), quiet=quiet)
 
 
-def step2_extract_llm_pdf(pdf_path: str, metadata_path: str, output_json: str, api_key: str | None = None, *, quiet: bool = False, flash: bool = False) -> int:
+def step2_upload_pdf(pdf_path: str, record_json: str, api_key: str | None = None, *, quiet: bool = False) -> int:
+    rc = run_on_worker(
+        "upload",
+        {"pdf": os.path.abspath(pdf_path), "output": os.path.abspath(record_json), "api_key": api_key},
+        quiet=quiet,
+    )
+    if rc is not None:
+        return rc
+    script = os.path.join(ROOT, "Scripts", "step2_group_with_pdf_gemini.py")
+    args = [
+        sys.executable,
+        shlex.quote(script),
+        "--pdf", shlex.quote(pdf_path),
+        "--output", shlex.quote(record_json),
+        "--upload-only",
+    ]
+    if api_key:
+        args += ["--api-key", shlex.quote(api_key)]
+    return run(" ".join(args), quiet=quiet)
+
+
+def upload_record_fresh(record_json: str) -> bool:
+    # Mirrors step2's UPLOAD_MAX_AGE_S: Gemini drops uploaded files after 48h
+    try:
+        with open(record_json, "r", encoding="utf-8") as f:
+            record = json.load(f)
+        return time.time() - float(record.get("uploaded_at", 0)) < 47 * 3600
+    except Exception:
+        return False
+
+
+def step2_extract_llm_pdf(
+    pdf_path: str,
+    metadata_path: str,
+    output_json: str,
+    api_key: str | None = None,
+    *,
+    quiet: bool = False,
+    flash: bool = False,
+    auto: bool = False,
+    max_latency: float | None = None,
+    max_cost: float | None = None,
+    uploaded: str | None = None,
+    alignment: str | None = None,
+    template_index: str | None = None,
+) -> int:
+    rc = run_on_worker(
+        "step2",
+        {
+            "pdf": os.path.abspath(pdf_path),
+            "metadata": os.path.abspath(metadata_path),
+            "output": os.path.abspath(output_json),
+            "api_key": api_key,
+            "flash": flash,
+            "auto": auto,
+            "max_latency": max_latency,
+            "max_cost": max_cost,
+            "uploaded": os.path.abspath(uploaded) if uploaded else None,
+            "alignment": os.path.abspath(alignment) if alignment else None,
+            "template_index": os.path.abspath(template_index) if template_index else None,
+        },
+        quiet=quiet,
+    )
+    if rc is not None:
+        return rc
     script = os.path.join(ROOT, "Scripts", "step2_group_with_pdf_gemini.py")
     args = [
         sys.executable,
@@ -44,74 +183,231 @@ def step2_extract_llm_pdf(pdf_path: str, metadata_path: str, output_json: str, a
         args += ["--api-key", shlex.quote(api_key)]
     if flash:
         args += ["--flash"]
+    if auto:
+        args += ["--auto"]
+        if max_latency is not None:
+            args += ["--max-latency", str(max_latency)]
+        if max_cost is not None:
+            args += ["--max-cost", str(max_cost)]
+    if uploaded:
+        args += ["--uploaded", shlex.quote(uploaded)]
+    if alignment:
+        args += ["--alignment", shlex.quote(alignment)]
+    if template_index:
+        args += ["--template-index", shlex.quote(template_index)]
     return run(" ".join(args), quiet=quiet)
 
+
+def step3_emit_groups(grouped_json: str, output_json: str, index_json: str | None = None) -> int:
+    # Groups from an earlier run in the same outdir are diffed into <output>.delta.json
+    previous = output_json if os.path.exists(output_json) else None
+    rc = run_on_worker("step3", {
+        "input": os.path.abspath(grouped_json),
+        "output": os.path.abspath(output_json),
+        "index_output": os.path.abspath(index_json) if index_json else None,
+        "previous": os.path.abspath(previous) if previous else None,
+    })
+    if rc is not None:
+        return rc
+    return subprocess.call(
+        [
+            "python",
+            os.path.join(ROOT, "Scripts", "step3_emit_groups.py"),
+            "--input", grouped_json,
+            "--output", output_json,
+        ] + (["--index-output", index_json] if index_json else []) + (["--previous", previous] if previous else []),
+        shell=False,
+    )
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Pipeline (steps 1–2): metadata, group-with-PDF")
     sub = parser.add_subparsers(dest="command", required=True)
 
     p_all = sub.add_parser("all", help="Run steps 1–2")
-    p_all.add_argument("--sav", required=True)
+    p_all.add_argument("--sav", "--data", dest="sav", required=True, help="Data file: .sav, .xlsx, .csv or .parquet (format auto-detected)")
     p_all.add_argument("--pdf", required=True)
     p_all.add_argument("--outdir", required=False, default=os.path.join(ROOT, "Output"))
     # removed indent control; scripts use fixed indentation
     p_all.add_argument("--api-key")
     p_all.add_argument("--verbose", action="store_true")
     p_all.add_argument("--flash", action="store_true", help="Use Gemini 2.5 Flash (thinking_budget 4096)")
+    p_all.add_argument("--auto", action="store_true", help="Let step2 plan model, thinking budget and sharding from the study size")
+    p_all.add_argument("--max-latency", type=float, help="With --auto: target seconds for the Gemini calls")
+    p_all.add_argument("--max-cost", type=float, help="With --auto: target USD for the Gemini calls")
+    p_all.add_argument("--align", action="store_true", help="Align variables to questionnaire text locally; step2 gets stem clusters as hints and shard boundaries")
+    p_all.add_argument("--slim-pdf", action="store_true", help="Shrink the questionnaire (images, fonts, annotations, metadata) before it is uploaded")
+    p_all.add_argument("--template-index", metavar="DIR", help="Reuse groups from matching earlier studies in a template_index.py directory and index this run")
+    p_all.add_argument("--sample", type=int, nargs="?", const=DEFAULT_SAMPLE_ROWS, metavar="ROWS", help=f"step1: derive answers from a sample of about ROWS rows (default {DEFAULT_SAMPLE_ROWS}) for very large data files")
+    p_all.add_argument("--exact-ranges", action="store_true", help="With --sample: read numeric range columns in full for exact min/max")
+    p_all.add_argument("--data-groups", action="store_true", help="Also detect grid/multi-select evidence from the response data alongside step1")
+    p_all.add_argument("--force", action="store_true", help="Rerun every stage even if its inputs are unchanged")
+    p_all.add_argument("--jobs", type=int, default=4, help="Maximum stages running at once (default: 4)")
+    p_all.add_argument("--no-worker", action="store_true", help="Run steps locally even if pipeline_worker.py is running")
+    p_all.add_argument("--priority", choices=["interactive", "batch"], default="batch", help="Worker queue for this run's jobs (default: batch; the Streamlit app submits interactive)")
+    p_all.add_argument("--user", help=f"Name this run's jobs count against for fair share (default: ${USER_ENV} or the login name)")
+    p_all.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="DIR",
+        help="Profile every stage (cProfile, tracemalloc, collapsed stacks) into DIR (default: <outdir>/profile/<timestamp>)",
+    )
 
     args = parser.parse_args()
 
     if args.command == "all":
+        if args.no_worker:
+            os.environ["PIPELINE_WORKER_DISABLE"] = "1"
+        # Read by worker_client.submit_job for every stage submitted to the worker
+        os.environ[PRIORITY_ENV] = args.priority
+        if args.user:
+            os.environ[USER_ENV] = args.user
         os.makedirs(args.outdir, exist_ok=True)
+        profile_dir = None
+        if args.profile is not None:
+            profile_dir = os.path.abspath(resolve_profile_dir(args.profile, os.path.join(args.outdir, "profile")))
+            # Stage subprocesses and worker jobs pick this up and profile themselves
+            os.environ[PROFILE_ENV] = profile_dir
         concise = not getattr(args, "verbose", False)
         meta_out = os.path.join(args.outdir, "step1_metadata.json")
         pdf_out = os.path.join(args.outdir, "step2_grouped_questions.json")
         groups_out = os.path.join(args.outdir, "step3_groups.json")
+        index_out = os.path.join(args.outdir, "step3_column_index.json")
+        data_groups_out = os.path.join(args.outdir, "step1_data_groups.json")
+        align_out = os.path.join(args.outdir, "step2_alignment.json")
+        slim_out = os.path.join(args.outdir, "step2_questionnaire.slim.pdf")
+        # With --slim-pdf the model sees the slimmed file; text alignment keeps the original
+        model_pdf = slim_out if args.slim_pdf else args.pdf
+
+        upload_out = os.path.join(args.outdir, "step2_upload.json")
+        state_path = os.path.join(args.outdir, ".pipeline_state.json")
+        scripts = lambda *names: [os.path.join(SCRIPTS_DIR, n) for n in names]  # noqa: E731
+        step2_params = {
+            "flash": bool(args.flash),
+            "auto": bool(args.auto),
+            "max_latency": args.max_latency,
+            "max_cost": args.max_cost,
+            "align": bool(args.align),
+            "template_index": os.path.abspath(args.template_index) if args.template_index else None,
+        }
+
+        # Stages form a DAG: step1 and the PDF upload are independent and run concurrently
+        stages = [
+            stage(
+                "step1",
+                lambda: step1_extract_metadata(
+                    args.sav, meta_out, include_empty=True, sample=args.sample, exact_ranges=args.exact_ranges, quiet=concise
+                ),
+                inputs=[args.sav] + scripts(
+                    "step1_extract_metadata.py",
+                    "step1_extract_spss_metadata.py",
+                    "step1_extract_xlsx_metadata.py",
+                    "data_readers.py",
+                    "sampled_profile.py",
+                ),
+                outputs=[meta_out],
+                params=dict({"include_empty": True}, **({"sample": args.sample, "exact_ranges": bool(args.exact_ranges)} if args.sample else {})),
+            ),
+            stage(
+                "upload",
+                lambda: step2_upload_pdf(model_pdf, upload_out, api_key=args.api_key, quiet=concise),
+                deps=["slim"] if args.slim_pdf else [],
+                inputs=[model_pdf],
+                outputs=[upload_out],
+                fresh=lambda: upload_record_fresh(upload_out),
+            ),
+            stage(
+                "step2",
+                lambda: step2_extract_llm_pdf(
+                    model_pdf,
+                    meta_out,
+                    pdf_out,
+                    api_key=args.api_key,
+                    quiet=concise,
+                    flash=getattr(args, "flash", False),
+                    auto=args.auto,
+                    max_latency=args.max_latency,
+                    max_cost=args.max_cost,
+                    uploaded=upload_out,
+                    # align is optional: without its output step2 simply runs unhinted
+                    alignment=align_out if args.align and os.path.exists(align_out) else None,
+                    template_index=args.template_index,
+                ),
+                deps=["step1", "upload"] + (["align"] if args.align else []),
+                inputs=[meta_out, model_pdf] + ([align_out] if args.align else []) + scripts("step2_group_with_pdf_gemini.py", "step2_planner.py", "template_index.py"),
+                outputs=[pdf_out],
+                params=step2_params,
+            ),
+            # Emit compact groups as final layer
+            stage(
+                "step3",
+                lambda: step3_emit_groups(pdf_out, groups_out, index_out),
+                deps=["step2"],
+                inputs=[pdf_out] + scripts("step3_emit_groups.py", "column_index.py"),
+                outputs=[groups_out, index_out],
+                optional=True,
+            ),
+        ]
+        if args.slim_pdf:
+            stages.append(stage(
+                "slim",
+                lambda: slim_pdf(args.pdf, slim_out, quiet=concise),
+                inputs=[args.pdf] + scripts("slim_pdf.py"),
+                outputs=[slim_out],
+            ))
+        if args.align:
+            stages.append(stage(
+                "align",
+                lambda: align_text(args.pdf, meta_out, align_out, quiet=concise),
+                deps=["step1"],
+                inputs=[args.pdf, meta_out] + scripts("align_text.py"),
+                outputs=[align_out],
+                optional=True,
+            ))
+        if args.data_groups:
+            stages.append(stage(
+                "data-groups",
+                lambda: detect_data_groups(args.sav, data_groups_out),
+                inputs=[args.sav] + scripts("detect_data_groups.py", "data_readers.py"),
+                outputs=[data_groups_out],
+                optional=True,
+            ))
 
-        # Step 1
-        print("[step] 1/2 Extract metadata…", flush=True)
-        t0 = time.time()
-        rc = step1_extract_metadata(args.sav, meta_out, include_empty=True, quiet=True)
-        if rc != 0:
-            return rc
-        t_step1 = time.time()-t0
-        print(f"[time] 1/2 Extract metadata: {t_step1:.1f}s", flush=True)
-
-        # Step 2
-        print("[step] 2/2 Group with PDF+metadata…", flush=True)
         t0 = time.time()
-        rc = step2_extract_llm_pdf(
-            args.pdf,
-            meta_out,
-            pdf_out,
-            api_key=args.api_key,
-            quiet=True,
-            flash=getattr(args, "flash", False),
+        results = run_dag(
+            stages,
+            state_path,
+            force=args.force,
+            max_workers=args.jobs,
+            log=lambda msg: print(msg, flush=True),
+        )
+        wall = time.time() - t0
+        path, path_time = critical_path(stages, results)
+        print(f"[time] total: {wall:.1f}s", flush=True)
+        print(
+            "[time] critical path: "
+            + " -> ".join(f"{n} ({results[n]['duration']:.1f}s)" for n in path if n in results)
+            + f" = {path_time:.1f}s",
+            flush=True,
         )
-        t_step2 = time.time()-t0
-        print(f"[time] 2/2 Group with PDF+metadata: {t_step2:.1f}s", flush=True)
-        # Emit compact groups as final layer
-        try:
-            rc3 = subprocess.call(
-                [
-                    "python",
-                    os.path.join(ROOT, "Scripts", "step3_emit_groups.py"),
-                    "--input", pdf_out,
-                    "--output", groups_out,
-                ],
-                shell=False,
-            )
-            if rc3 == 0:
-                print(f"[time] total: {t_step1 + t_step2:.1f}s", flush=True)
-                print(f"[groups] {groups_out}")
-            else:
-                print(f"[warn] groups emission failed (exit {rc3})")
-                print(f"[time] total: {t_step1 + t_step2:.1f}s", flush=True)
-        except Exception as exc:
-            print(f"[warn] groups emission error: {exc}")
-            print(f"[time] total: {t_step1 + t_step2:.1f}s", flush=True)
-        if rc != 0:
-            return rc
+
+        if profile_dir:
+            for summary in load_summaries(profile_dir).values():
+                print(describe_summary(summary), flush=True)
+            print(f"[profile] {profile_dir}", flush=True)
+
+        for name in ("data-groups", "step3"):
+            res = results.get(name)
+            if res and res["status"] in ("failed", "blocked"):
+                print(f"[warn] {name} {res['status']} (exit {res['rc']})")
+        if results.get("step3", {}).get("status") in ("ran", "skipped"):
+            print(f"[groups] {groups_out}")
+        for name in ("step1", "slim", "upload", "step2"):
+            res = results.get(name)
+            if res and res["status"] in ("failed", "blocked"):
+                return res["rc"] or 1
         return 0
 
     return 2
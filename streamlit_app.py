@@ -1,45 +1,57 @@
 #!/usr/bin/env python3
 import json
 import os
-import shutil
-import subprocess
-import tempfile
-import time
-from datetime import datetime
+import sys
+import uuid
 
 import streamlit as st
-import sys
-import traceback
 
 
 ROOT = os.path.abspath(os.path.dirname(__file__))
 PIPELINE = os.path.join(ROOT, "pipeline_new.py")
 SCRIPTS_DIR = os.path.join(ROOT, "Scripts")
-
-
-def run_step(cmd: list[str]) -> tuple[int, str, float]:
-    start = time.time()
-    try:
-        proc = subprocess.run(cmd, capture_output=True, text=True)
-        elapsed = time.time() - start
-        logs = (proc.stdout or "") + (proc.stderr or "")
-        return proc.returncode, logs, elapsed
-    except Exception:
-        elapsed = time.time() - start
-        return 1, traceback.format_exc(), elapsed
+sys.path.insert(0, SCRIPTS_DIR)
+
+from profiling import load_summaries  # noqa: E402
+from ui_pipeline import run_ui_pipeline  # noqa: E402
+
+
+def show_profiles(profile_dir: str) -> None:
+    summaries = load_summaries(profile_dir)
+    with st.expander("Profile", expanded=False):
+        st.caption(f"Written to {profile_dir} (.prof for snakeviz, .collapsed for flamegraph.pl/speedscope)")
+        st.table([
+            {
+                "step": name,
+                "wall (s)": s.get("wall_s"),
+                "cpu (s)": s.get("thread_cpu_s"),
+                "peak memory (MB)": s.get("mem_peak_mb"),
+            }
+            for name, s in summaries.items()
+        ])
+        for name in summaries:
+            txt = os.path.join(profile_dir, f"{name}.txt")
+            if os.path.exists(txt):
+                with open(txt, "r", encoding="utf-8") as f:
+                    st.code(f.read(), language=None)
 
 
 def main() -> None:
     st.set_page_config(page_title="Questionnaire Grouper", page_icon="📊", layout="wide")
 
     st.title("📊 Questionnaire Grouper")
-    st.caption("Upload an SPSS .sav and the questionnaire PDF. The app extracts metadata and groups questions (multi-select/grid), optionally using Gemini 2.5 Flash.")
+    st.caption("Upload a data file (SPSS .sav, Excel, CSV or Parquet) and the questionnaire PDF. The app extracts metadata and groups questions (multi-select/grid), optionally using Gemini 2.5 Flash.")
 
     with st.sidebar:
         st.header("Settings")
-        use_flash = st.toggle("Use Gemini 2.5 Flash (faster)", value=True)
+        use_auto = st.toggle("Auto-select model and thinking budget", value=False)
+        use_flash = st.toggle("Use Gemini 2.5 Flash (faster)", value=True, disabled=use_auto)
+        use_slim = st.toggle("Shrink the questionnaire before upload (images, fonts, metadata)", value=True)
         # Fixed JSON indentation in scripts; no user control
         show_tb = st.toggle("Show Python traceback on error", value=True)
+        xlsx_all_sheets = st.toggle("Read every sheet of Excel workbooks", value=False)
+        use_profile = st.toggle("Profile each step (CPU, memory, flamegraph stacks)", value=False)
+        use_reuse = st.toggle("Reuse cached results for identical inputs", value=True)
         # Read Gemini key from Streamlit secrets or env; no manual entry in UI
         secret_key = ""
         try:
@@ -50,7 +62,7 @@ def main() -> None:
 
     c1, c2 = st.columns(2)
     with c1:
-        sav_file = st.file_uploader("Data file (.sav or .xlsx)", type=["sav","xlsx"], accept_multiple_files=False)
+        sav_file = st.file_uploader("Data file (.sav, .xlsx, .csv or .parquet)", type=["sav","xlsx","csv","parquet"], accept_multiple_files=False)
     with c2:
         pdf_file = st.file_uploader("Questionnaire (PDF or DOCX)", type=["pdf","docx"], accept_multiple_files=False)
 
@@ -61,146 +73,76 @@ def main() -> None:
             st.error("Please upload both the data file and the questionnaire.")
             return
 
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        workdir = tempfile.mkdtemp(prefix=f"ui_run_{ts}_", dir=None)
-        outdir_base = os.path.join(ROOT, "Output", "ui_runs")
-        outdir = os.path.join(outdir_base, ts)
-        os.makedirs(outdir, exist_ok=True)
-
-        sav_path = os.path.join(workdir, sav_file.name)
-        pdf_path = os.path.join(workdir, pdf_file.name)
-        with open(sav_path, "wb") as f:
-            f.write(sav_file.getbuffer())
-        with open(pdf_path, "wb") as f:
-            f.write(pdf_file.getbuffer())
-        # If DOCX uploaded, convert to a temporary PDF by extracting text and writing to simple PDF
-        if pdf_path.lower().endswith(".docx"):
-            try:
-                from docx import Document
-                import fitz  # PyMuPDF
-                doc = Document(pdf_path)
-                text = []
-                for p in doc.paragraphs:
-                    if p.text:
-                        text.append(p.text)
-                text_content = "\n".join(text) or "(empty document)"
-                pdf_out = os.path.join(workdir, os.path.splitext(os.path.basename(pdf_path))[0] + ".pdf")
-                # Write a very basic PDF with the extracted text
-                pdf_doc = fitz.open()
-                page = pdf_doc.new_page()
-                rect = page.rect
-                page.insert_textbox(rect, text_content, fontsize=11, fontname="helv")
-                pdf_doc.save(pdf_out)
-                pdf_doc.close()
-                pdf_path = pdf_out
-            except Exception as e:
-                st.error(f"Failed to convert DOCX to PDF: {e}")
-                shutil.rmtree(workdir, ignore_errors=True)
-                return
-
-        st.info("Starting pipeline…")
-        status = st.empty()
-        # Step 1: metadata (.sav or .xlsx)
-        status.write("[step] 1/2 Extract metadata…")
-        meta_out = os.path.join(outdir, "step1_metadata.json")
-        if sav_path.lower().endswith(".xlsx"):
-            step1_cmd = [
-                sys.executable, os.path.join(SCRIPTS_DIR, "step1_extract_xlsx_metadata.py"),
-                "--input", sav_path,
-                "--output", meta_out,
-                "--include-empty",
-            ]
-        else:
-            step1_cmd = [
-                sys.executable, os.path.join(SCRIPTS_DIR, "step1_extract_spss_metadata.py"),
-                "--input", sav_path,
-                "--output", meta_out,
-                "--include-empty",
-            ]
-        rc1, logs1, t1 = run_step(step1_cmd)
-        if rc1 != 0:
-            st.error(f"Step 1 failed ({t1:.1f}s)")
-            with st.expander("Logs", expanded=True):
-                if not logs1.strip():
-                    st.write(f"Return code: {rc1}")
-                    st.code("(no output)")
-                    st.code("CMD: " + " ".join(step1_cmd))
-                else:
-                    st.code(logs1)
-            if show_tb and logs1.strip() == "":
-                st.exception(RuntimeError("Step 1 failed"))
-            shutil.rmtree(workdir, ignore_errors=True)
-            return
-        status.write(f"[time] 1/2 Extract metadata: {t1:.1f}s")
-
-        # Step 2: group with PDF+metadata
-        status.write("[step] 2/2 Group with PDF+metadata…")
-        step2_cmd = [
-            sys.executable, os.path.join(SCRIPTS_DIR, "step2_group_with_pdf_gemini.py"),
-            "--pdf", pdf_path,
-            "--metadata", meta_out,
-            "--output", os.path.join(outdir, "step2_grouped_questions.json"),
-        ]
-        if use_flash:
-            step2_cmd.append("--flash")
         effective_api_key = (secret_key or os.environ.get("GOOGLE_API_KEY", "")).strip()
         if effective_api_key:
             os.environ["GOOGLE_API_KEY"] = effective_api_key
-            step2_cmd += ["--api-key", effective_api_key]
-        else:
-            st.error("Gemini API key is not configured. Set Streamlit secret 'google-gemini-key' or env 'GOOGLE_API_KEY'.")
-            shutil.rmtree(workdir, ignore_errors=True)
+
+        # Worker fair share is per browser session unless PIPELINE_USER names the analyst
+        user = os.environ.get("PIPELINE_USER") or st.session_state.setdefault("user_id", "ui-" + uuid.uuid4().hex[:8])
+        st.info("Starting pipeline…")
+        status = st.empty()
+        result = run_ui_pipeline(
+            sav_file.name,
+            bytes(sav_file.getbuffer()),
+            pdf_file.name,
+            bytes(pdf_file.getbuffer()),
+            api_key=effective_api_key,
+            use_flash=use_flash,
+            use_auto=use_auto,
+            slim=use_slim,
+            xlsx_all_sheets=xlsx_all_sheets,
+            profile=use_profile,
+            reuse=use_reuse,
+            status=status.write,
+            user=user,
+        )
+        logs1 = result["logs"]["step1"]
+        logs2 = result["logs"]["step2"]
+        logs3 = result["logs"]["step3"]
+        failed = result["failed_step"]
+        if failed in ("convert", "config"):
+            st.error(result["error"])
             return
-        rc2, logs2, t2 = run_step(step2_cmd)
-        if rc2 != 0:
-            st.error(f"Step 2 failed ({t2:.1f}s)")
+        if failed in ("step1", "step2"):
+            n = failed[-1]
+            rc = result["rc"]
+            elapsed = result["times"].get(failed, 0.0)
+            st.error(f"Step {n} failed ({elapsed:.1f}s)")
             with st.expander("Logs", expanded=True):
-                combined = (logs1 or "") + "\n" + (logs2 or "")
+                combined = logs1 if failed == "step1" else (logs1 or "") + "\n" + (logs2 or "")
                 if not combined.strip():
-                    st.write(f"Return code: {rc2}")
+                    st.write(f"Return code: {rc}")
                     st.code("(no output)")
-                    st.code("CMD: " + " ".join(step2_cmd))
+                    st.code("CMD: " + " ".join(result["cmd"]))
                 else:
                     st.code(combined)
-            if show_tb and (logs2.strip() == ""):
-                st.exception(RuntimeError("Step 2 failed"))
-            shutil.rmtree(workdir, ignore_errors=True)
+            if show_tb and result["logs"][failed].strip() == "":
+                st.exception(RuntimeError(f"Step {n} failed"))
             return
-        status.write(f"[time] 2/2 Group with PDF+metadata: {t2:.1f}s")
-
-        # Success: read outputs
-        grouped_path = os.path.join(outdir, "step2_grouped_questions.json")
-        if not os.path.exists(grouped_path):
-            st.warning("Grouping output not found. See logs below.")
+        if failed == "output":
+            st.warning(result["error"])
             with st.expander("Logs", expanded=True):
                 st.code(logs1 + "\n" + logs2)
-            shutil.rmtree(workdir, ignore_errors=True)
             return
-
-        # Step 3: emit compact groups JSON (final output shape)
-        status.write("[step] Emit compact groups…")
-        groups_path = os.path.join(outdir, "step3_groups.json")
-        step3_cmd = [
-            sys.executable, os.path.join(SCRIPTS_DIR, "step3_emit_groups.py"),
-            "--input", grouped_path,
-            "--output", groups_path,
-        ]
-        rc3, logs3, t3 = run_step(step3_cmd)
-        if rc3 != 0 or (not os.path.exists(groups_path)):
-            st.error(f"Groups emission failed ({t3:.1f}s)")
+        if failed == "step3":
+            st.error(f"Groups emission failed ({result['times'].get('step3', 0.0):.1f}s)")
             with st.expander("Logs", expanded=True):
                 combined3 = (logs1 or "") + "\n" + (logs2 or "") + "\n" + (logs3 or "")
                 if not combined3.strip():
-                    st.write(f"Return code: {rc3}")
+                    st.write(f"Return code: {result['rc']}")
                     st.code("(no output)")
-                    st.code("CMD: " + " ".join(step3_cmd))
+                    st.code("CMD: " + " ".join(result["cmd"]))
                 else:
                     st.code(combined3)
-            shutil.rmtree(workdir, ignore_errors=True)
             return
+        meta_out = result["paths"]["step1"]
+        grouped_path = result["paths"]["step2"]
+        groups_path = result["paths"]["step3"]
 
         status.write("Completed. Showing results…")
         st.success("Done")
+        if result["cached"]:
+            st.caption("Reused cached results for: " + ", ".join(result["cached"]))
 
         # Load groups.json
         try:
@@ -212,7 +154,6 @@ def main() -> None:
                 st.exception(e)
             with st.expander("Logs", expanded=False):
                 st.code(logs1 + "\n" + logs2 + "\n" + logs3)
-            shutil.rmtree(workdir, ignore_errors=True)
             return
 
         groups_list = groups_obj.get("groups") if isinstance(groups_obj, dict) else []
@@ -220,7 +161,7 @@ def main() -> None:
 
         m1, m2 = st.columns(2)
         m1.metric("Groups", f"{num_groups}")
-        m2.metric("Flash", "Yes" if use_flash else "No")
+        m2.metric("Flash", "Auto" if use_auto else ("Yes" if use_flash else "No"))
 
         st.subheader("Groups (first 10)")
         st.json(groups_list[:10], expanded=False)
@@ -232,10 +173,13 @@ def main() -> None:
             mime="application/json",
         )
 
+        if result["profile_dir"]:
+            show_profiles(result["profile_dir"])
+
         with st.expander("Full logs"):
             st.code(logs1 + "\n" + logs2 + ("\n" + logs3 if logs3 else ""))
 
-        # Provide direct downloads for all three artifacts
+        # Provide direct downloads for every artifact
         st.subheader("Downloads")
         try:
             with open(meta_out, "r", encoding="utf-8") as f:
@@ -252,8 +196,13 @@ def main() -> None:
                 final_groups_content = f.read()
         except Exception:
             final_groups_content = ""
+        try:
+            with open(result["paths"]["index"], "r", encoding="utf-8") as f:
+                index_content = f.read()
+        except Exception:
+            index_content = ""
 
-        d1, d2, d3 = st.columns(3)
+        d1, d2, d3, d4 = st.columns(4)
         with d1:
             st.download_button(
                 label="Download step1 metadata",
@@ -275,9 +224,13 @@ def main() -> None:
                 file_name="groups.json",
                 mime="application/json",
             )
-
-        # Clean up temp uploads
-        shutil.rmtree(workdir, ignore_errors=True)
+        with d4:
+            st.download_button(
+                label="Download column index",
+                data=index_content,
+                file_name="column_index.json",
+                mime="application/json",
+            )
 
 
 if __name__ == "__main__":